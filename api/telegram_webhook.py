@@ -8,17 +8,25 @@ import requests
 import logging
 from flask import Flask, request, jsonify
 
+# Корень репозитория — для импорта bot.job_runner
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot.job_runner import get_job_runner, send_message, send_notice, JOB_QUEUED, JOB_DUPLICATE
+from bot.update_queue import get_update_queue, UPDATE_FULL
+from bot.report_cache import get_report_cache
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
-@app.route('/api/telegram_webhook', methods=['POST', 'GET'])
-def telegram_webhook():
-    if request.method == 'GET':
-        return 'ok', 200
+# local — команды выполняются встроенной очередью заданий, github — через GitHub Actions
+JOB_RUNNER_MODE = os.environ.get('JOB_RUNNER_MODE', 'local').strip().lower()
 
+
+def dispatch_to_github(command, chat_id, user_id, user_name) -> bool:
+    """Отправляет команду в GitHub Actions (repository_dispatch)"""
     GITHUB_TOKEN = os.environ.get('GITHUB_TOKEN')
     GITHUB_REPO = os.environ.get('GITHUB_REPO', 'krvzdrv/planfix_kpi')
     GITHUB_EVENT_TYPE = "telegram_command"
@@ -28,28 +36,85 @@ def telegram_webhook():
         logger.error("Missing required environment variables: GITHUB_TOKEN or GITHUB_REPO")
         logger.error(f"GITHUB_TOKEN: {'set' if GITHUB_TOKEN else 'not set'}")
         logger.error(f"GITHUB_REPO: {GITHUB_REPO}")
-        return jsonify({"error": "Server configuration error"}), 500
+        return False
 
     # Логируем конфигурацию (без токена)
     logger.info(f"GitHub Repo: {GITHUB_REPO}")
     logger.info(f"GitHub Token: {'set' if GITHUB_TOKEN else 'not set'}")
 
+    headers = {
+        "Authorization": f"token {GITHUB_TOKEN}",
+        "Accept": "application/vnd.github.v3+json",
+        "User-Agent": "Planfix-KPI-Webhook/1.0"
+    }
+    payload = {
+        "event_type": GITHUB_EVENT_TYPE,
+        "client_payload": {
+            "chat_id": chat_id,
+            "command": command,
+            "user_id": user_id,
+            "user_name": user_name
+        }
+    }
+
+    github_url = f"https://api.github.com/repos/{GITHUB_REPO}/dispatches"
+    logger.info(f"Sending dispatch to GitHub: {command}")
+    logger.info(f"GitHub URL: {github_url}")
+    logger.info(f"Payload: {payload}")
+
     try:
-        data = request.get_json(force=True, silent=True) or {}
-        message = data.get('message', {})
-        text = message.get('text', '')
-        chat_id = message.get('chat', {}).get('id')
-        user_id = message.get('from', {}).get('id')
-        user_name = message.get('from', {}).get('first_name', 'Unknown')
+        response = requests.post(
+            github_url,
+            json=payload,
+            headers=headers,
+            timeout=10
+        )
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Request error: {e}")
+        return False
+
+    logger.info(f"GitHub API Response Status: {response.status_code}")
+    logger.info(f"GitHub API Response Headers: {dict(response.headers)}")
+    logger.info(f"GitHub API Response Body: {response.text}")
+
+    if response.status_code == 204:
+        logger.info(f"Successfully dispatched {command} to GitHub Actions")
+        return True
+    elif response.status_code == 404:
+        logger.error(f"Repository not found: {GITHUB_REPO}")
+        logger.error(f"Check if repository exists and token has access")
+    elif response.status_code == 401:
+        logger.error(f"Unauthorized: Check GitHub token permissions")
+    else:
+        logger.error(f"Failed to dispatch to GitHub: {response.status_code} - {response.text}")
+    return False
 
-        logger.info(f"Received message from {user_name} (ID: {user_id}): {text}")
 
-        # Обработка команд
-        command = None
-        
-        # Команды помощи
-        if text.startswith('/start') or text.startswith('/help'):
-            help_text = """
+def run_locally(command, chat_id, user_id, user_name, force=False):
+    """Ставит команду во встроенную очередь заданий; при переполнении — GitHub Actions, если он настроен"""
+    status = get_job_runner().submit(command, chat_id, user_name, force)
+    if status == JOB_QUEUED:
+        return
+    if status == JOB_DUPLICATE:
+        send_notice(chat_id, f"⏳ Komenda /{command} już czeka w kolejce.")
+        return
+    if os.environ.get('GITHUB_TOKEN'):
+        logger.warning(f"Job queue is full, dispatching {command} to GitHub Actions")
+        if dispatch_to_github(command, chat_id, user_id, user_name):
+            return
+    send_notice(chat_id, "⏳ Kolejka zadań jest pełna. Spróbuj ponownie za kilka minut.")
+
+
+def handle_command(command, chat_id, user_id, user_name, force=False):
+    """Выполняет команду (вызывается фоновым обработчиком update)"""
+    logger.info(f"Processing command: {command}{' (force)' if force else ''}")
+    if JOB_RUNNER_MODE == 'github':
+        dispatch_to_github(command, chat_id, user_id, user_name)
+    else:
+        run_locally(command, chat_id, user_id, user_name, force)
+
+
+HELP_TEXT = """
 🤖 **Доступные команды бота:**
 
 📊 **Отчеты:**
@@ -67,127 +132,80 @@ def telegram_webhook():
 /sync_orders - Синхронизировать заказы
 /sync_tasks - Синхронизировать задачи
 
+Добавьте `force` после команды отчета (например, `/report_kpi force`), чтобы построить отчет заново без кэша.
+
 ℹ️ /help - Показать это сообщение
 """
-            # Отправляем справку напрямую
-            TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
-            if TELEGRAM_BOT_TOKEN:
-                try:
-                    requests.post(
-                        f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
-                        json={
-                            "chat_id": chat_id,
-                            "text": help_text,
-                            "parse_mode": "Markdown"
-                        },
-                        timeout=10
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to send help message: {e}")
-            return jsonify({"status": "OK", "message": "Help sent"}), 200
-        
-        # Отчеты
-        elif text.startswith('/report_all'):
-            command = "report_all"
-        elif text.startswith('/report_activity'):
-            command = "report_activity"
-        elif text.startswith('/report_kpi'):
-            command = "report_kpi"
-        elif text.startswith('/report_bonus_previous'):
-            command = "report_bonus_previous"
-        elif text.startswith('/report_bonus'):
-            command = "report_bonus"
-        elif text.startswith('/report_income'):
-            command = "report_income"
-        elif text.startswith('/report_status'):
-            command = "report_status"
-            
-        # Синхронизация данных
-        elif text.startswith('/sync_all'):
-            command = "sync_all"
-        elif text.startswith('/sync_clients'):
-            command = "sync_clients"
-        elif text.startswith('/sync_orders'):
-            command = "sync_orders"
-        elif text.startswith('/sync_tasks'):
-            command = "sync_tasks"
-            
-        # Старые команды для обратной совместимости
-        elif text.startswith('/premia_current'):
-            command = "report_bonus"
-        elif text.startswith('/premia_previous'):
-            command = "report_bonus_previous"
-            
-        else:
-            logger.info(f"Ignoring message: {text}")
-            return jsonify({"status": "Ignored", "message": "Command not recognized. Use /help for available commands."}), 200
-        
-        logger.info(f"Processing command: {command}")
-
-        # Отправляем команду в GitHub Actions
-        headers = {
-            "Authorization": f"token {GITHUB_TOKEN}",
-            "Accept": "application/vnd.github.v3+json",
-            "User-Agent": "Planfix-KPI-Webhook/1.0"
-        }
-        payload = {
-            "event_type": GITHUB_EVENT_TYPE,
-            "client_payload": {
-                "chat_id": chat_id,
-                "command": command,
-                "user_id": user_id,
-                "user_name": user_name
-            }
-        }
 
-        github_url = f"https://api.github.com/repos/{GITHUB_REPO}/dispatches"
-        logger.info(f"Sending dispatch to GitHub: {command}")
-        logger.info(f"GitHub URL: {github_url}")
-        logger.info(f"Payload: {payload}")
+HELP_COMMAND = "help"
 
-        response = requests.post(
-            github_url,
-            json=payload,
-            headers=headers,
-            timeout=10
-        )
+# Слова после команды, отключающие кэш отчетов
+FORCE_WORDS = ('force', 'refresh')
+
+# Префикс сообщения -> команда; более длинные префиксы раньше (/report_bonus_previous до /report_bonus)
+COMMAND_PREFIXES = [
+    ('/start', HELP_COMMAND),
+    ('/help', HELP_COMMAND),
+    # Отчеты
+    ('/report_all', "report_all"),
+    ('/report_activity', "report_activity"),
+    ('/report_kpi', "report_kpi"),
+    ('/report_bonus_previous', "report_bonus_previous"),
+    ('/report_bonus', "report_bonus"),
+    ('/report_income', "report_income"),
+    ('/report_status', "report_status"),
+    # Синхронизация данных
+    ('/sync_all', "sync_all"),
+    ('/sync_clients', "sync_clients"),
+    ('/sync_orders', "sync_orders"),
+    ('/sync_tasks', "sync_tasks"),
+    # Старые команды для обратной совместимости
+    ('/premia_current', "report_bonus"),
+    ('/premia_previous', "report_bonus_previous"),
+]
+
+
+def parse_command(text: str):
+    """Команда по тексту сообщения или None, если сообщение не является командой бота"""
+    for prefix, command in COMMAND_PREFIXES:
+        if text.startswith(prefix):
+            return command
+    return None
 
-        logger.info(f"GitHub API Response Status: {response.status_code}")
-        logger.info(f"GitHub API Response Headers: {dict(response.headers)}")
-        logger.info(f"GitHub API Response Body: {response.text}")
-
-        if response.status_code == 204:
-            logger.info(f"Successfully dispatched {command} to GitHub Actions")
-            return jsonify({
-                "status": "OK", 
-                "message": f"Command {command} sent to GitHub Actions",
-                "command": command
-            }), 200
-        elif response.status_code == 404:
-            logger.error(f"Repository not found: {GITHUB_REPO}")
-            logger.error(f"Check if repository exists and token has access")
-            return jsonify({
-                "error": "Repository not found",
-                "github_response": response.text,
-                "repository": GITHUB_REPO
-            }), 500
-        elif response.status_code == 401:
-            logger.error(f"Unauthorized: Check GitHub token permissions")
-            return jsonify({
-                "error": "Unauthorized - check GitHub token",
-                "github_response": response.text
-            }), 500
+
+@app.route('/api/telegram_webhook', methods=['POST', 'GET'])
+def telegram_webhook():
+    if request.method == 'GET':
+        return 'ok', 200
+
+    try:
+        data = request.get_json(force=True, silent=True) or {}
+        update_id = data.get('update_id')
+        message = data.get('message') or {}
+        text = message.get('text') or ''
+        chat_id = message.get('chat', {}).get('id')
+        user_id = message.get('from', {}).get('id')
+        user_name = message.get('from', {}).get('first_name', 'Unknown')
+
+        logger.info(f"Received update {update_id} from {user_name} (ID: {user_id}): {text}")
+
+        command = parse_command(text)
+        if command is None or chat_id is None:
+            logger.info(f"Ignoring message: {text}")
+            return jsonify({"status": "Ignored", "message": "Command not recognized. Use /help for available commands."}), 200
+
+        # Обработка идет в фоне, Telegram сразу получает ответ
+        if command == HELP_COMMAND:
+            status = get_update_queue().enqueue(update_id, send_message, chat_id, HELP_TEXT)
         else:
-            logger.error(f"Failed to dispatch to GitHub: {response.status_code} - {response.text}")
-            return jsonify({
-                "error": "Failed to dispatch command",
-                "github_response": response.text,
-                "status_code": response.status_code
-            }), 500
+            force = any(word.lower() in FORCE_WORDS for word in text.split()[1:])
+            status = get_update_queue().enqueue(update_id, handle_command, command, chat_id, user_id, user_name, force)
+
+        if status == UPDATE_FULL:
+            # 503 — Telegram повторит доставку позже
+            return jsonify({"status": "Busy", "message": "Update queue is full", "command": command}), 503
+        return jsonify({"status": "OK", "update": status, "command": command}), 200
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Request error: {e}")
-        return jsonify({"error": "Network error", "details": str(e)}), 500
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
         return jsonify({"error": "Internal server error", "details": str(e)}), 500
@@ -202,7 +220,11 @@ def health_check():
         "status": "healthy",
         "service": "planfix-kpi-webhook",
         "github_repo": github_repo,
-        "github_token": "set" if github_token != "not_set" else "not_set"
+        "github_token": "set" if github_token != "not_set" else "not_set",
+        "job_runner_mode": JOB_RUNNER_MODE,
+        "jobs": get_job_runner().stats(),
+        "pending_updates": get_update_queue().pending(),
+        "report_cache": get_report_cache().stats()
     }), 200
 
 @app.route('/debug', methods=['GET'])
@@ -214,6 +236,7 @@ def debug_info():
         "environment": {
             "GITHUB_REPO": os.environ.get('GITHUB_REPO', 'not_set'),
             "GITHUB_TOKEN": "set" if os.environ.get('GITHUB_TOKEN') else "not_set",
+            "JOB_RUNNER_MODE": JOB_RUNNER_MODE,
             "PORT": os.environ.get('PORT', '8080')
         },
         "endpoints": {
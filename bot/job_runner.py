@@ -0,0 +1,305 @@
+"""
+Выполнение команд бота внутри webhook-сервиса.
+
+Команда (/report_*, /sync_*) превращается в задание — список запусков скриптов
+из scripts/. Задания ставятся в ограниченную очередь и выполняются пулом
+рабочих потоков без GitHub Actions:
+- JOB_QUEUE_SIZE — максимум ожидающих заданий, при переполнении submit() возвращает JOB_FULL;
+- одинаковое ожидающее задание (та же команда для того же чата) повторно не ставится;
+- команды одной группы выполняются не больше чем GROUP_LIMITS параллельно
+  (все синхронизации пишут в одни таблицы, поэтому идут по одной).
+
+Экспортеры запускаются тем же интерпретатором, что и сервис, с TELEGRAM_CHAT_ID
+чата, из которого пришла команда, — как шаги workflow manual-bot-commands.yml.
+Отчеты строятся в процессе через кэш отчетов (bot/report_cache.py) и отправляются в чат;
+несколько отчетов одного задания (/report_all) строятся параллельно (utils.report_runner)
+и отправляются по порядку, ошибка одного отчета не останавливает остальные.
+"""
+import os
+import sys
+import logging
+import threading
+import subprocess
+from collections import deque
+from dataclasses import dataclass, field
+from bot.report_cache import get_report_cache, SCRIPTS_DIR
+
+# Общий клиент Telegram из scripts/utils (пул соединений, ограничение частоты, деление длинных сообщений)
+if SCRIPTS_DIR not in sys.path:
+    sys.path.insert(0, SCRIPTS_DIR)
+from utils.telegram_client import get_telegram_client
+from utils.report_runner import run_reports, format_timings
+
+logger = logging.getLogger(__name__)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', '20'))
+# Ограничение на один запуск скрипта, секунд
+JOB_TIMEOUT = int(os.environ.get('JOB_TIMEOUT', '1800'))
+# Сколько заданий одной группы выполняется одновременно, если группа не указана в GROUP_LIMITS
+JOB_COMMAND_CONCURRENCY = int(os.environ.get('JOB_COMMAND_CONCURRENCY', '1'))
+
+JOB_QUEUED = 'queued'
+JOB_DUPLICATE = 'duplicate'
+JOB_FULL = 'full'
+
+_REPORTS = 'scripts/reports'
+_EXPORTERS = 'scripts/exporters'
+
+# Команда -> скрипты (путь от корня репозитория и аргументы), выполняются по порядку
+COMMAND_JOBS = {
+    'report_all': [
+        [f'{_REPORTS}/report_activity.py'],
+        [f'{_REPORTS}/report_kpi.py'],
+        [f'{_REPORTS}/report_bonus.py', '--period', 'current'],
+        [f'{_REPORTS}/report_income.py'],
+        [f'{_REPORTS}/report_status.py'],
+    ],
+    'report_activity': [[f'{_REPORTS}/report_activity.py']],
+    'report_kpi': [[f'{_REPORTS}/report_kpi.py']],
+    'report_bonus': [[f'{_REPORTS}/report_bonus.py', '--period', 'current']],
+    'report_bonus_previous': [[f'{_REPORTS}/report_bonus.py', '--period', 'previous']],
+    'report_income': [[f'{_REPORTS}/report_income.py']],
+    'report_status': [[f'{_REPORTS}/report_status.py']],
+    'sync_all': [
+        [f'{_EXPORTERS}/planfix_export_clients.py'],
+        [f'{_EXPORTERS}/planfix_export_orders.py'],
+        [f'{_EXPORTERS}/planfix_export_tasks.py'],
+    ],
+    'sync_clients': [[f'{_EXPORTERS}/planfix_export_clients.py']],
+    'sync_orders': [[f'{_EXPORTERS}/planfix_export_orders.py']],
+    'sync_tasks': [[f'{_EXPORTERS}/planfix_export_tasks.py']],
+}
+
+# Шаги-отчеты строятся в процессе через кэш отчетов (bot/report_cache.py), а не отдельным запуском
+REPORT_STEPS = {
+    (f'{_REPORTS}/report_activity.py',): 'activity',
+    (f'{_REPORTS}/report_kpi.py',): 'kpi',
+    (f'{_REPORTS}/report_bonus.py', '--period', 'current'): 'bonus_current',
+    (f'{_REPORTS}/report_bonus.py', '--period', 'previous'): 'bonus_previous',
+    (f'{_REPORTS}/report_income.py',): 'income',
+    (f'{_REPORTS}/report_status.py',): 'status',
+}
+
+# Группа ограничения параллельности; по умолчанию группа — сама команда
+COMMAND_GROUPS = {
+    'sync_all': 'sync',
+    'sync_clients': 'sync',
+    'sync_orders': 'sync',
+    'sync_tasks': 'sync',
+}
+
+GROUP_LIMITS = {
+    'sync': 1,
+}
+
+# Сообщения в чат до и после выполнения (как в manual-bot-commands.yml)
+COMMAND_MESSAGES = {
+    'report_all': ("📊 Generuję wszystkie raporty...", "✅ Wszystkie raporty wysłane!"),
+    'sync_all': ("🔄 Rozpoczynam synchronizację wszystkich danych z Planfix...", "✅ Synchronizacja zakończona pomyślnie!"),
+    'sync_clients': ("🔄 Synchronizacja klientów z Planfix...", "✅ Klienci zsynchronizowani!"),
+    'sync_orders': ("🔄 Synchronizacja zamówień z Planfix...", "✅ Zamówienia zsynchronizowane!"),
+    'sync_tasks': ("🔄 Synchronizacja zadań z Planfix...", "✅ Zadania zsynchronizowane!"),
+}
+
+FAILURE_MESSAGE = "❌ Błąd podczas wykonywania komendy /{command}. Spróbuj ponownie później."
+FAILED_REPORT_MESSAGE = "❌ Błąd podczas generowania raportu {name}."
+
+# Сколько последних строк вывода скрипта попадает в лог при ошибке
+_OUTPUT_TAIL_LINES = 20
+
+
+@dataclass
+class Job:
+    command: str
+    chat_id: str
+    user_name: str = 'Unknown'
+    steps: list = field(default_factory=list)
+    # Построить отчеты заново, не используя кэш
+    force: bool = False
+
+    @property
+    def key(self) -> tuple:
+        return (self.command, self.chat_id)
+
+    @property
+    def group(self) -> str:
+        return COMMAND_GROUPS.get(self.command, self.command)
+
+
+def send_message(chat_id: str, text: str, parse_mode: str = 'Markdown'):
+    """Сообщение в чат через общий клиент Telegram; ошибки отправки только логируются."""
+    if chat_id:
+        get_telegram_client().send_message(chat_id, text, parse_mode=parse_mode)
+
+
+def send_notice(chat_id: str, text: str):
+    """
+    Служебное сообщение простым текстом: имена команд (/sync_all) содержат одиночный '_',
+    и Telegram отклонил бы такое сообщение в разметке Markdown.
+    """
+    send_message(chat_id, text, parse_mode=None)
+
+
+def _output_tail(output: str) -> str:
+    return '\n'.join((output or '').strip().splitlines()[-_OUTPUT_TAIL_LINES:])
+
+
+class JobRunner:
+    """Очередь заданий и пул рабочих потоков"""
+
+    def __init__(self, workers: int = JOB_WORKERS, max_queue: int = JOB_QUEUE_SIZE, timeout: int = JOB_TIMEOUT):
+        self.workers = max(1, workers)
+        self.max_queue = max(1, max_queue)
+        self.timeout = timeout
+        self._pending = deque()
+        self._pending_keys = set()
+        self._running = {}  # группа -> число выполняемых заданий
+        self._condition = threading.Condition()
+        self._threads = []
+
+    def _start_workers(self):
+        # Потоки создаются при первой команде, а не при импорте (после fork воркера gunicorn)
+        if self._threads:
+            return
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{number + 1}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Started {self.workers} job workers (queue size {self.max_queue})")
+
+    def submit(self, command: str, chat_id, user_name: str = 'Unknown', force: bool = False) -> str:
+        """
+        Ставит команду в очередь (force — отчеты строятся заново, без кэша).
+        Возвращает JOB_QUEUED, JOB_DUPLICATE (такое задание уже ожидает) или JOB_FULL (очередь заполнена).
+        """
+        if command not in COMMAND_JOBS:
+            raise ValueError(f"Unknown command: {command}")
+        job = Job(command, str(chat_id), user_name, COMMAND_JOBS[command], force)
+        with self._condition:
+            if job.key in self._pending_keys:
+                logger.info(f"Job {command} for chat {chat_id} is already pending")
+                return JOB_DUPLICATE
+            if len(self._pending) >= self.max_queue:
+                logger.warning(f"Job queue is full ({self.max_queue}), rejecting {command}")
+                return JOB_FULL
+            self._start_workers()
+            self._pending.append(job)
+            self._pending_keys.add(job.key)
+            self._condition.notify_all()
+        logger.info(f"Queued job {command} for chat {chat_id} ({user_name})")
+        return JOB_QUEUED
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "workers": self.workers,
+                "pending": len(self._pending),
+                "running": {group: count for group, count in self._running.items() if count},
+                "max_queue": self.max_queue,
+            }
+
+    def _take_job(self) -> Job:
+        """Первое ожидающее задание, группа которого не достигла лимита (ждет, если такого нет)."""
+        with self._condition:
+            while True:
+                for job in self._pending:
+                    limit = GROUP_LIMITS.get(job.group, JOB_COMMAND_CONCURRENCY)
+                    if self._running.get(job.group, 0) < limit:
+                        self._pending.remove(job)
+                        self._pending_keys.discard(job.key)
+                        self._running[job.group] = self._running.get(job.group, 0) + 1
+                        return job
+                self._condition.wait()
+
+    def _work(self):
+        while True:
+            job = self._take_job()
+            try:
+                self._run_job(job)
+            except Exception as e:
+                logger.error(f"Job {job.command} failed: {e}")
+                send_notice(job.chat_id, FAILURE_MESSAGE.format(command=job.command))
+            finally:
+                with self._condition:
+                    self._running[job.group] -= 1
+                    self._condition.notify_all()
+
+    def _run_job(self, job: Job):
+        start_message, done_message = COMMAND_MESSAGES.get(job.command, (None, None))
+        if start_message:
+            send_message(job.chat_id, start_message)
+
+        reports = [REPORT_STEPS.get(tuple(step)) for step in job.steps]
+        if len(reports) > 1 and all(reports):
+            if not self._run_reports(job, reports):
+                send_notice(job.chat_id, FAILURE_MESSAGE.format(command=job.command))
+                return
+            if done_message:
+                send_message(job.chat_id, done_message)
+            logger.info(f"[{job.command}] Job completed for chat {job.chat_id}")
+            return
+
+        env = dict(os.environ, TELEGRAM_CHAT_ID=job.chat_id)
+        for script, *args in job.steps:
+            report = REPORT_STEPS.get((script, *args))
+            if report:
+                logger.info(f"[{job.command}] Building report {report}")
+                for message in get_report_cache().get_messages(report, force=job.force):
+                    send_message(job.chat_id, message)
+                continue
+
+            logger.info(f"[{job.command}] Running {script} {' '.join(args)}".rstrip())
+            try:
+                result = subprocess.run(
+                    [sys.executable, os.path.join(REPO_ROOT, script), *args],
+                    cwd=REPO_ROOT,
+                    env=env,
+                    capture_output=True,
+                    text=True,
+                    timeout=self.timeout,
+                )
+            except subprocess.TimeoutExpired:
+                logger.error(f"[{job.command}] {script} timed out after {self.timeout}s")
+                send_notice(job.chat_id, FAILURE_MESSAGE.format(command=job.command))
+                return
+            if result.returncode != 0:
+                # Как в workflow: после упавшего шага следующие скрипты не запускаются
+                logger.error(f"[{job.command}] {script} exited with code {result.returncode}:\n{_output_tail(result.stderr or result.stdout)}")
+                send_notice(job.chat_id, FAILURE_MESSAGE.format(command=job.command))
+                return
+
+        if done_message:
+            send_message(job.chat_id, done_message)
+        logger.info(f"[{job.command}] Job completed for chat {job.chat_id}")
+
+    def _run_reports(self, job: Job, reports: list) -> bool:
+        """Строит отчеты параллельно и отправляет их по порядку; False, если какой-то отчет не построен."""
+        cache = get_report_cache()
+        results = run_reports([
+            (report, lambda report=report: cache.get_messages(report, force=job.force)) for report in reports
+        ])
+        for result in results:
+            if not result.ok:
+                send_notice(job.chat_id, FAILED_REPORT_MESSAGE.format(name=result.name))
+                continue
+            for message in result.messages:
+                send_message(job.chat_id, message)
+        logger.info(f"[{job.command}] Reports: {format_timings(results)}")
+        return all(result.ok for result in results)
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_job_runner() -> JobRunner:
+    """Общий JobRunner процесса."""
+    global _runner
+    if _runner is None:
+        with _runner_lock:
+            if _runner is None:
+                _runner = JobRunner()
+    return _runner
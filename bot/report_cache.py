@@ -0,0 +1,145 @@
+"""
+Кэш готовых отчетов бота.
+
+Отчет строится функцией build_* из scripts/reports прямо в процессе webhook
+и запоминается по ключу (отчет, день, версия данных). Версия данных — отметки из
+sync_state и версии строк планов kpi_metrics. Кроме итогов синхронизаций, в sync_state
+отмечается каждая запись в таблицы отчетов (upsert, пометка удаленных, пересчет
+kpi_daily_facts — utils.sync_state.bump_data_version) в той же транзакции, поэтому
+частично прошедшая или упавшая синхронизация тоже сбрасывает кэш. Повторный /report_kpi
+без записей между запросами отдается из памяти без запросов к отчетным таблицам.
+
+REPORT_CACHE_TTL — сколько секунд отчет живет в кэше (0 — кэш выключен),
+REPORT_CACHE_SIZE — максимум отчетов, самые давно использованные вытесняются первыми.
+"""
+import os
+import sys
+import time
+import logging
+import importlib
+import threading
+from datetime import date
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+
+REPORT_CACHE_TTL = float(os.environ.get('REPORT_CACHE_TTL', '900'))
+REPORT_CACHE_SIZE = int(os.environ.get('REPORT_CACHE_SIZE', '32'))
+
+# Отчет -> (модуль в scripts, функция построения сообщений, аргументы)
+REPORT_BUILDERS = {
+    'activity': ('reports.report_activity', 'build_activity_messages', {}),
+    'kpi': ('reports.report_kpi', 'build_kpi_messages', {}),
+    'bonus_current': ('reports.report_bonus', 'build_premia_messages', {'period_types': ['monthly']}),
+    'bonus_previous': ('reports.report_bonus', 'build_premia_messages', {'period_types': ['previous_month']}),
+    'income': ('reports.report_income', 'build_income_messages', {}),
+    'status': ('reports.report_status', 'build_status_messages', {}),
+}
+
+DATA_VERSION_QUERY = """
+    SELECT
+        (SELECT string_agg(entity || '=' || COALESCE(last_sync_at::text, ''), ',' ORDER BY entity) FROM "{sync_state}"),
+        (SELECT string_agg(month || '.' || year || '=' || xmin::text, ',' ORDER BY year, month) FROM kpi_metrics)
+"""
+
+
+def _scripts_module(name: str):
+    if SCRIPTS_DIR not in sys.path:
+        sys.path.insert(0, SCRIPTS_DIR)
+    return importlib.import_module(name)
+
+
+def get_data_version():
+    """Версия данных отчетов или None, если ее не удалось прочитать (тогда отчет не кэшируется)."""
+    try:
+        db_pool = _scripts_module('utils.db_pool')
+        sync_state = _scripts_module('utils.sync_state')
+        rows = db_pool.execute_query(
+            DATA_VERSION_QUERY.format(sync_state=sync_state.SYNC_STATE_TABLE_NAME), (), "report data version"
+        )
+    except Exception as e:
+        logger.warning(f"Could not read report data version: {e}")
+        return None
+    syncs, plans = rows[0]
+    return f"{syncs or ''}|{plans or ''}"
+
+
+def build_report(report: str) -> list:
+    """Строит сообщения отчета без кэша."""
+    module_name, function_name, kwargs = REPORT_BUILDERS[report]
+    build = getattr(_scripts_module(module_name), function_name)
+    return build(**kwargs)
+
+
+class ReportCache:
+    """LRU-кэш сообщений отчетов с TTL, ключ — (отчет, день, версия данных)"""
+
+    def __init__(self, ttl_seconds: float = REPORT_CACHE_TTL, max_entries: int = REPORT_CACHE_SIZE):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()  # ключ -> (время построения, сообщения)
+        self._lock = threading.Lock()
+
+    def get_messages(self, report: str, force: bool = False) -> list:
+        """
+        Сообщения отчета: из кэша, если данные не менялись и TTL не истек, иначе строятся заново.
+        force — построить заново и обновить кэш.
+        """
+        if report not in REPORT_BUILDERS:
+            raise ValueError(f"Unknown report: {report}")
+        if self.ttl_seconds <= 0:
+            return build_report(report)
+
+        version = get_data_version()
+        key = (report, date.today().isoformat(), version)
+        if version is not None and not force:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and time.time() - entry[0] < self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    logger.info(f"Report {report} served from cache")
+                    return list(entry[1])
+
+        messages = build_report(report)
+        if version is not None:
+            self._store(key, messages)
+        return messages
+
+    def _store(self, key: tuple, messages: list):
+        now = time.time()
+        with self._lock:
+            # Отчет за прошлый день или по старой версии данных больше не понадобится
+            for old_key in [k for k in self._entries if k[0] == key[0] and k != key]:
+                del self._entries[old_key]
+            for old_key in [k for k, (created_at, _) in self._entries.items() if now - created_at >= self.ttl_seconds]:
+                del self._entries[old_key]
+            self._entries[key] = (now, list(messages))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, report: str = None):
+        """Сбрасывает кэш отчета (или весь кэш, если отчет не указан)."""
+        with self._lock:
+            for key in [k for k in self._entries if report is None or k[0] == report]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"reports": len(self._entries), "max_entries": self.max_entries, "ttl_seconds": self.ttl_seconds}
+
+
+_report_cache = None
+_report_cache_lock = threading.Lock()
+
+
+def get_report_cache() -> ReportCache:
+    """Общий кэш отчетов процесса."""
+    global _report_cache
+    if _report_cache is None:
+        with _report_cache_lock:
+            if _report_cache is None:
+                _report_cache = ReportCache()
+    return _report_cache
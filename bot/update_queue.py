@@ -0,0 +1,94 @@
+"""
+Фоновая обработка update от Telegram.
+
+Webhook только проверяет update, ставит его в очередь и сразу отвечает 200 —
+медленный вызов GitHub или Telegram API больше не задерживает остальные update
+(gunicorn работает с одним воркером), а Telegram не повторяет доставку из-за таймаута.
+Update обрабатываются по порядку одним фоновым потоком.
+
+Telegram может доставить один update повторно, поэтому последние UPDATE_DEDUP_SIZE
+значений update_id запоминаются, и повторная доставка отбрасывается (повторный /sync_*
+не запускает вторую синхронизацию).
+"""
+import os
+import queue
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', '100'))
+UPDATE_DEDUP_SIZE = int(os.environ.get('UPDATE_DEDUP_SIZE', '1000'))
+
+UPDATE_ACCEPTED = 'accepted'
+UPDATE_DUPLICATE = 'duplicate'
+UPDATE_FULL = 'full'
+
+
+class UpdateQueue:
+    """Очередь update с фоновым обработчиком и отбрасыванием повторных update_id"""
+
+    def __init__(self, max_size: int = UPDATE_QUEUE_SIZE, dedup_size: int = UPDATE_DEDUP_SIZE):
+        self.dedup_size = max(1, dedup_size)
+        self._queue = queue.Queue(maxsize=max(1, max_size))
+        self._seen = OrderedDict()  # update_id -> None, в порядке последнего появления
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _start_consumer(self):
+        # Поток создается при первом update, а не при импорте (после fork воркера gunicorn)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._consume, name="telegram-updates", daemon=True)
+            self._thread.start()
+            logger.info("Started Telegram update consumer")
+
+    def enqueue(self, update_id, handler, *args) -> str:
+        """
+        Ставит handler(*args) в очередь для update update_id.
+        Возвращает UPDATE_ACCEPTED, UPDATE_DUPLICATE (update уже принят) или UPDATE_FULL.
+        """
+        with self._lock:
+            if update_id is not None and update_id in self._seen:
+                self._seen.move_to_end(update_id)
+                logger.info(f"Skipping duplicate update {update_id}")
+                return UPDATE_DUPLICATE
+            self._start_consumer()
+            try:
+                self._queue.put_nowait((update_id, handler, args))
+            except queue.Full:
+                # update_id не запоминается: Telegram доставит update повторно
+                logger.warning(f"Update queue is full, rejecting update {update_id}")
+                return UPDATE_FULL
+            if update_id is not None:
+                self._seen[update_id] = None
+                if len(self._seen) > self.dedup_size:
+                    self._seen.popitem(last=False)
+        return UPDATE_ACCEPTED
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def _consume(self):
+        while True:
+            update_id, handler, args = self._queue.get()
+            try:
+                handler(*args)
+            except Exception as e:
+                logger.error(f"Failed to process update {update_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+
+_update_queue = None
+_update_queue_lock = threading.Lock()
+
+
+def get_update_queue() -> UpdateQueue:
+    """Общая очередь update процесса."""
+    global _update_queue
+    if _update_queue is None:
+        with _update_queue_lock:
+            if _update_queue is None:
+                _update_queue = UpdateQueue()
+    return _update_queue
@@ -0,0 +1,189 @@
+"""
+Календарь рабочих дней с предрассчитанным накопительным индексом.
+
+Для каждого дня диапазона хранится число рабочих дней до него, поэтому количество
+рабочих дней между датами и «N рабочих дней назад» — поиск в массиве за O(1),
+а count_workdays_bulk считает то же для массивов дат одной операцией numpy.
+Если дата выходит за диапазон, индекс перестраивается с запасом.
+
+Выходные — суббота и воскресенье. Праздники подключаются через HOLIDAY_CALENDARS:
+WORKDAY_HOLIDAYS=PL добавляет государственные праздники Польши (по умолчанию не заданы).
+"""
+import os
+import logging
+import threading
+from datetime import date, timedelta
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Код календаря праздников из HOLIDAY_CALENDARS; пусто — только выходные
+WORKDAY_HOLIDAYS = os.environ.get('WORKDAY_HOLIDAYS', '').strip().upper()
+
+# Индекс строится с начала этого года и минимум на год вперед
+CALENDAR_FIRST_YEAR = 2015
+
+
+def easter_sunday(year: int) -> date:
+    """Дата Пасхи (григорианский календарь, алгоритм Мипса/Гаусса)."""
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+def polish_holidays(year: int) -> set:
+    """Государственные праздники Польши (dni wolne od pracy) за год."""
+    easter = easter_sunday(year)
+    holidays = {
+        date(year, 1, 1),                 # Nowy Rok
+        date(year, 1, 6),                 # Trzech Króli
+        easter,                           # Wielkanoc
+        easter + timedelta(days=1),       # Poniedziałek Wielkanocny
+        date(year, 5, 1),                 # Święto Pracy
+        date(year, 5, 3),                 # Święto Konstytucji 3 Maja
+        easter + timedelta(days=49),      # Zielone Świątki
+        easter + timedelta(days=60),      # Boże Ciało
+        date(year, 8, 15),                # Wniebowzięcie NMP
+        date(year, 11, 1),                # Wszystkich Świętych
+        date(year, 11, 11),               # Święto Niepodległości
+        date(year, 12, 25),               # Boże Narodzenie
+        date(year, 12, 26),               # Drugi dzień Bożego Narodzenia
+    }
+    if year >= 2025:
+        holidays.add(date(year, 12, 24))  # Wigilia
+    return holidays
+
+
+# Код календаря -> функция year -> множество праздничных дат
+HOLIDAY_CALENDARS = {
+    'PL': polish_holidays,
+}
+
+
+class BusinessCalendar:
+    """Рабочие дни (пн-пт без праздников) с накопительным индексом"""
+
+    def __init__(self, holiday_provider=None, first_year: int = CALENDAR_FIRST_YEAR, last_year: int = None):
+        """
+        holiday_provider: функция year -> множество праздничных дат (например, polish_holidays);
+        None — праздники не учитываются.
+        """
+        self._holiday_provider = holiday_provider
+        self._lock = threading.Lock()
+        self._index = None
+        self._build(first_year, last_year or date.today().year + 1)
+
+    def _build(self, first_year: int, last_year: int):
+        origin = date(first_year, 1, 1)
+        end = date(last_year, 12, 31)
+        days = np.arange(np.datetime64(origin, 'D'), np.datetime64(end, 'D') + 1)
+        holidays = []
+        if self._holiday_provider:
+            for year in range(first_year, last_year + 1):
+                holidays.extend(self._holiday_provider(year))
+        is_workday = np.is_busday(days, holidays=np.array(sorted(holidays), dtype='datetime64[D]'))
+        # cumulative[i] — число рабочих дней строго до origin + i
+        cumulative = np.concatenate(([0], np.cumsum(is_workday, dtype=np.int64)))
+        # Индекс заменяется целиком, чтобы параллельные читатели не видели его наполовину
+        self._index = (origin, end, cumulative, days[is_workday])
+
+    def _ensure_range(self, first: date, last: date):
+        origin, end = self._index[0], self._index[1]
+        if origin <= first and last <= end:
+            return
+        with self._lock:
+            origin, end = self._index[0], self._index[1]
+            if origin <= first and last <= end:
+                return
+            self._build(min(origin.year, first.year), max(end.year, last.year + 1))
+
+    def is_workday(self, day: date) -> bool:
+        self._ensure_range(day, day)
+        origin, _, cumulative, _ = self._index
+        position = (day - origin).days
+        return bool(cumulative[position + 1] - cumulative[position])
+
+    def count_workdays(self, start_date: date, end_date: date) -> int:
+        """
+        Количество рабочих дней между датами включительно
+        (0, если start_date позже end_date).
+        """
+        if start_date > end_date:
+            return 0
+        self._ensure_range(start_date, end_date)
+        origin, _, cumulative, _ = self._index
+        return int(cumulative[(end_date - origin).days + 1] - cumulative[(start_date - origin).days])
+
+    def workdays_ago(self, n: int, day: date) -> date:
+        """Дата, отстоящая от day на n рабочих дней назад (n >= 1; day в подсчет не входит)."""
+        if n < 1:
+            raise ValueError(f"n must be >= 1, got {n}")
+        self._ensure_range(day, day)
+        while True:
+            origin, _, cumulative, workday_dates = self._index
+            position = int(cumulative[(day - origin).days]) - n
+            if position >= 0:
+                return workday_dates[position].item()
+            # Нужная дата раньше начала индекса — расширяем его назад
+            self._ensure_range(date(origin.year - 1, 1, 1), day)
+
+    def count_workdays_bulk(self, start_dates, end_dates) -> np.ndarray:
+        """
+        Векторный count_workdays для массивов дат (datetime64[D], date или None/NaT).
+        Для пар с отсутствующей датой и для start > end возвращается 0.
+        """
+        starts = np.asarray(start_dates, dtype='datetime64[D]')
+        ends = np.asarray(end_dates, dtype='datetime64[D]')
+        starts, ends = np.broadcast_arrays(starts, ends)
+        valid = ~np.isnat(starts) & ~np.isnat(ends) & (starts <= ends)
+        if not valid.any():
+            return np.zeros(starts.shape, dtype=np.int64)
+
+        self._ensure_range(starts[valid].min().item(), ends[valid].max().item())
+        origin, _, cumulative, _ = self._index
+        origin64 = np.datetime64(origin, 'D')
+        start_pos = np.where(valid, (starts - origin64).astype(np.int64), 0)
+        end_pos = np.where(valid, (ends - origin64).astype(np.int64) + 1, 0)
+        return np.where(valid, cumulative[end_pos] - cumulative[start_pos], 0)
+
+
+_default_calendar = None
+_default_calendar_lock = threading.Lock()
+
+
+def get_business_calendar() -> BusinessCalendar:
+    """Общий календарь процесса с праздниками из WORKDAY_HOLIDAYS."""
+    global _default_calendar
+    if _default_calendar is None:
+        with _default_calendar_lock:
+            if _default_calendar is None:
+                if WORKDAY_HOLIDAYS and WORKDAY_HOLIDAYS not in HOLIDAY_CALENDARS:
+                    logger.warning(f"Unknown WORKDAY_HOLIDAYS={WORKDAY_HOLIDAYS!r}, holidays are not applied")
+                _default_calendar = BusinessCalendar(HOLIDAY_CALENDARS.get(WORKDAY_HOLIDAYS))
+    return _default_calendar
+
+
+def count_workdays(start_date: date, end_date: date) -> int:
+    """Количество рабочих дней между датами включительно (по общему календарю)."""
+    return get_business_calendar().count_workdays(start_date, end_date)
+
+
+def workdays_ago(n: int, day: date) -> date:
+    """Дата за n рабочих дней до day (по общему календарю)."""
+    return get_business_calendar().workdays_ago(n, day)
+
+
+def count_workdays_bulk(start_dates, end_dates) -> np.ndarray:
+    """Векторный count_workdays по общему календарю."""
+    return get_business_calendar().count_workdays_bulk(start_dates, end_dates)
@@ -0,0 +1,306 @@
+"""
+Воронка статусов клиентов менеджера (NWI → WTR → PSK → PIZ → STL/NAK, REZ, BRK, ARC).
+
+Все клиенты менеджера загружаются из planfix_clients одним запросом, для каждого
+строится хронология статусов по датам перехода, а остатки, приток и отток на любую
+пару дат считаются в памяти — без запросов на каждого клиента. Статус на дату
+определяется векторно для всех клиентов сразу (FunnelColumns, numpy).
+"""
+import logging
+from datetime import date
+import numpy as np
+from .business_calendar import count_workdays, count_workdays_bulk
+
+logger = logging.getLogger(__name__)
+
+# Статусы клиентов и их порядок в отчёте
+CLIENT_STATUSES = ['NWI', 'WTR', 'PSK', 'PIZ', 'STL', 'NAK', 'REZ', 'BRK', 'ARC']
+
+# Сопоставление для статусов, чья логика НЕ зависит от дат (кроме STL)
+STATUS_MAPPING = {
+    'Nowi': 'NWI',
+    'W trakcie': 'WTR',
+    'Perspektywiczni': 'PSK',
+    'Pierwsze zamówienie': 'PIZ',
+    'Stali klienci': 'STL',
+    'Rezygnacja': 'REZ',
+    'Brak kontaktu': 'BRK',
+    'Archiwum': 'ARC'
+}
+
+# Сопоставление статусов с их полем даты для расчета ПРИТОКА
+STATUS_INFLOW_DATE_COLS = {
+    'NWI': 'data_dodania_do_nowi',
+    'WTR': 'data_dodania_do_w_trakcie',
+    'PSK': 'data_dodania_do_perspektywiczni',
+    'PIZ': 'data_pierwszego_zamowienia',
+    'REZ': 'data_dodania_do_rezygnacja',
+    'BRK': 'data_dodania_do_brak_kontaktu',
+    'ARC': 'data_dodania_do_archiwum',
+}
+
+# Порядок статусов в воронке: при одинаковых датах побеждает статус, который идет ПОЗЖЕ
+FUNNEL_ORDER = ['NWI', 'WTR', 'PSK', 'PIZ', 'REZ', 'BRK', 'ARC']
+
+# Статусы, по самой ранней дате которых определяется первый статус нового клиента
+FIRST_STATUS_CANDIDATES = ['NWI', 'WTR', 'PSK', 'PIZ']
+
+STALI_KLIENCI = 'Stali klienci'
+# Клиент остается в STL, если с последнего заказа прошло не больше стольких рабочих дней
+STL_MAX_WORKDAYS = 30
+
+# Позиция в FUNNEL_ORDER -> индекс в CLIENT_STATUSES
+_FUNNEL_TO_STATUS_CODE = np.array([CLIENT_STATUSES.index(status) for status in FUNNEL_ORDER], dtype=np.int8)
+_STL_CODE = CLIENT_STATUSES.index('STL')
+_NAK_CODE = CLIENT_STATUSES.index('NAK')
+
+# Номер дня от 1970-01-01 для отсутствующей даты (то же значение, что NaT у datetime64)
+_NAT_DAY = np.iinfo(np.int64).min
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+CLIENTS_QUERY = f"""
+    SELECT id, status_wspolpracy, data_ostatniego_zamowienia_date,
+           {', '.join(f'{col}_date' for col in STATUS_INFLOW_DATE_COLS.values())}
+    FROM planfix_clients
+    WHERE menedzer = %s AND is_deleted = false
+"""
+
+
+def stl_or_nak(last_order_date: date | None, on_date: date) -> str:
+    """STL, если последний заказ был не позже STL_MAX_WORKDAYS рабочих дней назад, иначе NAK."""
+    if last_order_date is None:
+        return 'NAK'
+    return 'STL' if count_workdays(last_order_date, on_date) <= STL_MAX_WORKDAYS else 'NAK'
+
+
+def _day_numbers(values) -> np.ndarray:
+    """Даты -> номера дней от 1970-01-01 (int64, _NAT_DAY для None), быстрее np.array(..., 'datetime64[D]')."""
+    return np.fromiter(
+        (value.toordinal() - _EPOCH_ORDINAL if value else _NAT_DAY for value in values), dtype=np.int64
+    )
+
+
+class ClientTimeline:
+    """Данные одного клиента для воронки"""
+    __slots__ = ('id', 'status', 'last_order_date', 'status_dates')
+
+    def __init__(self, client_id: int, status: str | None, last_order_date: date | None, status_dates: dict):
+        self.id = client_id
+        self.status = status
+        self.last_order_date = last_order_date
+        self.status_dates = status_dates
+
+    def current_status(self, today: date) -> str | None:
+        """Текущий статус по полю status_wspolpracy (STL/NAK — по дате последнего заказа)."""
+        status_clean = (self.status or '').strip()
+        if not status_clean:
+            return None
+        if status_clean == STALI_KLIENCI:
+            return stl_or_nak(self.last_order_date, today)
+        return STATUS_MAPPING.get(status_clean)
+
+    def transitions_on(self, target_date: date) -> list:
+        """Все переходы клиента за день в порядке воронки"""
+        statuses = {short_status for short_status, status_date in self.status_dates.items() if status_date == target_date}
+        if self.status == STALI_KLIENCI and self.last_order_date == target_date:
+            statuses.add(stl_or_nak(self.last_order_date, target_date))
+        return [status for status in CLIENT_STATUSES if status in statuses]
+
+    def first_status(self) -> str | None:
+        """Первый статус клиента — статус с самой ранней датой среди FIRST_STATUS_CANDIDATES"""
+        earliest_status = None
+        earliest_date = None
+        for short_status in FIRST_STATUS_CANDIDATES:
+            status_date = self.status_dates.get(short_status)
+            if status_date and (earliest_date is None or status_date < earliest_date):
+                earliest_date = status_date
+                earliest_status = short_status
+        return earliest_status
+
+
+class FunnelColumns:
+    """
+    Колоночное представление клиентов для векторной классификации статуса на даты.
+
+    Каждой дате статуса ставится в соответствие балл (дата - base) * 8 + позиция в FUNNEL_ORDER,
+    поэтому статус на дату — это максимальный балл клиента, не превышающий (target - base) * 8 + 7:
+    побеждает самая поздняя дата <= target, а при равных датах — статус позже в воронке.
+    Баллы всех клиентов лежат в одном отсортированном массиве ключей, и статусы на все
+    даты находятся одним np.searchsorted. Поверх применяется STL/NAK для 'Stali klienci'.
+    """
+
+    def __init__(self, clients: list):
+        self.ids = np.array([client.id for client in clients], dtype=np.int64)
+        days = _day_numbers(
+            status_date for client in clients for status_date in map(client.status_dates.get, FUNNEL_ORDER)
+        ).reshape(len(clients), len(FUNNEL_ORDER))
+        missing = days == _NAT_DAY
+        self._base_day = int(days[~missing].min()) if (~missing).any() else 0
+
+        scores = np.where(
+            missing, -1, (days - self._base_day) * 8 + np.arange(len(FUNNEL_ORDER), dtype=np.int64)
+        )
+        scores.sort(axis=1)
+        self._max_score = int(scores.max()) if scores.size else -1
+        # Ключ = клиент * stride + балл + 1: ключи клиента идут подряд и отсортированы глобально
+        self._stride = self._max_score + 2
+        rows = np.arange(len(clients), dtype=np.int64)[:, None]
+        self._keys = (rows * self._stride + scores + 1).ravel()
+        self._scores = scores.ravel()
+
+        self._is_stali = np.array([client.status == STALI_KLIENCI for client in clients], dtype=bool)
+        self._last_order = _day_numbers(client.last_order_date for client in clients).view('datetime64[D]')
+
+    def status_codes_on(self, target_dates) -> np.ndarray:
+        """
+        Статусы всех клиентов на каждую из дат: массив (даты × клиенты) индексов
+        в CLIENT_STATUSES, -1 — у клиента нет статуса на эту дату.
+        """
+        targets = np.atleast_1d(np.asarray(target_dates, dtype='datetime64[D]'))
+        client_count = len(self.ids)
+        if not client_count:
+            return np.full((len(targets), 0), -1, dtype=np.int8)
+
+        thresholds = np.clip((targets.astype(np.int64) - self._base_day) * 8 + 7, -1, self._max_score)
+        rows = np.arange(client_count, dtype=np.int64)
+        queries = rows[None, :] * self._stride + thresholds[:, None] + 1
+        # Последний ключ клиента, не превышающий порог; если он чужой или это -1 — статуса нет
+        position = np.searchsorted(self._keys, queries, side='right') - 1
+        own = position >= rows[None, :] * len(FUNNEL_ORDER)
+        best = np.where(own, self._scores[np.maximum(position, 0)], -1)
+        codes = np.where(best >= 0, _FUNNEL_TO_STATUS_CODE[np.maximum(best, 0) % 8], -1).astype(np.int8)
+
+        # STL/NAK — только если последний заказ был ДО target_date (нет даты заказа — NAK)
+        no_order = self._is_stali & np.isnat(self._last_order)
+        codes[:, no_order] = _NAK_CODE
+        ordered = self._is_stali & ~np.isnat(self._last_order)
+        if ordered.any():
+            last_order = self._last_order[ordered]
+            in_stl = last_order[None, :] <= targets[:, None]
+            workdays = count_workdays_bulk(last_order[None, :], targets[:, None])
+            stl_codes = np.where(workdays <= STL_MAX_WORKDAYS, _STL_CODE, _NAK_CODE).astype(np.int8)
+            codes[:, ordered] = np.where(in_stl, stl_codes, codes[:, ordered])
+        return codes
+
+    def statuses_on(self, target_date: date) -> dict:
+        """{client_id: статус} на одну дату (клиенты без статуса не попадают)."""
+        codes = self.status_codes_on([target_date])[0]
+        has_status = codes >= 0
+        return {
+            int(client_id): CLIENT_STATUSES[code]
+            for client_id, code in zip(self.ids[has_status], codes[has_status])
+        }
+
+    def totals_on_dates(self, target_dates) -> dict:
+        """{дата: {статус: количество}} для набора дат за один проход."""
+        targets = np.atleast_1d(np.asarray(target_dates, dtype='datetime64[D]'))
+        codes = self.status_codes_on(targets)
+        totals = {}
+        for target, row in zip(targets, codes):
+            counts = np.bincount(row[row >= 0], minlength=len(CLIENT_STATUSES))
+            totals[target.item()] = dict(zip(CLIENT_STATUSES, (int(count) for count in counts)))
+        return totals
+
+
+class ClientFunnel:
+    """Воронка клиентов одного менеджера по одному снимку planfix_clients"""
+
+    def __init__(self, manager: str, clients: list):
+        self.manager = manager
+        self.clients = clients
+        self._columns = None
+
+    @property
+    def columns(self) -> FunnelColumns:
+        """Колоночное представление клиентов (строится при первом обращении)."""
+        if self._columns is None:
+            self._columns = FunnelColumns(self.clients)
+        return self._columns
+
+    @classmethod
+    def from_rows(cls, manager: str, rows: list) -> 'ClientFunnel':
+        """Строит воронку из строк CLIENTS_QUERY."""
+        clients = [
+            ClientTimeline(row[0], row[1], row[2], dict(zip(STATUS_INFLOW_DATE_COLS, row[3:])))
+            for row in rows
+        ]
+        return cls(manager, clients)
+
+    @classmethod
+    def load(cls, conn, manager: str) -> 'ClientFunnel':
+        """Загружает всех клиентов менеджера одним запросом."""
+        with conn.cursor() as cur:
+            cur.execute(CLIENTS_QUERY, (manager,))
+            rows = cur.fetchall()
+        logger.info(f"Loaded {len(rows)} clients into funnel for {manager}")
+        return cls.from_rows(manager, rows)
+
+    def current_totals(self, today: date) -> dict:
+        """Абсолютное количество клиентов в каждом статусе на сегодня."""
+        totals = {status: 0 for status in CLIENT_STATUSES}
+        for client in self.clients:
+            short_status = client.current_status(today)
+            if short_status in totals:
+                totals[short_status] += 1
+        return totals
+
+    def statuses_on(self, target_date: date) -> dict:
+        """{client_id: статус} на определенную дату (клиенты без статуса не попадают)."""
+        return self.columns.statuses_on(target_date)
+
+    def totals_on(self, target_date: date) -> dict:
+        """Количество клиентов в каждом статусе на определенную дату."""
+        return self.columns.totals_on_dates([target_date])[target_date]
+
+    def daily_totals(self, start_date: date, end_date: date) -> dict:
+        """{дата: {статус: количество}} за каждый день диапазона включительно."""
+        days = np.arange(np.datetime64(start_date, 'D'), np.datetime64(end_date, 'D') + 1)
+        return self.columns.totals_on_dates(days)
+
+    def flows(self, previous_date: date, report_date: date) -> tuple:
+        """
+        Дневной приток и отток по статусам за report_date относительно previous_date.
+        - Для клиентов с переходами в report_date считаются все переходы цепочки;
+        - для остальных — сравнение статуса на previous_date и report_date;
+        - новый клиент всегда дает приток в свой первый статус.
+        """
+        daily_inflow = {status: 0 for status in CLIENT_STATUSES}
+        daily_outflow = {status: 0 for status in CLIENT_STATUSES}
+
+        yesterday_statuses = self.statuses_on(previous_date)
+        today_statuses = self.statuses_on(report_date)
+
+        for client in self.clients:
+            yesterday_status = yesterday_statuses.get(client.id)
+            today_status = today_statuses.get(client.id)
+            if yesterday_status is None and today_status is None:
+                continue
+
+            transitions = client.transitions_on(report_date)
+            is_new_client = yesterday_status is None
+
+            # Если это новый клиент, ВСЕГДА добавляем его в первый статус
+            if is_new_client:
+                earliest_status = client.first_status()
+                if earliest_status and earliest_status not in transitions:
+                    daily_inflow[earliest_status] += 1
+                    # Outflow только если первый статус != текущий статус
+                    if earliest_status != today_status:
+                        daily_outflow[earliest_status] += 1
+
+            if transitions:
+                # Если есть переходы за день, считаем inflow по всей цепочке,
+                # outflow — для всех кроме последнего в цепочке
+                for i, status in enumerate(transitions):
+                    daily_inflow[status] += 1
+                    if i < len(transitions) - 1:
+                        daily_outflow[status] += 1
+            elif not is_new_client and yesterday_status != today_status and today_status:
+                daily_inflow[today_status] += 1
+
+            # OUTFLOW считаем ВСЕГДА по сравнению вчера/сегодня, если клиент НЕ в цепочке переходов
+            if yesterday_status and yesterday_status != today_status:
+                if not transitions or yesterday_status not in transitions:
+                    daily_outflow[yesterday_status] += 1
+
+        return daily_inflow, daily_outflow
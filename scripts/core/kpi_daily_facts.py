@@ -0,0 +1,305 @@
+"""
+Дневные агрегаты KPI: таблица kpi_daily_facts (день, менеджер, код KPI) -> количество и сумма.
+
+Экспортеры обновляют агрегаты своей таблицы: полная синхронизация пересчитывает их целиком,
+инкрементальная — только за дни, которых касались измененные записи (старые и новые даты).
+Отчеты за любой период суммируют строки дней, поэтому время отчета не зависит
+от объема истории в planfix_tasks, planfix_clients и planfix_orders.
+
+Менеджер хранится так, как он записан в исходной таблице: имя для задач и клиентов,
+значение menedzher (ID) для заказов.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+import psycopg2
+from utils.db_pool import execute_query
+from utils.sync_state import SYNC_STATE_TABLE_NAME, SYNC_MODE_FULL, bump_data_version, save_sync_state
+from .kpi_facts import CLIENT_KPI_DATE_COLUMNS, TASK_FACT_CODES
+from .task_types import KZI_RESULT, TASK_KPI_CODES
+
+logger = logging.getLogger(__name__)
+
+DAILY_FACTS_TABLE_NAME = "kpi_daily_facts"
+
+# Источник -> таблица, первичный ключ, колонка менеджера и показатели.
+# Показатель: (код KPI или колонка с кодом, колонка даты, условие, выражение суммы)
+DAILY_FACT_SOURCES = {
+    'tasks': {
+        'table': 'planfix_tasks',
+        'pk': 'planfix_id',
+        'manager': 'owner_name',
+        'codes': TASK_KPI_CODES + ['KZI'],
+        'facts': [
+            ('kpi_code', 'data_zakonczenia_zadania', 'kpi_code IS NOT NULL', '0'),
+            ("'KZI'", 'data_zakonczenia_zadania', "kpi_code = 'PRZ' AND wynik = %(kzi_result)s", '0'),
+        ],
+    },
+    'clients': {
+        'table': 'planfix_clients',
+        'pk': 'id',
+        'manager': 'menedzer',
+        'codes': list(CLIENT_KPI_DATE_COLUMNS),
+        'facts': [
+            (f"'{code}'", date_col, 'TRUE', '0')
+            for code, date_col in CLIENT_KPI_DATE_COLUMNS.items()
+        ],
+    },
+    'orders': {
+        'table': 'planfix_orders',
+        'pk': 'planfix_id',
+        'manager': 'menedzher',
+        'codes': ['OFW', 'ZAM', 'PRC', 'PRW'],
+        'facts': [
+            ("'OFW'", 'data_wyslania_oferty_ts', 'wartosc_netto_pln_num != 0', '0'),
+            ("'ZAM'", 'data_potwierdzenia_zamowienia_ts', 'wartosc_netto_pln_num != 0', '0'),
+            # PRC — сумма реализованных заказов, PRW — комиссия по ним; количество — число заказов
+            ("'PRC'", 'data_realizacji_ts', 'TRUE', 'COALESCE(SUM(ROUND(wartosc_netto_pln_num, 2)), 0)'),
+            ("'PRW'", 'data_realizacji_ts', 'TRUE', 'COALESCE(SUM(laczna_prowizja_pln_num), 0)'),
+        ],
+    },
+}
+
+
+def _sync_entity(source: str) -> str:
+    return f"{DAILY_FACTS_TABLE_NAME}_{source}"
+
+
+def create_daily_facts_table(conn) -> None:
+    """Создает таблицу kpi_daily_facts, если ее нет."""
+    query = f"""
+    CREATE TABLE IF NOT EXISTS "{DAILY_FACTS_TABLE_NAME}" (
+        fact_date DATE NOT NULL,
+        manager TEXT NOT NULL,
+        kpi_code TEXT NOT NULL,
+        value_count BIGINT NOT NULL DEFAULT 0,
+        value_amount NUMERIC NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP,
+        PRIMARY KEY (fact_date, manager, kpi_code)
+    );
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query)
+        conn.commit()
+    except psycopg2.Error as e:
+        logger.error(f"Error creating table '{DAILY_FACTS_TABLE_NAME}': {e}")
+        conn.rollback()
+        raise
+
+
+def _aggregate_sql(source: str, day_filter: str = None) -> str:
+    """
+    SELECT дневных агрегатов источника.
+    day_filter: None — все дни, 'days' — дни из %(days)s,
+    'range' — дни [%(first_day)s, %(end_day)s) для менеджеров %(managers)s.
+    """
+    config = DAILY_FACT_SOURCES[source]
+    manager = config['manager']
+    selects = []
+    for code_expr, date_col, condition, amount_expr in config['facts']:
+        if day_filter == 'days':
+            condition += f" AND {date_col}::date = ANY(%(days)s::date[])"
+        elif day_filter == 'range':
+            condition += (
+                f" AND {date_col} >= %(first_day)s AND {date_col} < %(end_day)s"
+                f" AND {manager} = ANY(%(managers)s)"
+            )
+        selects.append(
+            f"SELECT {date_col}::date AS fact_date, {manager} AS manager, {code_expr} AS kpi_code, "
+            f"COUNT(*) AS value_count, {amount_expr} AS value_amount "
+            f"FROM {config['table']} "
+            f"WHERE is_deleted = false AND {manager} IS NOT NULL AND {date_col} IS NOT NULL "
+            f"AND {condition} "
+            f"GROUP BY 1, 2, 3"
+        )
+    return '\nUNION ALL\n'.join(selects)
+
+
+def get_touched_days(conn, source: str, ids: list) -> set:
+    """Дни, к которым сейчас относятся записи источника с указанными первичными ключами."""
+    if not ids:
+        return set()
+    config = DAILY_FACT_SOURCES[source]
+    date_cols = sorted({date_col for _, date_col, _, _ in config['facts']})
+    query = '\nUNION\n'.join(
+        f"SELECT {date_col}::date FROM {config['table']} WHERE {config['pk']} = ANY(%(ids)s) AND {date_col} IS NOT NULL"
+        for date_col in date_cols
+    )
+    with conn.cursor() as cur:
+        cur.execute(query, {'ids': list(ids)})
+        return {row[0] for row in cur.fetchall()}
+
+
+def refresh_daily_facts(conn, source: str, days=None) -> None:
+    """
+    Пересчитывает дневные агрегаты источника ('tasks', 'clients', 'orders').
+    days=None — полный пересчет (после него агрегаты источника считаются готовыми к чтению);
+    иначе — только за указанные дни.
+    """
+    config = DAILY_FACT_SOURCES[source]
+    params = {'codes': config['codes'], 'kzi_result': KZI_RESULT}
+    delete_sql = f'DELETE FROM "{DAILY_FACTS_TABLE_NAME}" WHERE kpi_code = ANY(%(codes)s)'
+    if days is not None:
+        params['days'] = sorted(days)
+        if not params['days']:
+            return
+        delete_sql += ' AND fact_date = ANY(%(days)s::date[])'
+    insert_sql = f"""
+        INSERT INTO "{DAILY_FACTS_TABLE_NAME}" (fact_date, manager, kpi_code, value_count, value_amount, updated_at)
+        SELECT fact_date, manager, kpi_code, value_count, value_amount, NOW()
+        FROM ({_aggregate_sql(source, 'days' if days is not None else None)}) facts;
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(delete_sql, params)
+            cur.execute(insert_sql, params)
+            inserted = cur.rowcount
+            bump_data_version(cur, DAILY_FACTS_TABLE_NAME)
+        conn.commit()
+    except psycopg2.Error as e:
+        logger.error(f"Error refreshing {DAILY_FACTS_TABLE_NAME} for {source}: {e}")
+        conn.rollback()
+        raise
+    scope = 'all days' if days is None else f"{len(params['days'])} days"
+    logger.info(f"Refreshed {DAILY_FACTS_TABLE_NAME} for {source} ({scope}): {inserted} rows.")
+    if days is None:
+        save_sync_state(conn, _sync_entity(source), None, SYNC_MODE_FULL)
+
+
+def daily_facts_ready() -> bool:
+    """True, если агрегаты всех источников хотя бы раз пересчитаны полностью."""
+    entities = [_sync_entity(source) for source in DAILY_FACT_SOURCES]
+    try:
+        rows = execute_query(
+            f'SELECT COUNT(*) FROM "{SYNC_STATE_TABLE_NAME}" '
+            f'WHERE entity = ANY(%s) AND last_full_sync_at IS NOT NULL',
+            (entities,), "Daily KPI facts readiness"
+        )
+    except psycopg2.Error:
+        return False
+    return bool(rows) and rows[0][0] == len(entities)
+
+
+def period_days(start_date: str, end_date: str) -> tuple:
+    """
+    Первый и последний день периода [start_date, end_date).
+    Конец ровно в полночь не включает этот день, иначе день конца входит в период.
+    """
+    start = datetime.fromisoformat(str(start_date))
+    end = datetime.fromisoformat(str(end_date))
+    last_day = end.date()
+    if end.time() == datetime.min.time() and end > start:
+        last_day -= timedelta(days=1)
+    return start.date(), last_day
+
+
+def client_last_day(end_date: str) -> date:
+    """
+    Последний день периода для переходов клиентов (NWI, WTR, PSK): конец приводится к дате
+    и не входит в период, как в kpi_facts.CLIENT_FACTS_QUERY (< end::date).
+    """
+    return datetime.fromisoformat(str(end_date)).date() - timedelta(days=1)
+
+
+def get_daily_totals(first_day: date, last_day: date, managers, clients_last_day: date = None) -> dict:
+    """
+    {менеджер: {код KPI: (количество, сумма)}} — сумма дневных строк за дни [first_day, last_day];
+    для переходов клиентов — за дни [first_day, clients_last_day], если он указан.
+    """
+    clients_last_day = last_day if clients_last_day is None else clients_last_day
+    rows = execute_query(
+        f"""
+        SELECT manager, kpi_code, SUM(value_count)::bigint, SUM(value_amount)
+        FROM "{DAILY_FACTS_TABLE_NAME}"
+        WHERE fact_date >= %s AND manager = ANY(%s)
+            AND CASE WHEN kpi_code = ANY(%s) THEN fact_date <= %s ELSE fact_date <= %s END
+        GROUP BY manager, kpi_code;
+        """,
+        (first_day, list(managers), list(CLIENT_KPI_DATE_COLUMNS), clients_last_day, last_day), "Daily KPI facts"
+    )
+    totals = {}
+    for manager, kpi_code, count, amount in rows:
+        totals.setdefault(manager, {})[kpi_code] = (count, amount)
+    return totals
+
+
+def get_daily_rows(first_day: date, last_day: date, managers) -> list:
+    """
+    Дневные строки (день, менеджер, код KPI, количество, сумма) за дни [first_day, last_day]:
+    из kpi_daily_facts, если агрегаты готовы, иначе — группировкой по дням исходных таблиц
+    (по одному запросу на таблицу, параллельно).
+    """
+    managers = list(managers)
+    if daily_facts_ready():
+        return execute_query(
+            f"""
+            SELECT fact_date, manager, kpi_code, value_count, value_amount
+            FROM "{DAILY_FACTS_TABLE_NAME}"
+            WHERE fact_date BETWEEN %s AND %s AND manager = ANY(%s);
+            """,
+            (first_day, last_day, managers), "Daily KPI facts by day"
+        )
+    logger.info("Daily KPI facts are not ready, grouping raw tables by day")
+    params = {
+        'first_day': first_day,
+        'end_day': last_day + timedelta(days=1),
+        'managers': managers,
+        'kzi_result': KZI_RESULT,
+    }
+    with ThreadPoolExecutor(max_workers=len(DAILY_FACT_SOURCES)) as executor:
+        futures = [
+            executor.submit(execute_query, _aggregate_sql(source, 'range'), params, f"Raw daily {source} facts")
+            for source in DAILY_FACT_SOURCES
+        ]
+        return [row for future in futures for row in future.result()]
+
+
+def sum_daily_rows(rows, first_day: date, last_day: date, clients_last_day: date = None) -> dict:
+    """
+    {менеджер: {код KPI: (количество, сумма)}} по дневным строкам за дни [first_day, last_day];
+    для переходов клиентов — за дни [first_day, clients_last_day], если он указан.
+    """
+    clients_last_day = last_day if clients_last_day is None else clients_last_day
+    totals = {}
+    for fact_date, manager, kpi_code, count, amount in rows:
+        end_day = clients_last_day if kpi_code in CLIENT_KPI_DATE_COLUMNS else last_day
+        if first_day <= fact_date <= end_day:
+            codes = totals.setdefault(manager, {})
+            total_count, total_amount = codes.get(kpi_code, (0, 0))
+            codes[kpi_code] = (total_count + count, total_amount + amount)
+    return totals
+
+
+def facts_from_totals(totals: dict, managers: tuple, order_managers: tuple) -> dict:
+    """Суммы по менеджерам -> факты KPI в формате kpi_facts.collect_kpi_facts."""
+    facts = {'tasks': {}, 'clients': {}, 'orders': {}}
+    for manager, codes in totals.items():
+        if manager in managers:
+            tasks = dict.fromkeys(TASK_FACT_CODES, 0)
+            for code in TASK_KPI_CODES:
+                count = codes.get(code, (0, 0))[0]
+                if code in tasks:
+                    tasks[code] = count
+                tasks['TTL'] += count
+            facts['tasks'][manager] = tasks
+            facts['clients'][manager] = {
+                code: codes.get(code, (0, 0))[0] for code in CLIENT_KPI_DATE_COLUMNS
+            }
+        if manager in order_managers:
+            prw_orders, prw = codes.get('PRW', (0, 0))
+            facts['orders'][manager] = {
+                'OFW': codes.get('OFW', (0, 0))[0],
+                'PRW': prw,
+                'PRW_ORDERS': prw_orders,
+            }
+    return facts
+
+
+def daily_kpi_facts(start_date: str, end_date: str, managers: tuple, order_managers: tuple) -> dict:
+    """Факты KPI за период из дневных агрегатов — в формате kpi_facts.collect_kpi_facts."""
+    first_day, last_day = period_days(start_date, end_date)
+    totals = get_daily_totals(
+        first_day, last_day, set(managers) | set(order_managers), client_last_day(end_date)
+    )
+    return facts_from_totals(totals, managers, order_managers)
@@ -17,17 +17,12 @@ from utils.planfix_utils import (
     SUPABASE_PASSWORD,
     SUPABASE_PORT
 )
-import psycopg2
+from utils.db_pool import execute_query
 from .kpi_utils import math_round
+from .kpi_plans import get_kpi_plan
 
 logger = logging.getLogger(__name__)
 
-PG_HOST = os.environ.get('SUPABASE_HOST')
-PG_DB = os.environ.get('SUPABASE_DB')
-PG_USER = os.environ.get('SUPABASE_USER')
-PG_PASSWORD = os.environ.get('SUPABASE_PASSWORD')
-PG_PORT = os.environ.get('SUPABASE_PORT')
-
 # Список KPI, для которых применяется ограничение min(факт, план)
 CAPPED_KPI = [
     'NWI', 'WTR', 'PSK', 'WDM', 'PRZ', 'KZI', 'ZKL', 'SPT', 'MAT', 'TPY', 'MSP', 'NOW', 'OPI', 'WRK', 'KNT', 'TTL', 'OFW', 'ZAM'
@@ -38,50 +33,23 @@ KPI_INDICATORS = [
 ]
 
 def _execute_query(query: str, params: tuple, description: str) -> list:
-    conn = None
-    try:
-        conn = psycopg2.connect(host=PG_HOST, dbname=PG_DB, user=PG_USER, password=PG_PASSWORD, port=PG_PORT)
-        cur = conn.cursor()
-        logger.info(f"Executing query for: {description} with params: {params}")
-        cur.execute(query, params)
-        rows = cur.fetchall()
-        logger.info(f"Query for {description} returned {len(rows)} rows.")
-        return rows
-    except psycopg2.Error as e:
-        logger.error(f"Database error during query for {description}: {e}")
-        raise
-    finally:
-        if conn:
-            conn.close()
+    return execute_query(query, params, description)
 
 def get_kpi_metrics(current_month: int, current_year: int) -> dict:
-    query = """
-        SELECT 
-            month,
-            year,
-            premia_kpi,
-            nwi, wtr, psk, wdm, prz, zkl, spt, msp, knt, ofw, ttl
-        FROM kpi_metrics
-        WHERE month = %s AND year = %s
-    """
-    results = _execute_query(query, (f"{current_month:02d}", current_year), "KPI metrics")
-    if not results:
+    row = get_kpi_plan(current_month, current_year)
+    if not row:
         logger.warning(f"No KPI metrics found for {current_month}/{current_year}")
         return {}
-    row = results[0]
     metrics = {}
-    column_mapping = {
-        'NWI': 3, 'WTR': 4, 'PSK': 5, 'WDM': 6, 'PRZ': 7, 'ZKL': 8, 'SPT': 9, 'MSP': 10, 'KNT': 11, 'OFW': 12, 'TTL': 13
-    }
-    for indicator, col_index in column_mapping.items():
-        metrics[indicator] = {'plan': row[col_index], 'weight': 0}
+    for indicator in ['NWI', 'WTR', 'PSK', 'WDM', 'PRZ', 'ZKL', 'SPT', 'MSP', 'KNT', 'OFW', 'TTL']:
+        metrics[indicator] = {'plan': row[indicator.lower()], 'weight': 0}
     active_kpis = sum(1 for metric in metrics.values() if metric['plan'] is not None)
     if active_kpis > 0:
         weight = 1.0 / active_kpis
         for metric in metrics.values():
             if metric['plan'] is not None:
                 metric['weight'] = weight
-    metrics['premia'] = row[2]
+    metrics['premia'] = row['premia_kpi']
     return metrics
 
 def _parse_netto_pln(value):
@@ -95,19 +63,12 @@ def _parse_netto_pln(value):
         return 0.0
 
 def get_actual_kpi_values(start_date: str, end_date: str) -> dict:
+    # TTL — все задачи с kpi_code (справочник core.task_types)
     task_query = """
         WITH task_counts AS (
             SELECT
                 owner_name AS manager,
-                CASE 
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Nawiązać pierwszy kontakt' THEN 'WDM'
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Przeprowadzić pierwszą rozmowę telefoniczną' THEN 'PRZ'
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Zadzwonić do klienta' THEN 'ZKL'
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Przeprowadzić spotkanie' THEN 'SPT'
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Zapisać na media społecznościowe' THEN 'MSP'
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Tworzyć kontent' THEN 'KNT'
-                    ELSE NULL
-                END AS task_type,
+                kpi_code,
                 COUNT(*) AS task_count
             FROM planfix_tasks
             WHERE
@@ -115,72 +76,40 @@ def get_actual_kpi_values(start_date: str, end_date: str) -> dict:
                 AND data_zakonczenia_zadania >= %s::timestamp
                 AND data_zakonczenia_zadania < %s::timestamp
                 AND owner_name IN %s
+                AND kpi_code IS NOT NULL
                 AND is_deleted = false
-            GROUP BY owner_name, task_type
-        ),
-        ttl_counts AS (
-            SELECT
-                owner_name AS manager,
-                'TTL' AS task_type,
-                COUNT(*) AS task_count
-            FROM planfix_tasks
-            WHERE
-                data_zakonczenia_zadania IS NOT NULL
-                AND data_zakonczenia_zadania >= %s::timestamp
-                AND data_zakonczenia_zadania < %s::timestamp
-                AND owner_name IN %s
-                AND is_deleted = false
-                AND TRIM(SPLIT_PART(title, ' /', 1)) IN (
-                    'Nawiązać pierwszy kontakt',
-                    'Przeprowadzić pierwszą rozmowę telefoniczną',
-                    'Przeprowadzić spotkanie',
-                    'Wysłać materiały',
-                    'Zadzwonić do klienta',
-                    'Odpowiedzieć na pytanie techniczne',
-                    'Zapisać na media społecznościowe',
-                    'Opowiedzieć o nowościach',
-                    'Przywrócić klienta',
-                    'Zebrać opinie',
-                    'Tworzyć kontent'
-                )
-            GROUP BY owner_name
+            GROUP BY owner_name, kpi_code
         )
-        SELECT 
-            manager,
-            task_type,
-            task_count
-        FROM (
-            SELECT * FROM task_counts
-            UNION ALL
-            SELECT * FROM ttl_counts
-        ) combined_results
-        WHERE task_type IS NOT NULL;
+        SELECT manager, kpi_code AS task_type, task_count
+        FROM task_counts
+        WHERE kpi_code IN ('WDM', 'PRZ', 'ZKL', 'SPT', 'MSP', 'KNT')
+        UNION ALL
+        SELECT manager, 'TTL' AS task_type, SUM(task_count)::bigint
+        FROM task_counts
+        GROUP BY manager;
     """
     client_query = """
         WITH client_statuses AS (
             SELECT menedzer AS manager, 'NWI' as status, COUNT(*) as count
             FROM planfix_clients
-            WHERE data_dodania_do_nowi IS NOT NULL AND data_dodania_do_nowi != ''
-                AND TO_DATE(data_dodania_do_nowi, 'DD-MM-YYYY') >= %s::date
-                AND TO_DATE(data_dodania_do_nowi, 'DD-MM-YYYY') < %s::date
+            WHERE data_dodania_do_nowi_date >= %s::date
+                AND data_dodania_do_nowi_date < %s::date
                 AND menedzer IN %s
                 AND is_deleted = false
             GROUP BY menedzer
             UNION ALL
             SELECT menedzer AS manager, 'WTR' as status, COUNT(*) as count
             FROM planfix_clients
-            WHERE data_dodania_do_w_trakcie IS NOT NULL AND data_dodania_do_w_trakcie != ''
-                AND TO_DATE(data_dodania_do_w_trakcie, 'DD-MM-YYYY') >= %s::date
-                AND TO_DATE(data_dodania_do_w_trakcie, 'DD-MM-YYYY') < %s::date
+            WHERE data_dodania_do_w_trakcie_date >= %s::date
+                AND data_dodania_do_w_trakcie_date < %s::date
                 AND menedzer IN %s
                 AND is_deleted = false
             GROUP BY menedzer
             UNION ALL
             SELECT menedzer AS manager, 'PSK' as status, COUNT(*) as count
             FROM planfix_clients
-            WHERE data_dodania_do_perspektywiczni IS NOT NULL AND data_dodania_do_perspektywiczni != ''
-                AND TO_DATE(data_dodania_do_perspektywiczni, 'DD-MM-YYYY') >= %s::date
-                AND TO_DATE(data_dodania_do_perspektywiczni, 'DD-MM-YYYY') < %s::date
+            WHERE data_dodania_do_perspektywiczni_date >= %s::date
+                AND data_dodania_do_perspektywiczni_date < %s::date
                 AND menedzer IN %s
                 AND is_deleted = false
             GROUP BY menedzer
@@ -194,24 +123,16 @@ def get_actual_kpi_values(start_date: str, end_date: str) -> dict:
             COUNT(*) as count
         FROM planfix_orders
         WHERE
-            data_wyslania_oferty IS NOT NULL
-            AND data_wyslania_oferty != ''
-            AND TO_TIMESTAMP(data_wyslania_oferty, 'DD-MM-YYYY HH24:MI') >= %s::timestamp
-            AND TO_TIMESTAMP(data_wyslania_oferty, 'DD-MM-YYYY HH24:MI') < %s::timestamp
+            data_wyslania_oferty_ts >= %s::timestamp
+            AND data_wyslania_oferty_ts < %s::timestamp
             AND menedzher IN %s
             AND is_deleted = false
-            AND wartosc_netto_pln IS NOT NULL
-            AND TRIM(wartosc_netto_pln) != ''
-            AND wartosc_netto_pln != '0,00'
-            AND COALESCE(NULLIF(CAST(REPLACE(REPLACE(REGEXP_REPLACE(wartosc_netto_pln, '[^0-9,.-]', '', 'g'), ',', '.'), ' ', '') AS DECIMAL), 0), 0) != 0
+            AND wartosc_netto_pln_num != 0
         GROUP BY menedzher;
     """
     PLANFIX_USER_NAMES = tuple(m['planfix_user_name'] for m in MANAGERS_KPI)
     PLANFIX_USER_NAMES = tuple(m['planfix_user_name'] for m in MANAGERS_KPI)
-    task_results = _execute_query(task_query, (
-        start_date, end_date, PLANFIX_USER_NAMES,
-        start_date, end_date, PLANFIX_USER_NAMES
-    ), "Task counts")
+    task_results = _execute_query(task_query, (start_date, end_date, PLANFIX_USER_NAMES), "Task counts")
     client_results = _execute_query(client_query, (
         start_date, end_date, PLANFIX_USER_NAMES,
         start_date, end_date, PLANFIX_USER_NAMES,
@@ -294,11 +215,10 @@ def get_additional_premia(start_date: str, end_date: str) -> dict:
     query = """
         SELECT 
             menedzher,
-            COALESCE(SUM(CAST(REPLACE(REPLACE(laczna_prowizja_pln, ' ', ''), ',', '.') AS DECIMAL)), 0) as prw
+            COALESCE(SUM(laczna_prowizja_pln_num), 0) as prw
         FROM planfix_orders
-        WHERE data_realizacji IS NOT NULL AND data_realizacji != ''
-            AND TO_TIMESTAMP(data_realizacji, 'DD-MM-YYYY HH24:MI') >= %s::timestamp
-            AND TO_TIMESTAMP(data_realizacji, 'DD-MM-YYYY HH24:MI') < %s::timestamp
+        WHERE data_realizacji_ts >= %s::timestamp
+            AND data_realizacji_ts < %s::timestamp
             AND menedzher IN %s
             AND is_deleted = false
         GROUP BY menedzher;
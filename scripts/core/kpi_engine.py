@@ -19,18 +19,23 @@ from utils.planfix_utils import (
     SUPABASE_PASSWORD,
     SUPABASE_PORT
 )
-import psycopg2
+from utils.db_pool import execute_query
 from .kpi_utils import math_round
+from .kpi_facts import collect_kpi_facts
+from .kpi_plans import get_kpi_plans
+from .kpi_matrix import KPICoefficientMatrix
+from .kpi_daily_facts import (
+    client_last_day,
+    daily_facts_ready,
+    daily_kpi_facts,
+    facts_from_totals,
+    get_daily_rows,
+    period_days,
+    sum_daily_rows
+)
 
 logger = logging.getLogger(__name__)
 
-# Database settings
-PG_HOST = os.environ.get('SUPABASE_HOST')
-PG_DB = os.environ.get('SUPABASE_DB')
-PG_USER = os.environ.get('SUPABASE_USER')
-PG_PASSWORD = os.environ.get('SUPABASE_PASSWORD')
-PG_PORT = os.environ.get('SUPABASE_PORT')
-
 # KPI Configuration
 KPI_INDICATORS = [
     'NWI', 'WTR', 'PSK', 'WDM', 'PRZ', 'KZI', 'ZKL', 'SPT', 'MAT', 
@@ -43,6 +48,12 @@ CAPPED_KPI = [
     'TPY', 'MSP', 'NOW', 'OPI', 'WRK', 'KNT', 'TTL', 'OFW', 'ZAM'
 ]
 
+# KPI, для которых в kpi_metrics есть план (колонка с тем же именем в нижнем регистре)
+PLAN_INDICATORS = ['NWI', 'WTR', 'PSK', 'WDM', 'PRZ', 'ZKL', 'SPT', 'MSP', 'KNT', 'OFW', 'TTL']
+
+# ID менеджеров в таблице заказов (поле menedzher) -> имя менеджера, для PRW
+ORDER_MANAGER_IDS = {str(m['planfix_user_id']): m['planfix_user_name'] for m in MANAGERS_KPI}
+
 # Периоды для расчетов
 PERIOD_TYPES = {
     'daily': 'day',
@@ -134,50 +145,27 @@ class KPIEngine:
         self.manager_ids = [m['planfix_user_id'] for m in MANAGERS_KPI]
     
     def _execute_query(self, query: str, params: tuple, description: str) -> list:
-        """Выполняет SQL запрос"""
-        conn = None
-        try:
-            conn = psycopg2.connect(
-                host=PG_HOST, dbname=PG_DB, user=PG_USER, 
-                password=PG_PASSWORD, port=PG_PORT
-            )
-            cur = conn.cursor()
-            logger.info(f"Executing query for: {description} with params: {params}")
-            cur.execute(query, params)
-            rows = cur.fetchall()
-            logger.info(f"Query for {description} returned {len(rows)} rows.")
-            return rows
-        except psycopg2.Error as e:
-            logger.error(f"Database error during query for {description}: {e}")
-            raise
-        finally:
-            if conn:
-                conn.close()
+        """Выполняет SQL запрос на соединении из общего пула"""
+        return execute_query(query, params, description)
     
     def get_kpi_metrics(self, month: int, year: int) -> dict:
         """Получает метрики KPI для указанного месяца"""
-        query = """
-            SELECT 
-                month, year, premia_kpi,
-                nwi, wtr, psk, wdm, prz, zkl, spt, msp, knt, ofw, ttl
-            FROM kpi_metrics
-            WHERE month = %s AND year = %s
-        """
-        results = self._execute_query(query, (f"{month:02d}", year), "KPI metrics")
-        
-        if not results:
+        metrics = self.get_kpi_metrics_batch([(month, year)]).get((month, year))
+        if not metrics:
             logger.warning(f"No KPI metrics found for {month}/{year}")
             return {}
-        
-        row = results[0]
+        return metrics
+    
+    def get_kpi_metrics_batch(self, month_years) -> dict:
+        """Метрики KPI для нескольких месяцев: {(month, year): metrics} (планы берутся из кэша kpi_plans)"""
+        plans = get_kpi_plans(month_years)
+        return {key: self._metrics_from_row(row) for key, row in plans.items()}
+    
+    def _metrics_from_row(self, row: dict) -> dict:
+        """Планы и веса KPI из строки kpi_metrics"""
         metrics = {}
-        column_mapping = {
-            'NWI': 3, 'WTR': 4, 'PSK': 5, 'WDM': 6, 'PRZ': 7, 
-            'ZKL': 8, 'SPT': 9, 'MSP': 10, 'KNT': 11, 'OFW': 12, 'TTL': 13
-        }
-        
-        for indicator, col_index in column_mapping.items():
-            metrics[indicator] = {'plan': row[col_index], 'weight': 0}
+        for indicator in PLAN_INDICATORS:
+            metrics[indicator] = {'plan': row[indicator.lower()], 'weight': 0}
         
         # Рассчитываем вес на основе активных KPI (только с планом > 0)
         active_kpis = sum(1 for metric in metrics.values() if isinstance(metric, dict) and metric.get('plan') is not None and metric['plan'] > 0)
@@ -187,301 +175,114 @@ class KPIEngine:
                 if isinstance(metric, dict) and metric.get('plan') is not None and metric['plan'] > 0:
                     metric['weight'] = weight
         
-        metrics['premia'] = row[2]  # premia_kpi
+        metrics['premia'] = row['premia_kpi']
         return metrics
     
-    def get_actual_kpi_values(self, period: KPIPeriod) -> dict:
-        """Получает фактические значения KPI за период"""
-        # Запрос для задач
-        task_query = """
-            WITH task_counts AS (
-                SELECT
-                    owner_name AS manager,
-                    CASE 
-                        WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Nawiązać pierwszy kontakt' THEN 'WDM'
-                        WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Przeprowadzić pierwszą rozmowę telefoniczną' THEN 'PRZ'
-                        WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Zadzwonić do klienta' THEN 'ZKL'
-                        WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Przeprowadzić spotkanie' THEN 'SPT'
-                        WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Zapisać na media społecznościowe' THEN 'MSP'
-                        WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Tworzyć kontent' THEN 'KNT'
-                        ELSE NULL
-                    END AS task_type,
-                    COUNT(*) AS task_count
-                FROM planfix_tasks
-                WHERE
-                    data_zakonczenia_zadania IS NOT NULL
-                    AND data_zakonczenia_zadania >= %s::timestamp
-                    AND data_zakonczenia_zadania < %s::timestamp
-                    AND owner_name IN %s
-                    AND is_deleted = false
-                GROUP BY owner_name, task_type
-            ),
-            ttl_counts AS (
-                SELECT
-                    owner_name AS manager,
-                    'TTL' AS task_type,
-                    COUNT(*) AS task_count
-                FROM planfix_tasks
-                WHERE
-                    data_zakonczenia_zadania IS NOT NULL
-                    AND data_zakonczenia_zadania >= %s::timestamp
-                    AND data_zakonczenia_zadania < %s::timestamp
-                    AND owner_name IN %s
-                    AND is_deleted = false
-                    AND TRIM(SPLIT_PART(title, ' /', 1)) IN (
-                        'Nawiązać pierwszy kontakt',
-                        'Przeprowadzić pierwszą rozmowę telefoniczną',
-                        'Przeprowadzić spotkanie',
-                        'Wysłać materiały',
-                        'Zadzwonić do klienta',
-                        'Odpowiedzieć na pytanie techniczne',
-                        'Zapisać na media społecznościowe',
-                        'Opowiedzieć o nowościach',
-                        'Przywrócić klienta',
-                        'Zebrać opinie',
-                        'Tworzyć kontent'
-                    )
-                GROUP BY owner_name
-            )
-            SELECT 
-                manager,
-                task_type,
-                task_count
-            FROM (
-                SELECT * FROM task_counts
-                UNION ALL
-                SELECT * FROM ttl_counts
-            ) combined_results
-            WHERE task_type IS NOT NULL;
+    def collect_facts(self, period: KPIPeriod) -> dict:
         """
-        
-        # Запрос для клиентов
-        client_query = """
-            WITH client_statuses AS (
-                SELECT menedzer AS manager, 'NWI' as status, COUNT(*) as count
-                FROM planfix_clients
-                WHERE data_dodania_do_nowi IS NOT NULL AND data_dodania_do_nowi != ''
-                    AND TO_DATE(data_dodania_do_nowi, 'DD-MM-YYYY') >= %s::date
-                    AND TO_DATE(data_dodania_do_nowi, 'DD-MM-YYYY') < %s::date
-                    AND menedzer IN %s
-                    AND is_deleted = false
-                GROUP BY menedzer
-                UNION ALL
-                SELECT menedzer AS manager, 'WTR' as status, COUNT(*) as count
-                FROM planfix_clients
-                WHERE data_dodania_do_w_trakcie IS NOT NULL AND data_dodania_do_w_trakcie != ''
-                    AND TO_DATE(data_dodania_do_w_trakcie, 'DD-MM-YYYY') >= %s::date
-                    AND TO_DATE(data_dodania_do_w_trakcie, 'DD-MM-YYYY') < %s::date
-                    AND menedzer IN %s
-                    AND is_deleted = false
-                GROUP BY menedzer
-                UNION ALL
-                SELECT menedzer AS manager, 'PSK' as status, COUNT(*) as count
-                FROM planfix_clients
-                WHERE data_dodania_do_perspektywiczni IS NOT NULL AND data_dodania_do_perspektywiczni != ''
-                    AND TO_DATE(data_dodania_do_perspektywiczni, 'DD-MM-YYYY') >= %s::date
-                    AND TO_DATE(data_dodania_do_perspektywiczni, 'DD-MM-YYYY') < %s::date
-                    AND menedzer IN %s
-                    AND is_deleted = false
-                GROUP BY menedzer
-            )
-            SELECT manager, status, count FROM client_statuses;
+        Собирает факты KPI за период: из дневных агрегатов kpi_daily_facts, если они готовы,
+        иначе по исходным таблицам (один запрос на таблицу, запросы выполняются параллельно)
         """
-        
-        # Запрос для предложений
-        offer_query = """
-            SELECT
-                menedzher AS manager,
-                'OFW' as metric,
-                COUNT(*) as count
-            FROM planfix_orders
-            WHERE
-                data_wyslania_oferty IS NOT NULL
-                AND data_wyslania_oferty != ''
-                AND TO_TIMESTAMP(data_wyslania_oferty, 'DD-MM-YYYY HH24:MI') >= %s::timestamp
-                AND TO_TIMESTAMP(data_wyslania_oferty, 'DD-MM-YYYY HH24:MI') < %s::timestamp
-                AND menedzher IN %s
-                AND is_deleted = false
-                AND wartosc_netto_pln IS NOT NULL
-                AND TRIM(wartosc_netto_pln) != ''
-                AND wartosc_netto_pln != '0,00'
-                AND COALESCE(NULLIF(CAST(REPLACE(REPLACE(REGEXP_REPLACE(wartosc_netto_pln, '[^0-9,.-]', '', 'g'), ',', '.'), ' ', '') AS DECIMAL), 0), 0) != 0
-            GROUP BY menedzher;
-        """
-        
-        # Выполняем запросы
-        task_results = self._execute_query(task_query, (
-            period.start_date, period.end_date, tuple(self.managers),
-            period.start_date, period.end_date, tuple(self.managers)
-        ), "Task counts")
-        
-        client_results = self._execute_query(client_query, (
-            period.start_date, period.end_date, tuple(self.managers),
-            period.start_date, period.end_date, tuple(self.managers),
-            period.start_date, period.end_date, tuple(self.managers)
-        ), "Client status counts")
-        
-        offer_results = self._execute_query(offer_query, (
-            period.start_date, period.end_date, tuple(self.managers)
-        ), "Offer counts")
-        
-        # Формируем результат
+        order_managers = tuple(self.managers) + tuple(ORDER_MANAGER_IDS)
+        if daily_facts_ready():
+            return daily_kpi_facts(period.start_date, period.end_date, tuple(self.managers), order_managers)
+        logger.info("Daily KPI facts are not ready, aggregating raw tables")
+        return collect_kpi_facts(period.start_date, period.end_date, tuple(self.managers), order_managers)
+    
+    def _actual_values_from_facts(self, facts: dict) -> dict:
+        """Фактические значения KPI по менеджерам из собранных фактов"""
         actual_values = {}
         for manager in self.managers:
             actual_values[manager] = {
                 'NWI': 0, 'WTR': 0, 'PSK': 0, 'WDM': 0, 'PRZ': 0,
                 'ZKL': 0, 'SPT': 0, 'MSP': 0, 'OFW': 0, 'TTL': 0
             }
-        
-        # Обрабатываем результаты задач
-        for row in task_results:
-            manager, task_type, count = row
-            if task_type in actual_values[manager]:
-                actual_values[manager][task_type] = count
-        
-        # Обрабатываем результаты клиентов
-        for row in client_results:
-            manager, status, count = row
-            if status in actual_values[manager]:
-                actual_values[manager][status] = count
-        
-        # Обрабатываем результаты предложений
-        for row in offer_results:
-            manager_id = row[0]
-            count = row[2]
-            manager = next((m['planfix_user_name'] for m in MANAGERS_KPI if m['planfix_user_name'] == manager_id), None)
-            if manager in actual_values:
-                actual_values[manager]['OFW'] = count
-        
+            values = actual_values[manager]
+            for source in ('tasks', 'clients'):
+                for indicator, count in facts[source].get(manager, {}).items():
+                    if indicator in values:
+                        values[indicator] = count
+            # Предложения (OFW) считаются по строкам, где menedzher совпадает с именем менеджера
+            values['OFW'] = facts['orders'].get(manager, {}).get('OFW', 0)
         return actual_values
     
-    def calculate_kpi_coefficients(self, metrics: dict, actual_values: dict) -> dict:
-        """Рассчитывает коэффициенты KPI для каждого менеджера"""
-        coefficients = {}
-        
-        # Отладочная информация
-        logger.info(f"Available metrics: {list(metrics.keys())}")
-        logger.info(f"Metrics with plans: {[k for k, v in metrics.items() if isinstance(v, dict) and v.get('plan') is not None]}")
+    def _additional_premia_from_facts(self, facts: dict) -> dict:
+        """Дополнительная премия (PRW) из собранных фактов — по ID менеджеров в таблице заказов"""
+        additional_premia = {}
+        for manager_id, manager_name in ORDER_MANAGER_IDS.items():
+            order_facts = facts['orders'].get(manager_id)
+            if order_facts and order_facts['PRW_ORDERS']:
+                additional_premia[manager_name] = {'PRW': order_facts['PRW']}
+                logger.info(f"Found PRW for {manager_name}: {order_facts['PRW']}")
         
-        for manager, values in actual_values.items():
-            logger.info(f"Processing manager: {manager}")
-            logger.info(f"Actual values for {manager}: {values}")
-            
-            manager_coefficients = {}
-            sum_coefficient = Decimal('0')
-            
-            # Рассчитываем коэффициенты для всех показателей
-            for indicator in KPI_INDICATORS:
-                if indicator in metrics and isinstance(metrics[indicator], dict) and metrics[indicator].get('plan') is not None and metrics[indicator]['plan'] > 0:
-                    actual = Decimal(str(values.get(indicator, 0)))
-                    plan = Decimal(str(metrics[indicator]['plan']))
-                    weight = Decimal(str(metrics[indicator]['weight']))
-                    
-                    logger.info(f"  {indicator}: actual={actual}, plan={plan}, weight={weight}")
-                    
-                    if plan > 0:
-                        if indicator in CAPPED_KPI:
-                            used_value = min(actual, plan)
-                        else:
-                            used_value = actual
-                        
-                        coefficient_value = float((used_value / plan) * weight)
-                        coefficient = math_round(coefficient_value, 2)
-                        logger.info(f"    used_value={used_value}, coefficient={coefficient}")
-                    else:
-                        coefficient = Decimal('0')
-                        logger.info(f"    plan=0, coefficient={coefficient}")
-                    
-                    manager_coefficients[indicator] = coefficient
-                    sum_coefficient += Decimal(str(coefficient))
-            
-            # Добавляем SUM коэффициент
-            manager_coefficients['SUM'] = Decimal(str(math_round(sum_coefficient, 2)))
-            logger.info(f"  SUM coefficient: {sum_coefficient}")
-            
-            # Рассчитываем PRK
-            if 'premia' in metrics and metrics['premia'] is not None:
-                premia = Decimal(str(metrics['premia']))
-                manager_coefficients['PRK'] = Decimal(str(math_round(premia * sum_coefficient, 2)))
-                logger.info(f"  PRK: {premia} * {sum_coefficient} = {manager_coefficients['PRK']}")
-            else:
-                manager_coefficients['PRK'] = Decimal('0')
-            
-            coefficients[manager] = manager_coefficients
+        logger.info(f"PRW calculation results: {additional_premia}")
+        return additional_premia
+    
+    def get_actual_kpi_values(self, period: KPIPeriod) -> dict:
+        """Получает фактические значения KPI за период"""
+        return self._actual_values_from_facts(self.collect_facts(period))
+    
+    def calculate_kpi_coefficients(self, metrics: dict, actual_values: dict) -> dict:
+        """Рассчитывает коэффициенты KPI для каждого менеджера (матрично, см. KPICoefficientMatrix)"""
+        matrix = KPICoefficientMatrix.from_metrics(metrics, KPI_INDICATORS, CAPPED_KPI)
+        logger.info(f"KPI with plans: {matrix.indicators}")
         
+        coefficients = matrix.coefficients(actual_values)
+        for manager, manager_coefficients in coefficients.items():
+            logger.info(f"Coefficients for {manager}: {manager_coefficients}")
         return coefficients
     
     def get_additional_premia(self, period: KPIPeriod) -> dict:
         """Получает дополнительную премию (PRW) за период"""
-        query = """
-            SELECT 
-                menedzher,
-                COALESCE(SUM(CAST(REPLACE(REPLACE(laczna_prowizja_pln, ' ', ''), ',', '.') AS DECIMAL)), 0) as prw
-            FROM planfix_orders
-            WHERE data_realizacji IS NOT NULL AND data_realizacji != ''
-                AND TO_TIMESTAMP(data_realizacji, 'DD-MM-YYYY HH24:MI') >= %s::timestamp
-                AND TO_TIMESTAMP(data_realizacji, 'DD-MM-YYYY HH24:MI') < %s::timestamp
-                AND menedzher IN %s
-                AND is_deleted = false
-            GROUP BY menedzher;
+        return self._additional_premia_from_facts(self.collect_facts(period))
+    
+    def collect_facts_for_periods(self, periods: List[KPIPeriod]) -> List[dict]:
         """
+        Факты KPI сразу для нескольких периодов: дневные строки за объединенный диапазон
+        читаются одним запросом на источник и раскладываются по дням каждого периода
+        """
+        managers = tuple(self.managers)
+        order_managers = managers + tuple(ORDER_MANAGER_IDS)
+        ranges = [
+            (*period_days(period.start_date, period.end_date), client_last_day(period.end_date))
+            for period in periods
+        ]
+        rows = get_daily_rows(min(first for first, _, _ in ranges), max(last for _, last, _ in ranges), order_managers)
+        return [
+            facts_from_totals(sum_daily_rows(rows, first, last, clients_last), managers, order_managers)
+            for first, last, clients_last in ranges
+        ]
+    
+    def generate_kpi_reports(self, periods: List[KPIPeriod]) -> List[dict]:
+        """
+        Генерирует KPI отчеты для нескольких периодов за один набор запросов:
+        метрики всех месяцев — одним запросом, факты — одним запросом на источник
+        """
+        if not periods:
+            return []
         
-        # Используем ID менеджеров для таблицы заказов
-        manager_ids = ('945243', '945245')  # Kozik Andrzej, Stukalo Nazarii
-        
-        results = self._execute_query(query, (
-            period.start_date, period.end_date, manager_ids
-        ), "Additional premia (PRW)")
-        
-        additional_premia = {}
-        for row in results:
-            manager_id = row[0]
-            prw = row[1]
-            
-            # Ищем менеджера по ID (хардкод для нужных менеджеров)
-            manager_name = None
-            if str(manager_id) == '945243':
-                manager_name = 'Kozik Andrzej'
-            elif str(manager_id) == '945245':
-                manager_name = 'Stukalo Nazarii'
-            
-            if manager_name:
-                additional_premia[manager_name] = {'PRW': prw}
-                logger.info(f"Found PRW for {manager_name}: {prw}")
-            else:
-                logger.warning(f"Manager not found for ID: {manager_id}")
+        # Метрики всех нужных месяцев
+        month_years = [period.get_month_year() for period in periods]
+        metrics_by_month = self.get_kpi_metrics_batch(month_years)
+        for month, year in month_years:
+            if not metrics_by_month.get((month, year)):
+                raise ValueError(f"No KPI metrics found for {month:02d}.{year}")
         
-        logger.info(f"PRW calculation results: {additional_premia}")
-        return additional_premia
+        reports = []
+        for period, (month, year), facts in zip(periods, month_years, self.collect_facts_for_periods(periods)):
+            metrics = metrics_by_month[(month, year)]
+            actual_values = self._actual_values_from_facts(facts)
+            reports.append({
+                'period': period,
+                'metrics': metrics,
+                'actual_values': actual_values,
+                'coefficients': self.calculate_kpi_coefficients(metrics, actual_values),
+                'additional_premia': self._additional_premia_from_facts(facts),
+                'month': month,
+                'year': year
+            })
+        return reports
     
     def generate_kpi_report(self, period_type: str, start_date: str = None, end_date: str = None) -> dict:
         """Генерирует полный KPI отчет для указанного периода"""
-        # Создаем период
-        period = KPIPeriod(period_type, start_date, end_date)
-        
-        # Получаем месяц и год для метрик
-        month, year = period.get_month_year()
-        
-        # Получаем метрики
-        metrics = self.get_kpi_metrics(month, year)
-        if not metrics:
-            raise ValueError(f"No KPI metrics found for {month:02d}.{year}")
-        
-        # Получаем фактические значения
-        actual_values = self.get_actual_kpi_values(period)
-        
-        # Рассчитываем коэффициенты
-        coefficients = self.calculate_kpi_coefficients(metrics, actual_values)
-        
-        # Получаем дополнительную премию
-        additional_premia = self.get_additional_premia(period)
-        
-        return {
-            'period': period,
-            'metrics': metrics,
-            'actual_values': actual_values,
-            'coefficients': coefficients,
-            'additional_premia': additional_premia,
-            'month': month,
-            'year': year
-        } 
\ No newline at end of file
+        return self.generate_kpi_reports([KPIPeriod(period_type, start_date, end_date)])[0] 
\ No newline at end of file
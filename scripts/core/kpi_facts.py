@@ -0,0 +1,135 @@
+"""
+Сбор фактических значений KPI: один проход по каждой таблице.
+
+Вместо отдельного запроса (и отдельного скана) на каждый показатель все KPI таблицы
+считаются одним запросом (GROUP BY по kpi_code для задач, условные агрегаты
+COUNT(*) FILTER (WHERE ...) для клиентов и заказов),
+а запросы к planfix_tasks, planfix_clients и planfix_orders выполняются
+параллельно на соединениях из общего пула.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from utils.db_pool import execute_query
+
+logger = logging.getLogger(__name__)
+
+# Коды KPI по задачам; TTL — все задачи из справочника типов (core.task_types)
+TASK_FACT_CODES = ['WDM', 'PRZ', 'ZKL', 'SPT', 'MSP', 'KNT', 'TTL']
+
+# Код KPI -> колонка даты перехода клиента в статус
+CLIENT_KPI_DATE_COLUMNS = {
+    'NWI': 'data_dodania_do_nowi_date',
+    'WTR': 'data_dodania_do_w_trakcie_date',
+    'PSK': 'data_dodania_do_perspektywiczni_date',
+}
+
+CLIENT_KPI_CODES = list(CLIENT_KPI_DATE_COLUMNS)
+
+_SELECT_SEPARATOR = ',\n        '
+
+# kpi_code заполняется экспортером задач, строки без кода в KPI не входят
+TASK_FACTS_QUERY = """
+    SELECT owner_name AS manager, kpi_code, COUNT(*)
+    FROM planfix_tasks
+    WHERE
+        data_zakonczenia_zadania IS NOT NULL
+        AND data_zakonczenia_zadania >= %s::timestamp
+        AND data_zakonczenia_zadania < %s::timestamp
+        AND owner_name IN %s
+        AND kpi_code IS NOT NULL
+        AND is_deleted = false
+    GROUP BY owner_name, kpi_code;
+"""
+
+# Колонки переходов — даты, конец периода приводится к дате и не входит в период:
+# при конце KPIPeriod 'YYYY-MM-DD 23:59:59' последний день не учитывается (как в исходном
+# запросе kpi_engine); дневной путь повторяет это правило (kpi_daily_facts.client_last_day)
+CLIENT_FACTS_QUERY = f"""
+    SELECT
+        menedzer AS manager,
+        {_SELECT_SEPARATOR.join(
+            f"COUNT(*) FILTER (WHERE {col} >= %(start)s::date AND {col} < %(end)s::date) AS {code.lower()}"
+            for code, col in CLIENT_KPI_DATE_COLUMNS.items()
+        )}
+    FROM planfix_clients
+    WHERE
+        menedzer IN %(managers)s
+        AND is_deleted = false
+        AND ({' OR '.join(
+            f"({col} >= %(start)s::date AND {col} < %(end)s::date)" for col in CLIENT_KPI_DATE_COLUMNS.values()
+        )})
+    GROUP BY menedzer;
+"""
+
+# OFW — отправленные предложения с ненулевой суммой, PRW — комиссия по реализованным заказам
+ORDER_FACTS_QUERY = """
+    SELECT
+        menedzher AS manager,
+        COUNT(*) FILTER (
+            WHERE data_wyslania_oferty_ts >= %(start)s::timestamp
+                AND data_wyslania_oferty_ts < %(end)s::timestamp
+                AND wartosc_netto_pln_num != 0
+        ) AS ofw,
+        COALESCE(SUM(laczna_prowizja_pln_num) FILTER (
+            WHERE data_realizacji_ts >= %(start)s::timestamp
+                AND data_realizacji_ts < %(end)s::timestamp
+        ), 0) AS prw,
+        COUNT(*) FILTER (
+            WHERE data_realizacji_ts >= %(start)s::timestamp
+                AND data_realizacji_ts < %(end)s::timestamp
+        ) AS prw_orders
+    FROM planfix_orders
+    WHERE
+        menedzher IN %(managers)s
+        AND is_deleted = false
+        AND (
+            (data_wyslania_oferty_ts >= %(start)s::timestamp AND data_wyslania_oferty_ts < %(end)s::timestamp)
+            OR (data_realizacji_ts >= %(start)s::timestamp AND data_realizacji_ts < %(end)s::timestamp)
+        )
+    GROUP BY menedzher;
+"""
+
+
+def get_task_facts(start_date: str, end_date: str, managers: tuple) -> dict:
+    """{owner_name: {код KPI: количество}} для задач (WDM, PRZ, ZKL, SPT, MSP, KNT, TTL)."""
+    rows = execute_query(TASK_FACTS_QUERY, (start_date, end_date, managers), "Task KPI facts")
+    facts = {}
+    for manager, kpi_code, count in rows:
+        manager_facts = facts.setdefault(manager, dict.fromkeys(TASK_FACT_CODES, 0))
+        if kpi_code in manager_facts:
+            manager_facts[kpi_code] = count
+        manager_facts['TTL'] += count
+    return facts
+
+
+def get_client_facts(start_date: str, end_date: str, managers: tuple) -> dict:
+    """{menedzer: {код KPI: количество}} для переходов клиентов (NWI, WTR, PSK)."""
+    params = {'start': start_date, 'end': end_date, 'managers': managers}
+    rows = execute_query(CLIENT_FACTS_QUERY, params, "Client KPI facts")
+    return {row[0]: dict(zip(CLIENT_KPI_CODES, row[1:])) for row in rows}
+
+
+def get_order_facts(start_date: str, end_date: str, managers: tuple) -> dict:
+    """
+    {menedzher: {'OFW': ..., 'PRW': ..., 'PRW_ORDERS': ...}} для заказов.
+    managers — значения поля menedzher (в planfix_orders это ID или имена менеджеров).
+    """
+    params = {'start': start_date, 'end': end_date, 'managers': managers}
+    rows = execute_query(ORDER_FACTS_QUERY, params, "Order KPI facts")
+    return {str(row[0]): {'OFW': row[1], 'PRW': row[2], 'PRW_ORDERS': row[3]} for row in rows}
+
+
+def collect_kpi_facts(start_date: str, end_date: str, managers: tuple, order_managers: tuple) -> dict:
+    """
+    Параллельно собирает факты по трем таблицам:
+    {'tasks': {...}, 'clients': {...}, 'orders': {...}} (см. get_*_facts).
+    """
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        tasks = executor.submit(get_task_facts, start_date, end_date, managers)
+        clients = executor.submit(get_client_facts, start_date, end_date, managers)
+        orders = executor.submit(get_order_facts, start_date, end_date, order_managers)
+        return {
+            'tasks': tasks.result(),
+            'clients': clients.result(),
+            'orders': orders.result(),
+        }
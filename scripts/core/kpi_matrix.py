@@ -0,0 +1,155 @@
+"""
+Матричный расчет коэффициентов KPI.
+
+Планы, веса и факты хранятся массивами (менеджер × KPI), коэффициенты считаются
+сразу для всех менеджеров (и, при необходимости, для набора сценариев или периодов —
+любые ведущие измерения массива фактов). Результат совпадает с поштучным расчетом
+через math_round: коэффициенты и суммы ведутся в целых сотых (центах), а значения,
+оказавшиеся на границе округления, пересчитываются тем же Decimal-путем, что и раньше.
+"""
+import logging
+from decimal import Decimal
+import numpy as np
+from .kpi_utils import math_round
+
+logger = logging.getLogger(__name__)
+
+_CENT = Decimal('0.01')
+# Значения ближе к границе округления (x * 100 + 0.5 около целого) пересчитываются через Decimal
+_TIE_TOLERANCE = 1e-6
+
+
+def _exact_coefficient_cents(actual, plan, weight, capped: bool) -> int:
+    """Коэффициент в сотых для одной пары (факт, план) — как в поштучном расчете."""
+    actual = Decimal(str(actual))
+    plan = Decimal(str(plan))
+    weight = Decimal(str(weight))
+    used_value = min(actual, plan) if capped else actual
+    coefficient = math_round(float((used_value / plan) * weight), 2)
+    return int(Decimal(str(coefficient)) * 100)
+
+
+def _round_half_up_div(numerator: np.ndarray, denominator: int) -> np.ndarray:
+    """Целочисленное деление с округлением половины от нуля (ROUND_HALF_UP)."""
+    magnitude = (np.abs(numerator) * 2 + denominator) // (2 * denominator)
+    return np.sign(numerator) * magnitude
+
+
+def _cents_to_decimal(cents) -> Decimal:
+    return (Decimal(int(cents)) / 100).quantize(_CENT)
+
+
+class KPICoefficientMatrix:
+    """Планы и веса KPI одного месяца в виде массивов; считает коэффициенты для матриц фактов"""
+
+    def __init__(self, indicators: list, plans, weights, capped, premia=None):
+        """
+        indicators — KPI с планом > 0 (столбцы матрицы фактов), plans и weights — их планы и веса,
+        capped — маска KPI с ограничением min(факт, план), premia — фонд премии (FND) или None.
+        """
+        self.indicators = list(indicators)
+        self.plans = np.asarray(plans, dtype=np.float64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.capped = np.asarray(capped, dtype=bool)
+        # Исходные значения для точного пересчета граничных случаев
+        self._plan_values = list(plans)
+        self._weight_values = list(weights)
+        self.premia = None if premia is None else Decimal(str(premia))
+        # Фонд в целых сотых, если он задан с точностью до копеек; иначе PRK считается через Decimal
+        self._premia_cents = None
+        if self.premia is not None and self.premia == self.premia.quantize(_CENT):
+            self._premia_cents = int(self.premia * 100)
+
+    @classmethod
+    def from_metrics(cls, metrics: dict, indicators: list, capped_indicators: list) -> 'KPICoefficientMatrix':
+        """Матрица из словаря метрик KPIEngine.get_kpi_metrics (учитываются KPI с планом > 0)."""
+        active = [
+            indicator for indicator in indicators
+            if isinstance(metrics.get(indicator), dict)
+            and metrics[indicator].get('plan') is not None
+            and metrics[indicator]['plan'] > 0
+        ]
+        return cls(
+            active,
+            [metrics[indicator]['plan'] for indicator in active],
+            [metrics[indicator]['weight'] for indicator in active],
+            [indicator in capped_indicators for indicator in active],
+            metrics.get('premia'),
+        )
+
+    def actuals_matrix(self, actual_values: dict, managers: list = None) -> np.ndarray:
+        """Факты {менеджер: {KPI: значение}} -> массив (менеджер × KPI) в порядке managers."""
+        managers = list(actual_values) if managers is None else managers
+        return np.array(
+            [[float(actual_values[manager].get(indicator, 0)) for indicator in self.indicators] for manager in managers],
+            dtype=np.float64,
+        ).reshape(len(managers), len(self.indicators))
+
+    def coefficient_cents(self, actuals: np.ndarray, raw_actuals=None) -> np.ndarray:
+        """
+        Коэффициенты в целых сотых для массива фактов (..., KPI).
+        raw_actuals — исходные значения фактов той же формы (для точного пересчета граничных случаев).
+        """
+        actuals = np.asarray(actuals, dtype=np.float64)
+        used = np.where(self.capped, np.minimum(actuals, self.plans), actuals)
+        scaled = used / self.plans * self.weights * 100 + 0.5
+        cents = np.floor(scaled).astype(np.int64)
+
+        # Граничные значения: float64 может разойтись с Decimal-путем в последнем знаке
+        ties = np.abs(scaled - np.rint(scaled)) < _TIE_TOLERANCE
+        if ties.any():
+            source = actuals if raw_actuals is None else np.asarray(raw_actuals, dtype=object)
+            for position in zip(*np.nonzero(ties)):
+                column = position[-1]
+                cents[position] = _exact_coefficient_cents(
+                    source[position], self._plan_values[column], self._weight_values[column], bool(self.capped[column])
+                )
+        return cents
+
+    def evaluate(self, actuals: np.ndarray, raw_actuals=None) -> dict:
+        """
+        Векторный расчет для массива фактов (..., KPI):
+        coefficient_cents (..., KPI), sum_cents (...), prk_cents (...) и fnd (...) в целых единицах.
+        prk_cents равен None, если фонд задан точнее копеек — тогда PRK считается в coefficients().
+        """
+        cents = self.coefficient_cents(actuals, raw_actuals)
+        sum_cents = cents.sum(axis=-1)
+        if self.premia is None:
+            prk_cents = np.zeros_like(sum_cents)
+        elif self._premia_cents is not None:
+            # PRK = FND × SUM, округление до сотых половиной вверх
+            prk_cents = _round_half_up_div(self._premia_cents * sum_cents, 100)
+        else:
+            prk_cents = None
+        fnd = None
+        if prk_cents is not None:
+            # FND, как в отчете: целая часть PRK / SUM
+            safe_sum = np.where(sum_cents == 0, 1, sum_cents)
+            fnd = np.where(sum_cents == 0, 0, np.trunc(prk_cents / safe_sum).astype(np.int64))
+        return {'coefficient_cents': cents, 'sum_cents': sum_cents, 'prk_cents': prk_cents, 'fnd': fnd}
+
+    def coefficients(self, actual_values: dict) -> dict:
+        """
+        Коэффициенты в формате KPIEngine.calculate_kpi_coefficients:
+        {менеджер: {KPI: float, 'SUM': Decimal, 'PRK': Decimal}}.
+        """
+        managers = list(actual_values)
+        raw = [[actual_values[manager].get(indicator, 0) for indicator in self.indicators] for manager in managers]
+        result = self.evaluate(self.actuals_matrix(actual_values, managers), np.array(raw, dtype=object).reshape(len(managers), len(self.indicators)))
+
+        coefficients = {}
+        for row, manager in enumerate(managers):
+            manager_coefficients = {
+                indicator: int(result['coefficient_cents'][row, column]) / 100
+                for column, indicator in enumerate(self.indicators)
+            }
+            sum_cents = int(result['sum_cents'][row])
+            manager_coefficients['SUM'] = _cents_to_decimal(sum_cents)
+            if self.premia is None:
+                manager_coefficients['PRK'] = Decimal('0')
+            elif result['prk_cents'] is not None:
+                manager_coefficients['PRK'] = _cents_to_decimal(result['prk_cents'][row])
+            else:
+                manager_coefficients['PRK'] = Decimal(str(math_round(self.premia * Decimal(sum_cents) / 100, 2)))
+            coefficients[manager] = manager_coefficients
+        return coefficients
@@ -0,0 +1,168 @@
+"""
+Кэш планов KPI (строк kpi_metrics) по ключу (month, year).
+
+Планы меняются раз в месяц, поэтому строка читается из базы один раз и затем
+отдается из памяти. Через KPI_PLAN_CACHE_TTL секунд закэшированные строки
+перепроверяются легким запросом версии (системная колонка xmin меняется
+при каждом UPDATE строки) и перечитываются только если строка изменилась.
+
+KPI_PLAN_CACHE_FILE — необязательный файл, в котором кэш переживает процесс:
+отчеты пакетного запуска, идущие отдельными процессами, читают планы один раз.
+"""
+import os
+import time
+import pickle
+import logging
+import threading
+from dotenv import load_dotenv
+from utils.db_pool import get_connection
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд строка плана используется без перепроверки версии
+KPI_PLAN_CACHE_TTL = float(os.environ.get('KPI_PLAN_CACHE_TTL', '300'))
+# Файл для кэша между процессами; пусто — кэш только в памяти
+KPI_PLAN_CACHE_FILE = os.environ.get('KPI_PLAN_CACHE_FILE', '').strip()
+
+PLANS_QUERY = """
+    SELECT xmin::text AS row_version, *
+    FROM kpi_metrics
+    WHERE (month, year) IN %s
+"""
+
+VERSIONS_QUERY = """
+    SELECT month, year, xmin::text
+    FROM kpi_metrics
+    WHERE (month, year) IN %s
+"""
+
+
+def _db_keys(keys) -> tuple:
+    """(month, year) -> значения колонок kpi_metrics (месяц хранится строкой '01'..'12')."""
+    return tuple((f"{month:02d}", year) for month, year in keys)
+
+
+class KPIPlanCache:
+    """Кэш строк kpi_metrics с перепроверкой по версии строки"""
+
+    def __init__(self, ttl_seconds: float = KPI_PLAN_CACHE_TTL, cache_file: str = KPI_PLAN_CACHE_FILE):
+        self.ttl_seconds = ttl_seconds
+        self.cache_file = cache_file or None
+        self._lock = threading.Lock()
+        # (month, year) -> {'version': xmin, 'checked_at': time.time(), 'row': {колонка: значение}}
+        self._entries = self._load_file()
+
+    def _load_file(self) -> dict:
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, 'rb') as f:
+                entries = pickle.load(f)
+            logger.info(f"Loaded {len(entries)} KPI plans from {self.cache_file}")
+            return entries
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            logger.warning(f"Could not read KPI plan cache file {self.cache_file}: {e}")
+            return {}
+
+    def _save_file(self):
+        if not self.cache_file:
+            return
+        tmp_path = f"{self.cache_file}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(self._entries, f)
+            os.replace(tmp_path, self.cache_file)
+        except OSError as e:
+            logger.warning(f"Could not write KPI plan cache file {self.cache_file}: {e}")
+
+    def _fetch_rows(self, cur, keys) -> dict:
+        cur.execute(PLANS_QUERY, (_db_keys(keys),))
+        columns = [desc[0] for desc in cur.description]
+        rows = {}
+        for values in cur.fetchall():
+            row = dict(zip(columns, values))
+            rows[(int(row['month']), int(row['year']))] = row
+        return rows
+
+    def get_plans(self, month_years) -> dict:
+        """{(month, year): строка kpi_metrics в виде словаря}; месяцы без плана отсутствуют."""
+        keys = sorted({(int(month), int(year)) for month, year in month_years})
+        if not keys:
+            return {}
+        now = time.time()
+        with self._lock:
+            missing = [key for key in keys if key not in self._entries]
+            stale = {
+                key: self._entries[key]['version'] for key in keys
+                if key in self._entries and now - self._entries[key]['checked_at'] >= self.ttl_seconds
+            }
+        if missing or stale:
+            self._refresh(missing, stale, now)
+        with self._lock:
+            return {key: self._entries[key]['row'] for key in keys if key in self._entries}
+
+    def _refresh(self, missing: list, stale: dict, now: float):
+        """
+        Перечитывает отсутствующие и изменившиеся строки (stale — ключ -> известная версия).
+        Запросы идут без блокировки кэша: иначе поток, ждущий соединение из пула,
+        держал бы блокировку, нужную потокам, которые сами держат соединения.
+        """
+        with get_connection() as conn, conn.cursor() as cur:
+            changed = list(missing)
+            versions = {}
+            if stale:
+                cur.execute(VERSIONS_QUERY, (_db_keys(stale),))
+                versions = {(int(month), int(year)): version for month, year, version in cur.fetchall()}
+                changed += [key for key, version in stale.items() if key in versions and versions[key] != version]
+            rows = self._fetch_rows(cur, changed) if changed else {}
+
+        with self._lock:
+            for key in stale:
+                if key not in versions:
+                    self._entries.pop(key, None)
+                elif key in self._entries and key not in rows:
+                    self._entries[key]['checked_at'] = now
+            for key, row in rows.items():
+                self._entries[key] = {'version': row.pop('row_version'), 'checked_at': now, 'row': row}
+            if rows:
+                logger.info(f"Loaded KPI plans from database: {sorted(rows)}")
+            self._save_file()
+
+    def get_plan(self, month: int, year: int):
+        """Строка kpi_metrics за месяц или None, если плана нет."""
+        return self.get_plans([(month, year)]).get((int(month), int(year)))
+
+    def invalidate(self, month: int = None, year: int = None):
+        """Сбрасывает кэш месяца (или весь кэш, если месяц не указан)."""
+        with self._lock:
+            if month is None or year is None:
+                self._entries.clear()
+            else:
+                self._entries.pop((int(month), int(year)), None)
+            self._save_file()
+
+
+_plan_cache = None
+_plan_cache_lock = threading.Lock()
+
+
+def get_plan_cache() -> KPIPlanCache:
+    """Общий кэш планов процесса."""
+    global _plan_cache
+    if _plan_cache is None:
+        with _plan_cache_lock:
+            if _plan_cache is None:
+                _plan_cache = KPIPlanCache()
+    return _plan_cache
+
+
+def get_kpi_plans(month_years) -> dict:
+    """Строки kpi_metrics для нескольких месяцев (по общему кэшу)."""
+    return get_plan_cache().get_plans(month_years)
+
+
+def get_kpi_plan(month: int, year: int):
+    """Строка kpi_metrics за месяц (по общему кэшу) или None."""
+    return get_plan_cache().get_plan(month, year)
@@ -0,0 +1,56 @@
+"""
+Справочник типов задач: название задачи -> код KPI.
+
+Тип задачи — часть названия до ' /' (например, 'Zadzwonić do klienta / Firma X').
+Экспортер задач сохраняет код в колонку planfix_tasks.kpi_code при загрузке,
+поэтому отчеты группируют по индексированной колонке, а не разбирают title в SQL.
+"""
+from typing import Optional
+
+# Название задачи (до ' /') -> код KPI, в порядке вывода в отчетах
+TASK_TYPES = {
+    'Nawiązać pierwszy kontakt': 'WDM',
+    'Przeprowadzić pierwszą rozmowę telefoniczną': 'PRZ',
+    'Zadzwonić do klienta': 'ZKL',
+    'Przeprowadzić spotkanie': 'SPT',
+    'Wysłać materiały': 'MAT',
+    'Odpowiedzieć na pytanie techniczne': 'TPY',
+    'Zapisać na media społecznościowe': 'MSP',
+    'Opowiedzieć o nowościach': 'NOW',
+    'Zebrać opinie': 'OPI',
+    'Przywrócić klienta': 'WRK',
+    'Tworzyć kontent': 'KNT',
+}
+
+TASK_KPI_CODES = list(TASK_TYPES.values())
+
+# KZI — PRZ с результатом «клиент заинтересован»
+KZI_RESULT = 'Klient jest zainteresowany'
+
+# Порядок строк в отчете по задачам (KZI выводится сразу после PRZ)
+TASK_REPORT_ORDER = ['WDM', 'PRZ', 'KZI', 'ZKL', 'SPT', 'MAT', 'TPY', 'MSP', 'NOW', 'OPI', 'WRK', 'KNT']
+
+
+def task_title_prefix(title: Optional[str]) -> Optional[str]:
+    """Название задачи до ' /' без пробелов по краям (как TRIM(SPLIT_PART(title, ' /', 1)))."""
+    if title is None:
+        return None
+    return title.split(' /', 1)[0].strip(' ')
+
+
+def get_kpi_code(title: Optional[str]) -> Optional[str]:
+    """Код KPI задачи по ее названию; None, если задача не входит в KPI."""
+    return TASK_TYPES.get(task_title_prefix(title))
+
+
+def kpi_code_case_sql(title_column: str = 'title') -> str:
+    """
+    SQL-выражение CASE, вычисляющее код KPI из названия задачи.
+    Нужно только для заполнения kpi_code у уже загруженных задач.
+    """
+    prefix = f"TRIM(SPLIT_PART({title_column}, ' /', 1))"
+    branches = ' '.join(
+        "WHEN {} = '{}' THEN '{}'".format(prefix, title.replace("'", "''"), code)
+        for title, code in TASK_TYPES.items()
+    )
+    return f"CASE {branches} END"
@@ -1,11 +1,12 @@
 import os
 import sys
 import logging
+import argparse
+from functools import partial
 from datetime import datetime
 import json
-import xml.etree.ElementTree as ET
 import psycopg2
-import requests
+import psycopg2.extras
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -13,6 +14,8 @@ load_dotenv()
 
 # Add the parent directory to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.planfix_client import get_planfix_client, iter_pages
+from utils.planfix_parser import iter_records
 from utils.planfix_utils import (
     check_required_env_vars,
     make_planfix_request,
@@ -22,11 +25,22 @@ from utils.planfix_utils import (
     create_table_if_not_exists,
     add_missing_columns
 )
+from utils.sync_state import (
+    PLANFIX_CONTACT_UPDATED_FILTER_TYPE,
+    SYNC_MODE_FULL,
+    build_updated_since_filter,
+    choose_sync_mode,
+    create_sync_state_table,
+    max_watermark,
+    save_sync_state
+)
+from core.kpi_daily_facts import create_daily_facts_table, get_touched_days, refresh_daily_facts
 
 # --- Константы ---
 CLIENT_TEMPLATE_ID = 20
 CLIENTS_TABLE_NAME = "planfix_clients"
 CLIENTS_PK_COLUMN = "id"
+CLIENTS_SYNC_ENTITY = "clients"
 
 # Сопоставление custom field name -> column name (как в старом скрипте)
 CUSTOM_MAP = {
@@ -92,6 +106,21 @@ DATE_FIELDS = [
     "Data pierwszego zamówienia"
 ]
 
+# Типизированные (DATE) копии полей с датами: data_dodania_do_nowi -> data_dodania_do_nowi_date
+DATE_SHADOW_COLUMNS = {CUSTOM_MAP[field]: f"{CUSTOM_MAP[field]}_date" for field in DATE_FIELDS}
+
+# Даты, по которым отчёты фильтруют клиентов менеджера
+DATE_SHADOW_INDEXED_COLUMNS = [
+    "data_dodania_do_nowi",
+    "data_dodania_do_w_trakcie",
+    "data_dodania_do_perspektywiczni",
+    "data_pierwszego_zamowienia",
+    "data_dodania_do_rezygnacja",
+    "data_dodania_do_brak_kontaktu",
+    "data_dodania_do_archiwum",
+    "data_ostatniego_zamowienia"
+]
+
 BASE_COLUMNS = {
     "id": "BIGINT",
     "userid": "BIGINT",
@@ -120,11 +149,13 @@ BASE_COLUMNS = {
     "user_pic": "TEXT",
     "birthdate": "TEXT",
     "created_date": "TIMESTAMP",
+    "last_update_date": "TIMESTAMP",
     "have_planfix_access": "BOOLEAN",
     "responsible_user_id": "BIGINT",
     "responsible_user_name": "TEXT",
     "updated_at": "TIMESTAMP",
-    "is_deleted": "BOOLEAN"
+    "is_deleted": "BOOLEAN",
+    "row_hash": "TEXT"
 }
 
 logger = logging.getLogger(__name__)
@@ -140,11 +171,18 @@ def parse_date(date_str):
             continue
     return None
 
-def get_planfix_companies(page):
-    headers = {
-        'Content-Type': 'application/xml',
-        'Accept': 'application/xml'
-    }
+def parse_status_date(date_str):
+    """Возвращает date из строки вида DD-MM-YYYY[ ...] или None (как при разборе в отчётах)"""
+    if not date_str or not date_str.strip():
+        return None
+    try:
+        return datetime.strptime(date_str.strip()[:10], "%d-%m-%Y").date()
+    except ValueError:
+        return None
+
+def get_planfix_companies(page, updated_since=None):
+    updated_filter = build_updated_since_filter(PLANFIX_CONTACT_UPDATED_FILTER_TYPE, updated_since)
+    filters = f'<filters>{updated_filter}</filters>' if updated_filter else ''
     body = (
         '<?xml version="1.0" encoding="UTF-8"?>'
         '<request method="contact.getList">'
@@ -152,6 +190,7 @@ def get_planfix_companies(page):
         f'<pageCurrent>{page}</pageCurrent>'
         f'<pageSize>100</pageSize>'
         '<target>company</target>'
+        f'{filters}'
         '<fields>'
         '  <field>lastUpdateDate</field>'
         '  <field>lastCommentDate</field>'
@@ -163,83 +202,56 @@ def get_planfix_companies(page):
         '</fields>'
         '</request>'
     )
-    response = requests.post(
-        "https://api.planfix.com/xml/",
-        data=body.encode('utf-8'),
-        headers=headers,
-        auth=(os.environ.get('PLANFIX_API_KEY'), os.environ.get('PLANFIX_TOKEN'))
-    )
-    response.raise_for_status()
-    return response.text
+    return get_planfix_client().post(body)
 
 def parse_companies(xml_text):
-    root = ET.fromstring(xml_text)
     companies = []
-    contacts_root = root.find('.//contacts')
-    if contacts_root is None:
-        return []
-    for contact in contacts_root.findall('contact'):
-        template = contact.find('template/id')
-        is_company = contact.findtext('isCompany') == "1"
-        if is_company and template is not None and template.text == str(CLIENT_TEMPLATE_ID):
+    for contact in iter_records(xml_text, 'contacts', 'contact', group_tags=('phones',)):
+        template_id = contact.get('template/id')
+        is_company = contact.get('isCompany') == "1"
+        if is_company and template_id == str(CLIENT_TEMPLATE_ID):
             companies.append(contact)
     return companies
 
 def company_to_dict(contact):
-    def get_text(tag):
-        el = contact.find(tag)
-        return el.text if el is not None else None
+    get_text = contact.get
 
     # phones as JSON
     phones = []
-    phones_root = contact.find('phones')
-    if phones_root is not None:
-        for phone in phones_root.findall('phone'):
-            phone_data = {
-                "number": phone.findtext('number'),
-                "typeId": phone.findtext('typeId'),
-                "typeName": phone.findtext('typeName')
-            }
-            phones.append(phone_data)
+    for phone in contact.groups.get('phones', []):
+        phone_data = {
+            "number": phone.get('number'),
+            "typeId": phone.get('typeId'),
+            "typeName": phone.get('typeName')
+        }
+        phones.append(phone_data)
 
     # custom fields
     custom_fields = {v: None for v in CUSTOM_MAP.values()}
-    custom_data_root = contact.find('customData')
-
-    if custom_data_root is not None:
-        for cv in custom_data_root.findall('customValue'):
-            field = cv.find('field/name')
-            value = cv.find('value')
-            text = cv.find('text')
-            if field is not None and field.text in CUSTOM_MAP:
-                # Для полей-справочников сохраняем text (имя), а не value (ID)
-                if field.text in TEXT_VALUE_FIELDS:
-                    custom_fields[CUSTOM_MAP[field.text]] = text.text if text is not None else None
-                # Для полей с датами парсим и сохраняем в правильном формате
-                elif field.text in DATE_FIELDS:
-                    date_value = value.text if value is not None else None
-                    if date_value:
-                        parsed_date = parse_date(date_value)
-                        if parsed_date:
-                            # Сохраняем в формате DD-MM-YYYY для совместимости с базой данных
-                            custom_fields[CUSTOM_MAP[field.text]] = parsed_date.strftime("%d-%m-%Y")
-                        else:
-                            # Если не удалось распарсить, сохраняем как есть
-                            custom_fields[CUSTOM_MAP[field.text]] = date_value
+    for field_name, cv in contact.custom.items():
+        if field_name in CUSTOM_MAP:
+            # Для полей-справочников сохраняем text (имя), а не value (ID)
+            if field_name in TEXT_VALUE_FIELDS:
+                custom_fields[CUSTOM_MAP[field_name]] = cv.get('text')
+            # Для полей с датами парсим и сохраняем в правильном формате
+            elif field_name in DATE_FIELDS:
+                date_value = cv.get('value')
+                if date_value:
+                    parsed_date = parse_date(date_value)
+                    if parsed_date:
+                        # Сохраняем в формате DD-MM-YYYY для совместимости с базой данных
+                        custom_fields[CUSTOM_MAP[field_name]] = parsed_date.strftime("%d-%m-%Y")
                     else:
-                        custom_fields[CUSTOM_MAP[field.text]] = None
+                        # Если не удалось распарсить, сохраняем как есть
+                        custom_fields[CUSTOM_MAP[field_name]] = date_value
                 else:
-                    custom_fields[CUSTOM_MAP[field.text]] = value.text if value is not None else None
+                    custom_fields[CUSTOM_MAP[field_name]] = None
+            else:
+                custom_fields[CUSTOM_MAP[field_name]] = cv.get('value')
 
     # responsible user
-    responsible_user_id = None
-    responsible_user_name = None
-    responsible = contact.find('responsible')
-    if responsible is not None:
-        user = responsible.find('.//user')
-        if user is not None:
-            responsible_user_id = user.findtext('id')
-            responsible_user_name = user.findtext('name')
+    responsible_user_id = contact.find_first('responsible', 'user/id')
+    responsible_user_name = contact.find_first('responsible', 'user/name')
 
     # group
     group_id = get_text('group/id')
@@ -286,6 +298,7 @@ def company_to_dict(contact):
         "user_pic": get_text('userPic'),
         "birthdate": get_text('birthdate'),
         "created_date": created_date,
+        "last_update_date": parse_date(get_text('lastUpdateDate')),
         "have_planfix_access": get_text('havePlanfixAccess') == "1",
         "responsible_user_id": int(responsible_user_id) if responsible_user_id else None,
         "responsible_user_name": responsible_user_name,
@@ -293,6 +306,8 @@ def company_to_dict(contact):
         "is_deleted": False
     }
     base.update(custom_fields)
+    for col, date_col in DATE_SHADOW_COLUMNS.items():
+        base[date_col] = parse_status_date(custom_fields[col])
     return base
 
 def get_create_table_sql(table_name, pk_column, columns_map):
@@ -304,8 +319,49 @@ def get_create_table_sql(table_name, pk_column, columns_map):
             break
     return f'CREATE TABLE IF NOT EXISTS "{table_name}" ({", ".join(column_definitions)});'
 
+def ensure_date_indexes(conn):
+    """Создаёт индексы (menedzer, <дата>) по типизированным колонкам дат."""
+    with conn.cursor() as cur:
+        for col in DATE_SHADOW_INDEXED_COLUMNS:
+            date_col = DATE_SHADOW_COLUMNS[col]
+            cur.execute(
+                f'CREATE INDEX IF NOT EXISTS idx_clients_menedzer_{date_col} '
+                f'ON "{CLIENTS_TABLE_NAME}" (menedzer, {date_col});'
+            )
+    conn.commit()
+
+def backfill_date_columns(conn):
+    """
+    Одноразово заполняет колонки *_date из текстовых дат уже загруженных клиентов.
+    Даты разбираются тем же parse_status_date, что и при загрузке: некорректное значение
+    (31-02-2024) дает NULL и не прерывает заполнение остальных строк.
+    """
+    text_cols = list(DATE_SHADOW_COLUMNS)
+    date_cols = [DATE_SHADOW_COLUMNS[col] for col in text_cols]
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT {CLIENTS_PK_COLUMN}, {", ".join(text_cols)} FROM "{CLIENTS_TABLE_NAME}";')
+        rows = [(row[0], *(parse_status_date(value) for value in row[1:])) for row in cur.fetchall()]
+        if rows:
+            psycopg2.extras.execute_values(
+                cur,
+                f'UPDATE "{CLIENTS_TABLE_NAME}" AS t SET '
+                f'{", ".join(f"{date_col} = v.{date_col}" for date_col in date_cols)} '
+                f'FROM (VALUES %s) AS v ({CLIENTS_PK_COLUMN}, {", ".join(date_cols)}) '
+                f'WHERE t.{CLIENTS_PK_COLUMN} = v.{CLIENTS_PK_COLUMN};',
+                rows,
+                template=f"(%s, {', '.join(['%s::date'] * len(date_cols))})",
+                page_size=1000,
+            )
+    conn.commit()
+    logger.info(f"Backfilled date columns for {len(rows)} companies.")
+
 def main():
     """Главная функция для экспорта клиентов из Planfix в Supabase."""
+    parser = argparse.ArgumentParser(description='Экспорт клиентов из Planfix в Supabase.')
+    parser.add_argument('--full', action='store_true', help='Полная синхронизация вместо инкрементальной')
+    parser.add_argument('--backfill', action='store_true', help='Заполнить колонки *_date из текстовых дат и выйти')
+    args = parser.parse_args()
+
     logger.info("--- Starting Planfix clients export ---")
     check_required_env_vars({
         'PLANFIX_API_KEY': os.environ.get('PLANFIX_API_KEY'),
@@ -321,33 +377,6 @@ def main():
 
     conn = None
     try:
-        page = 1
-        all_companies_data = []
-        all_company_ids = []
-
-        while True:
-            logger.info(f"Fetching page {page} of companies...")
-            xml_text = get_planfix_companies(page)
-            companies = parse_companies(xml_text)
-            if not companies:
-                logger.info("No more companies found.")
-                break
-
-            for company_xml in companies:
-                company_data = company_to_dict(company_xml)
-                if company_data and company_data.get("id"):
-                    all_companies_data.append(company_data)
-                    all_company_ids.append(company_data["id"])
-            
-            page += 1
-            # break # для отладки
-
-        logger.info(f"Total companies (templateId={CLIENT_TEMPLATE_ID}) processed: {len(all_companies_data)}")
-
-        if not all_companies_data:
-            logger.info("No companies to update. Exiting.")
-            return
-
         conn = get_supabase_connection()
 
         # --- Schema Management ---
@@ -355,6 +384,7 @@ def main():
         all_columns = BASE_COLUMNS.copy()
         custom_columns_map = {v: "TEXT" for v in CUSTOM_MAP.values()} # Treat all custom as TEXT for simplicity
         all_columns.update(custom_columns_map)
+        all_columns.update({date_col: "DATE" for date_col in DATE_SHADOW_COLUMNS.values()})
 
         # 2. Create table if it doesn't exist
         create_sql = get_create_table_sql(CLIENTS_TABLE_NAME, CLIENTS_PK_COLUMN, all_columns)
@@ -362,28 +392,77 @@ def main():
 
         # 3. Add any missing columns to the existing table
         add_missing_columns(conn, CLIENTS_TABLE_NAME, all_columns)
+        ensure_date_indexes(conn)
+        create_daily_facts_table(conn)
 
-        # --- Data Upsert ---
-        # Get final list of columns from the DB in case some were added
-        with conn.cursor() as cur:
-            cur.execute(f"SELECT * FROM {CLIENTS_TABLE_NAME} LIMIT 0")
-            db_column_names = [desc[0] for desc in cur.description]
-
-        upsert_data_to_supabase(
-            conn,
-            CLIENTS_TABLE_NAME,
-            CLIENTS_PK_COLUMN,
-            db_column_names,
-            all_companies_data
+        if args.backfill:
+            backfill_date_columns(conn)
+            return
+
+        # --- Sync Mode ---
+        create_sync_state_table(conn)
+        sync_mode, updated_since = choose_sync_mode(
+            conn, CLIENTS_SYNC_ENTITY, PLANFIX_CONTACT_UPDATED_FILTER_TYPE, force_full=args.full
         )
 
+        all_companies_data = []
+        all_company_ids = []
+
+        fetch_page = partial(get_planfix_companies, updated_since=updated_since)
+        for page, xml_text in iter_pages(fetch_page, 'contacts'):
+            companies = parse_companies(xml_text)
+            logger.info(f"Page {page}: {len(companies)} companies with templateId={CLIENT_TEMPLATE_ID}")
+
+            for company_xml in companies:
+                company_data = company_to_dict(company_xml)
+                if company_data and company_data.get("id"):
+                    all_companies_data.append(company_data)
+                    all_company_ids.append(company_data["id"])
+
+        logger.info(f"Total companies (templateId={CLIENT_TEMPLATE_ID}) processed ({sync_mode}): {len(all_companies_data)}")
+
+        # Дни, к которым клиенты относились до обновления, тоже пересчитываются в kpi_daily_facts
+        touched_days = set()
+        if sync_mode != SYNC_MODE_FULL:
+            touched_days = get_touched_days(conn, 'clients', all_company_ids)
+
+        if all_companies_data:
+            # --- Data Upsert ---
+            # Get final list of columns from the DB in case some were added
+            with conn.cursor() as cur:
+                cur.execute(f"SELECT * FROM {CLIENTS_TABLE_NAME} LIMIT 0")
+                db_column_names = [desc[0] for desc in cur.description]
+
+            upsert_data_to_supabase(
+                conn,
+                CLIENTS_TABLE_NAME,
+                CLIENTS_PK_COLUMN,
+                db_column_names,
+                all_companies_data
+            )
+        else:
+            logger.info("No companies to update.")
+
         # --- Mark Deleted ---
-        mark_items_as_deleted_in_supabase(
-            conn,
-            CLIENTS_TABLE_NAME,
-            CLIENTS_PK_COLUMN,
-            all_company_ids
-        )
+        # An incremental run only sees changed companies, so deletions are
+        # reconciled on full runs only.
+        if sync_mode == SYNC_MODE_FULL and all_companies_data:
+            result = mark_items_as_deleted_in_supabase(
+                conn,
+                CLIENTS_TABLE_NAME,
+                CLIENTS_PK_COLUMN,
+                all_company_ids
+            )
+            logger.info(f"Companies marked as deleted: {result['deleted']}, revived: {result['revived']}")
+
+        # --- Daily KPI facts ---
+        if sync_mode == SYNC_MODE_FULL:
+            refresh_daily_facts(conn, 'clients')
+        else:
+            touched_days |= get_touched_days(conn, 'clients', all_company_ids)
+            refresh_daily_facts(conn, 'clients', touched_days)
+
+        save_sync_state(conn, CLIENTS_SYNC_ENTITY, max_watermark(updated_since, all_companies_data), sync_mode)
 
         logger.info("--- Planfix clients export finished successfully ---")
 
@@ -394,6 +473,7 @@ def main():
         if conn:
             conn.close()
             logger.info("Supabase connection closed.")
+        logger.info(f"Planfix API stats: {get_planfix_client().get_stats()}")
 
 
 if __name__ == '__main__':
@@ -1,11 +1,13 @@
 import os
 import sys
 import logging
+import argparse
+from functools import partial
 from datetime import datetime
 import json
-import xml.etree.ElementTree as ET
+import re
+from decimal import Decimal, InvalidOperation
 import psycopg2
-import requests
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -13,17 +15,32 @@ load_dotenv()
 
 # Add the parent directory to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.planfix_client import get_planfix_client, iter_pages
+from utils.planfix_parser import iter_records
 from utils.planfix_utils import (
     check_required_env_vars,
     make_planfix_request,
     get_supabase_connection,
     mark_items_as_deleted_in_supabase,
-    upsert_data_to_supabase
+    upsert_data_to_supabase,
+    add_missing_columns,
+    ROW_HASH_COLUMN
 )
+from utils.sync_state import (
+    PLANFIX_TASK_UPDATED_FILTER_TYPE,
+    SYNC_MODE_FULL,
+    build_updated_since_filter,
+    choose_sync_mode,
+    create_sync_state_table,
+    max_watermark,
+    save_sync_state
+)
+from core.kpi_daily_facts import create_daily_facts_table, get_touched_days, refresh_daily_facts
 
 ORDER_TEMPLATE_ID = 2420917
 ORDERS_TABLE_NAME = "planfix_orders"
 ORDERS_PK_COLUMN = "planfix_id"
+ORDERS_SYNC_ENTITY = "orders"
 
 # Сопоставление custom field name -> column name (как в старом скрипте)
 CUSTOM_MAP = {
@@ -80,13 +97,30 @@ CUSTOM_MAP = {
     "Numer trackingu": "numer_trackingu"
 }
 
+# Типизированные копии текстовых полей для индексируемых запросов отчётов
+TIMESTAMP_SHADOW_COLUMNS = {
+    "data_wyslania_oferty": "data_wyslania_oferty_ts",
+    "data_potwierdzenia_zamowienia": "data_potwierdzenia_zamowienia_ts",
+    "data_realizacji": "data_realizacji_ts"
+}
+NUMERIC_SHADOW_COLUMNS = {
+    "wartosc_netto_pln": "wartosc_netto_pln_num",
+    "laczna_prowizja_pln": "laczna_prowizja_pln_num"
+}
+SHADOW_COLUMN_TYPES = {
+    **{col: "TIMESTAMP" for col in TIMESTAMP_SHADOW_COLUMNS.values()},
+    **{col: "NUMERIC" for col in NUMERIC_SHADOW_COLUMNS.values()}
+}
+SHADOW_INDEXES = {
+    "idx_planfix_orders_data_wyslania_oferty_ts": "(data_wyslania_oferty_ts)",
+    "idx_planfix_orders_data_potwierdzenia_zamowienia_ts": "(data_potwierdzenia_zamowienia_ts)",
+    "idx_planfix_orders_data_realizacji_ts": "(data_realizacji_ts)",
+    "idx_planfix_orders_menedzher_data_realizacji_ts": "(menedzher, data_realizacji_ts)"
+}
+
 logger = logging.getLogger(__name__)
 
-def get_planfix_orders(page):
-    headers = {
-        'Content-Type': 'application/xml',
-        'Accept': 'application/xml'
-    }
+def get_planfix_orders(page, updated_since=None):
     body = (
         '<?xml version="1.0" encoding="UTF-8"?>'
         f'<request method="task.getList">'
@@ -99,6 +133,7 @@ def get_planfix_orders(page):
         '    <operator>equal</operator>'
         f'    <value>{ORDER_TEMPLATE_ID}</value>'
         '  </filter>'
+        f'{build_updated_since_filter(PLANFIX_TASK_UPDATED_FILTER_TYPE, updated_since)}'
         '</filters>'
         '<fields>'
         '  <field>id</field>'
@@ -122,18 +157,12 @@ def get_planfix_orders(page):
         '  <field>isNotAcceptedInTime</field>'
         '  <field>isSummary</field>'
         '  <field>starred</field>'
+        '  <field>lastUpdateDate</field>'
         '  <field>customData</field>'
         '</fields>'
         '</request>'
     )
-    response = requests.post(
-        "https://api.planfix.com/xml/",
-        data=body.encode('utf-8'),
-        headers=headers,
-        auth=(os.environ.get('PLANFIX_API_KEY'), os.environ.get('PLANFIX_TOKEN'))
-    )
-    response.raise_for_status()
-    return response.text
+    return get_planfix_client().post(body)
 
 def parse_date(date_str):
     if not date_str:
@@ -145,54 +174,56 @@ def parse_date(date_str):
             continue
     return None
 
+def parse_amount(value):
+    """Преобразует текстовую сумму ('1 234,56') в Decimal. Возвращает None, если значение не число."""
+    if not value:
+        return None
+    cleaned = re.sub(r'[^0-9,.-]', '', value).replace(',', '.')
+    try:
+        return Decimal(cleaned)
+    except InvalidOperation:
+        return None
+
 def parse_orders(xml_text):
-    root = ET.fromstring(xml_text)
-    if root.attrib.get("status") == "error":
-        code = root.findtext("code")
-        message = root.findtext("message")
-        logger.error(f"Ошибка Planfix API: code={code}, message={message}")
-        return []
     orders = []
-    for task in root.findall('.//task'):
-        def get_text(tag):
-            el = task.find(tag)
-            return el.text if el is not None else None
+    for task in iter_records(xml_text, 'tasks', 'task'):
+        get_text = task.get
+        get_int = task.get_int
 
         # customData as dict
         custom_fields = {v: None for v in CUSTOM_MAP.values()}
-        custom_data_root = task.find('customData')
-        if custom_data_root is not None:
-            for cv in custom_data_root.findall('customValue'):
-                field = cv.find('field/name')
-                value = cv.find('value')
-                if field is not None and field.text in CUSTOM_MAP:
-                    custom_fields[CUSTOM_MAP[field.text]] = value.text if value is not None else None
+        for field_name, cv in task.custom.items():
+            if field_name in CUSTOM_MAP:
+                custom_fields[CUSTOM_MAP[field_name]] = cv.get('value')
 
         orders.append({
-            "planfix_id": int(get_text('id')) if get_text('id') else None,
+            "planfix_id": get_int('id'),
             "title": get_text('title'),
             "description": get_text('description'),
             "importance": get_text('importance'),
             "status": get_text('statusName') or get_text('status'),
-            "status_set": int(get_text('statusSet')) if get_text('statusSet') else None,
-            "check_result": int(get_text('checkResult')) if get_text('checkResult') else None,
+            "status_set": get_int('statusSet'),
+            "check_result": get_int('checkResult'),
             "type": get_text('type'),
-            "owner_id": int(get_text('owner/id')) if get_text('owner/id') else None,
+            "owner_id": get_int('owner/id'),
             "owner_name": get_text('owner/name'),
-            "parent_id": int(get_text('parent/id')) if get_text('parent/id') else None,
-            "template_id": int(get_text('template/id')) if get_text('template/id') else None,
-            "project_id": int(get_text('project/id')) if get_text('project/id') else None,
+            "parent_id": get_int('parent/id'),
+            "template_id": get_int('template/id'),
+            "project_id": get_int('project/id'),
             "project_title": get_text('project/title'),
-            "client_id": int(get_text('client/id')) if get_text('client/id') else None,
+            "client_id": get_int('client/id'),
             "client_name": get_text('client/name'),
             "begin_datetime": parse_date(get_text('beginDateTime')),
-            "general": int(get_text('general')) if get_text('general') else None,
+            "general": get_int('general'),
             "is_overdued": get_text('isOverdued') == "1",
             "is_close_to_deadline": get_text('isCloseToDeadline') == "1",
             "is_not_accepted_in_time": get_text('isNotAcceptedInTime') == "1",
             "is_summary": get_text('isSummary') == "1",
             "starred": get_text('starred') == "1",
+            "last_update_date": parse_date(get_text('lastUpdateDate')),
             **custom_fields,
+            **{ts_col: parse_date(custom_fields[col]) for col, ts_col in TIMESTAMP_SHADOW_COLUMNS.items()},
+            **{num_col: parse_amount(custom_fields[col]) for col, num_col in NUMERIC_SHADOW_COLUMNS.items()},
             "updated_at": datetime.now(),
             "is_deleted": False
         })
@@ -202,7 +233,7 @@ def upsert_orders(orders, supabase_conn):
     if not orders:
         return
     first_item_keys = orders[0].keys()
-    all_column_names = list(first_item_keys)
+    all_column_names = list(first_item_keys) + [ROW_HASH_COLUMN]
     upsert_data_to_supabase(
         supabase_conn,
         ORDERS_TABLE_NAME,
@@ -212,7 +243,39 @@ def upsert_orders(orders, supabase_conn):
     )
     logger.info(f"Upserted {len(orders)} orders.")
 
+def ensure_shadow_columns(conn):
+    """Добавляет типизированные колонки и индексы по ним, если их ещё нет."""
+    add_missing_columns(conn, ORDERS_TABLE_NAME, SHADOW_COLUMN_TYPES)
+    with conn.cursor() as cur:
+        for index_name, index_columns in SHADOW_INDEXES.items():
+            cur.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON "{ORDERS_TABLE_NAME}" {index_columns};')
+    conn.commit()
+
+def backfill_shadow_columns(conn):
+    """Одноразово заполняет типизированные колонки из текстовых для уже загруженных заказов."""
+    assignments = []
+    for col, ts_col in TIMESTAMP_SHADOW_COLUMNS.items():
+        assignments.append(
+            f"{ts_col} = CASE WHEN {col} ~ '^\\d{{2}}-\\d{{2}}-\\d{{4}}( \\d{{2}}:\\d{{2}})?$' "
+            f"THEN TO_TIMESTAMP({col}, 'DD-MM-YYYY HH24:MI')::timestamp END"
+        )
+    for col, num_col in NUMERIC_SHADOW_COLUMNS.items():
+        cleaned = f"REPLACE(REGEXP_REPLACE({col}, '[^0-9,.-]', '', 'g'), ',', '.')"
+        assignments.append(
+            f"{num_col} = CASE WHEN {cleaned} ~ '^-?(\\d+(\\.\\d*)?|\\.\\d+)$' THEN {cleaned}::numeric END"
+        )
+    with conn.cursor() as cur:
+        cur.execute(f'UPDATE "{ORDERS_TABLE_NAME}" SET {", ".join(assignments)};')
+        updated = cur.rowcount
+    conn.commit()
+    logger.info(f"Backfilled typed columns for {updated} orders.")
+
 def main():
+    parser = argparse.ArgumentParser(description='Synchronize Planfix orders to Supabase.')
+    parser.add_argument('--full', action='store_true', help='Force a full sync instead of an incremental one')
+    parser.add_argument('--backfill', action='store_true', help='Fill typed shadow columns from text columns and exit')
+    args = parser.parse_args()
+
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -240,12 +303,23 @@ def main():
     supabase_conn = None
     try:
         supabase_conn = get_supabase_connection()
+        create_sync_state_table(supabase_conn)
+        add_missing_columns(supabase_conn, ORDERS_TABLE_NAME, {"last_update_date": "TIMESTAMP", ROW_HASH_COLUMN: "TEXT"})
+        ensure_shadow_columns(supabase_conn)
+        create_daily_facts_table(supabase_conn)
+        if args.backfill:
+            backfill_shadow_columns(supabase_conn)
+            return
+        sync_mode, updated_since = choose_sync_mode(
+            supabase_conn, ORDERS_SYNC_ENTITY, PLANFIX_TASK_UPDATED_FILTER_TYPE, force_full=args.full
+        )
+        watermark = updated_since
         all_orders = []
         all_ids = []
-        page = 1
-        while True:
-            logger.info(f"Fetching page {page} of orders...")
-            xml = get_planfix_orders(page)
+        # Дни, к которым заказы относились до обновления, тоже пересчитываются в kpi_daily_facts
+        touched_days = set()
+        fetch_page = partial(get_planfix_orders, updated_since=updated_since)
+        for page, xml in iter_pages(fetch_page, 'tasks'):
             if page == 1:
                 logger.debug("----- XML-ответ первой страницы -----")
                 logger.debug(xml[:2000])
@@ -253,15 +327,31 @@ def main():
             orders = parse_orders(xml)
             if not orders:
                 break
+            if sync_mode != SYNC_MODE_FULL:
+                touched_days |= get_touched_days(
+                    supabase_conn, 'orders', [o[ORDERS_PK_COLUMN] for o in orders if o[ORDERS_PK_COLUMN] is not None]
+                )
             upsert_orders(orders, supabase_conn)
             all_orders.extend(orders)
+            watermark = max_watermark(watermark, orders)
             all_ids.extend([o[ORDERS_PK_COLUMN] for o in orders if o[ORDERS_PK_COLUMN] is not None])
             logger.info(f"Загружено заказов на странице {page}: {len(orders)}")
-            if len(orders) < 100:
-                break
-            page += 1
-        logger.info(f"Всего загружено заказов: {len(all_orders)}")
-        # Можно добавить пометку удалённых, если нужно
+        logger.info(f"Всего загружено заказов ({sync_mode}): {len(all_orders)}")
+        # Пометка удалённых возможна только после полной синхронизации
+        # Пустой ответ Planfix не означает, что все заказы удалены
+        if sync_mode == SYNC_MODE_FULL and all_ids:
+            result = mark_items_as_deleted_in_supabase(
+                supabase_conn, ORDERS_TABLE_NAME, ORDERS_PK_COLUMN, all_ids
+            )
+            logger.info(f"Заказов помечено удалёнными: {result['deleted']}, восстановлено: {result['revived']}")
+        elif sync_mode == SYNC_MODE_FULL:
+            logger.warning("Полная синхронизация не вернула ни одного заказа, пометка удалённых пропущена.")
+        if sync_mode == SYNC_MODE_FULL:
+            refresh_daily_facts(supabase_conn, 'orders')
+        else:
+            touched_days |= get_touched_days(supabase_conn, 'orders', all_ids)
+            refresh_daily_facts(supabase_conn, 'orders', touched_days)
+        save_sync_state(supabase_conn, ORDERS_SYNC_ENTITY, watermark, sync_mode)
     except psycopg2.Error as e:
         logger.critical(f"Supabase connection error: {e}")
     except Exception as e:
@@ -270,6 +360,7 @@ def main():
         if supabase_conn:
             supabase_conn.close()
             logger.info("Supabase connection closed.")
+        logger.info(f"Planfix API stats: {get_planfix_client().get_stats()}")
         logger.info("Order synchronization finished.")
 
 if __name__ == "__main__":
@@ -1,8 +1,9 @@
 import os
 import sys
 import logging
+import argparse
+from functools import partial
 from datetime import datetime
-import xml.etree.ElementTree as ET
 import psycopg2
 import requests
 from dotenv import load_dotenv
@@ -14,29 +15,41 @@ load_dotenv()
 # Add the parent directory to the Python path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from utils.planfix_client import get_planfix_client, iter_pages
+from utils.planfix_parser import iter_records
 from utils.planfix_utils import (
     check_required_env_vars,
     make_planfix_request,
     get_supabase_connection,
     mark_items_as_deleted_in_supabase,
-    upsert_data_to_supabase
+    upsert_data_to_supabase,
+    add_missing_columns,
+    ROW_HASH_COLUMN
 )
+from utils.sync_state import (
+    PLANFIX_TASK_UPDATED_FILTER_TYPE,
+    SYNC_MODE_FULL,
+    build_updated_since_filter,
+    choose_sync_mode,
+    create_sync_state_table,
+    max_watermark,
+    save_sync_state
+)
+from core.task_types import get_kpi_code, kpi_code_case_sql
+from core.kpi_daily_facts import create_daily_facts_table, get_touched_days, refresh_daily_facts
 
 # Script-specific constants
 TASK_TEMPLATE_ID = 2465239  # Planfix ID for "Tasks" general task template
 TASKS_TABLE_NAME = "planfix_tasks"
 TASKS_PK_COLUMN = "planfix_id" # Primary key in Supabase table
+TASKS_SYNC_ENTITY = "tasks"
 # No custom map for tasks in this example, but could be added if needed:
 # TASK_CUSTOM_MAP = {} 
 
 # Get a logger instance for this module
 logger = logging.getLogger(__name__)
 
-def get_planfix_tasks(page):
-    headers = {
-        'Content-Type': 'application/xml',
-        'Accept': 'application/xml'
-    }
+def get_planfix_tasks(page, updated_since=None):
     body = (
         '<?xml version="1.0" encoding="UTF-8"?>'
         '<request method="task.getList">'
@@ -49,6 +62,7 @@ def get_planfix_tasks(page):
         '    <operator>equal</operator>'
         f'    <value>{TASK_TEMPLATE_ID}</value>'
         '  </filter>'
+        f'{build_updated_since_filter(PLANFIX_TASK_UPDATED_FILTER_TYPE, updated_since)}'
         '</filters>'
         '<fields>'
         '  <field>id</field>'
@@ -69,14 +83,7 @@ def get_planfix_tasks(page):
         '</fields>'
         '</request>'
     )
-    response = requests.post(
-        "https://api.planfix.com/xml/",
-        data=body.encode('utf-8'),
-        headers=headers,
-        auth=(os.environ.get('PLANFIX_API_KEY'), os.environ.get('PLANFIX_TOKEN'))
-    )
-    response.raise_for_status()
-    return response.text
+    return get_planfix_client().post(body)
 
 def parse_date(date_str):
     if not date_str:
@@ -90,12 +97,6 @@ def parse_date(date_str):
     return None
 
 def parse_tasks(xml_text):
-    root = ET.fromstring(xml_text)
-    if root.attrib.get("status") == "error":
-        code = root.findtext("code")
-        message = root.findtext("message")
-        logger.error(f"Ошибка Planfix API: code={code}, message={message}")
-        return []
     tasks = []
     custom_fields = {
         "Zadanie powiązane": "zadanie_powiazane",
@@ -110,64 +111,57 @@ def parse_tasks(xml_text):
         "Data zakończenia zadania": "data_zakonczenia_zadania",
         "Запустить сценарий \"Обновить данные в KPI\"": "zapustit_scenarij_obnovit_dannye_v_kpi"
     }
-    for task in root.findall('.//task'):
-        template_id = task.findtext('template/id')
+    for task in iter_records(xml_text, 'tasks', 'task'):
+        template_id = task.get('template/id')
         if str(template_id) != str(TASK_TEMPLATE_ID):
             continue
-        def get_text(tag):
-            el = task.find(tag)
-            return el.text if el is not None else None
+        get_text = task.get
+        get_int = task.get_int
         title = get_text('title')
-        task_type = None
-        if title and '/' in title:
-            task_type = title.split('/')[0].strip()
         # Парсим customData
         custom_data = {}
         custom_result = {v: None for v in custom_fields.values()}
-        custom_data_root = task.find('customData')
-        if custom_data_root is not None:
-            for cv in custom_data_root.findall('customValue'):
-                field = cv.find('field/name')
-                value = cv.find('value')
-                text = cv.find('text')
-                if field is not None:
-                    field_name = field.text
-                    if field_name in custom_fields:
-                        # Для дат парсим value как дату, если это дата
-                        if field_name in ["Data utworzenia zadania", "Data zakończenia zadania"]:
-                            custom_result[custom_fields[field_name]] = parse_date(value.text) if value is not None else None
-                        else:
-                            custom_result[custom_fields[field_name]] = value.text if value is not None else text.text if text is not None else None
-                    custom_data[field_name] = {
-                        "value": value.text if value is not None else None,
-                        "text": text.text if text is not None else None
-                    }
+        for field_name, cv in task.custom.items():
+            value = cv.get('value')
+            text = cv.get('text')
+            if field_name in custom_fields:
+                # Для дат парсим value как дату, если это дата
+                if field_name in ["Data utworzenia zadania", "Data zakończenia zadania"]:
+                    custom_result[custom_fields[field_name]] = parse_date(value)
+                else:
+                    custom_result[custom_fields[field_name]] = value if 'value' in cv else text
+            custom_data[field_name] = {
+                "value": value,
+                "text": text
+            }
         tasks.append({
-            "planfix_id": int(get_text('id')) if get_text('id') else None,
+            "planfix_id": get_int('id'),
             "title": title,
+            "kpi_code": get_kpi_code(title),
             "description": get_text('description'),
             "importance": get_text('importance'),
             "status": get_text('status'),
-            "status_set": int(get_text('statusSet')) if get_text('statusSet') else None,
+            "status_set": get_int('statusSet'),
             "check_result": get_text('checkResult') == '1',
             "type": get_text('type'),
             "additional_description_data": get_text('additionalDescriptionData'),
-            "owner_id": int(get_text('owner/id')) if get_text('owner/id') else None,
+            "owner_id": get_int('owner/id'),
             "owner_name": get_text('owner/name'),
-            "parent_id": int(get_text('parent/id')) if get_text('parent/id') else None,
-            "template_id": int(get_text('template/id')) if get_text('template/id') else None,
-            "project_id": int(get_text('project/id')) if get_text('project/id') else None,
+            "parent_id": get_int('parent/id'),
+            "template_id": get_int('template/id'),
+            "project_id": get_int('project/id'),
             "project_title": get_text('project/title'),
-            "client_id": int(get_text('client/id')) if get_text('client/id') else None,
+            "client_id": get_int('client/id'),
             "client_name": get_text('client/name'),
             "begin_datetime": parse_date(get_text('beginDateTime')),
             "end_time": parse_date(get_text('endTime')),
-            "general": int(get_text('general')) if get_text('general') else None,
+            "general": get_int('general'),
             "is_overdued": get_text('isOverdued') == '1',
             "is_close_to_deadline": get_text('isCloseToDeadline') == '1',
             "is_not_accepted_in_time": get_text('isNotAcceptedInTime') == '1',
             "is_summary": get_text('isSummary') == '1',
             "starred": get_text('starred') == '1',
+            "last_update_date": parse_date(get_text('lastUpdateDate')),
             # Пользовательские поля
             **custom_result,
             # Всё customData в JSON
@@ -178,10 +172,36 @@ def parse_tasks(xml_text):
         })
     return tasks
 
+def ensure_kpi_code_index(conn):
+    """Создаёт индекс (owner_name, kpi_code, data_zakonczenia_zadania) для отчетов по задачам."""
+    with conn.cursor() as cur:
+        cur.execute(
+            f'CREATE INDEX IF NOT EXISTS idx_tasks_owner_kpi_code_done '
+            f'ON "{TASKS_TABLE_NAME}" (owner_name, kpi_code, data_zakonczenia_zadania);'
+        )
+    conn.commit()
+
+def backfill_kpi_codes(conn):
+    """Заполняет kpi_code по названию у уже загруженных задач (после изменения справочника типов)."""
+    kpi_code_sql = kpi_code_case_sql('title')
+    with conn.cursor() as cur:
+        cur.execute(
+            f'UPDATE "{TASKS_TABLE_NAME}" SET kpi_code = {kpi_code_sql} '
+            f'WHERE kpi_code IS DISTINCT FROM ({kpi_code_sql});'
+        )
+        updated = cur.rowcount
+    conn.commit()
+    logger.info(f"Backfilled kpi_code for {updated} tasks.")
+
 def main():
     """
     Main function to fetch tasks from Planfix and upsert to Supabase.
     """
+    parser = argparse.ArgumentParser(description='Synchronize Planfix tasks to Supabase.')
+    parser.add_argument('--full', action='store_true', help='Force a full sync instead of an incremental one')
+    parser.add_argument('--backfill', action='store_true', help='Fill kpi_code from task titles and exit')
+    args = parser.parse_args()
+
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -209,13 +229,26 @@ def main():
     supabase_conn = None
     try:
         supabase_conn = get_supabase_connection()
+        create_sync_state_table(supabase_conn)
+        add_missing_columns(
+            supabase_conn, TASKS_TABLE_NAME,
+            {"last_update_date": "TIMESTAMP", "kpi_code": "TEXT", ROW_HASH_COLUMN: "TEXT"}
+        )
+        ensure_kpi_code_index(supabase_conn)
+        create_daily_facts_table(supabase_conn)
+        if args.backfill:
+            backfill_kpi_codes(supabase_conn)
+            return
+        sync_mode, updated_since = choose_sync_mode(
+            supabase_conn, TASKS_SYNC_ENTITY, PLANFIX_TASK_UPDATED_FILTER_TYPE, force_full=args.full
+        )
         current_page = 1
         all_processed_ids = []
         all_tasks = []
-        while True:
-            logger.info(f"Fetching page {current_page} of tasks...")
-            try:
-                xml = get_planfix_tasks(current_page)
+        fetch_completed = False
+        try:
+            fetch_page = partial(get_planfix_tasks, updated_since=updated_since)
+            for current_page, xml in iter_pages(fetch_page, 'tasks'):
                 tasks = parse_tasks(xml)
                 all_tasks.extend(tasks)
                 logger.info(f"На странице {current_page}: {len(tasks)} задач с шаблоном {TASK_TEMPLATE_ID}")
@@ -229,23 +262,21 @@ def main():
                             all_processed_ids.append(int(pk_value))
                         except ValueError:
                             logger.warning(f"Could not convert primary key '{pk_value}' to int for task ID. Skipping for deletion marking list.")
-                
-                # Check if we should continue to next page
-                if len(tasks) < 100:
-                    break
-                current_page += 1
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Error fetching data from Planfix API for tasks: {e}")
-                break
-            except Exception as e:
-                logger.error(f"An unexpected error occurred processing page {current_page} of tasks: {e}")
-                break
+            fetch_completed = True
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error fetching data from Planfix API for tasks: {e}")
+        except Exception as e:
+            logger.error(f"An unexpected error occurred processing page {current_page} of tasks: {e}")
+        # Дни, к которым задачи относились до обновления, тоже пересчитываются в kpi_daily_facts
+        touched_days = set()
+        if sync_mode != SYNC_MODE_FULL:
+            touched_days = get_touched_days(supabase_conn, 'tasks', all_processed_ids)
         if all_tasks:
             first_item_keys = all_tasks[0].keys()
             if TASKS_PK_COLUMN not in first_item_keys:
                 logger.critical(f"Primary key '{TASKS_PK_COLUMN}' not found in processed data keys. Skipping upsert.")
             else:
-                all_column_names = list(first_item_keys)
+                all_column_names = list(first_item_keys) + [ROW_HASH_COLUMN]
                 upsert_data_to_supabase(
                     supabase_conn,
                     TASKS_TABLE_NAME,
@@ -256,18 +287,26 @@ def main():
                 logger.info(f"Upserted {len(all_tasks)} tasks.")
         else:
             logger.info(f"No data to upsert.")
-        if supabase_conn:
-            if not all_processed_ids and current_page == 1:
-                logger.info("No tasks were found in Planfix. Marking all existing tasks in Supabase as deleted.")
-                mark_items_as_deleted_in_supabase(
-                    supabase_conn, TASKS_TABLE_NAME, TASKS_PK_COLUMN, []
-                )
-            elif all_processed_ids:
-                logger.info(f"Total processed task IDs for deletion check: {len(all_processed_ids)}")
-                mark_items_as_deleted_in_supabase(
-                    supabase_conn, TASKS_TABLE_NAME, TASKS_PK_COLUMN, all_processed_ids
-                )
-                logger.info(f"Marked tasks not in the current batch as deleted.")
+        # An empty (but successful) Planfix response does not mean every task was deleted
+        if sync_mode == SYNC_MODE_FULL and fetch_completed and all_processed_ids:
+            logger.info(f"Total processed task IDs for deletion check: {len(all_processed_ids)}")
+            result = mark_items_as_deleted_in_supabase(
+                supabase_conn, TASKS_TABLE_NAME, TASKS_PK_COLUMN, all_processed_ids
+            )
+            logger.info(f"Tasks marked as deleted: {result['deleted']}, revived: {result['revived']}.")
+        elif sync_mode == SYNC_MODE_FULL and fetch_completed:
+            logger.warning("Full sync returned no tasks. Skipping deletion marking.")
+        elif sync_mode == SYNC_MODE_FULL:
+            logger.warning("Task fetch was incomplete. Skipping deletion marking.")
+        if sync_mode == SYNC_MODE_FULL:
+            refresh_daily_facts(supabase_conn, 'tasks')
+        else:
+            touched_days |= get_touched_days(supabase_conn, 'tasks', all_processed_ids)
+            refresh_daily_facts(supabase_conn, 'tasks', touched_days)
+        if fetch_completed:
+            save_sync_state(supabase_conn, TASKS_SYNC_ENTITY, max_watermark(updated_since, all_tasks), sync_mode)
+        else:
+            logger.warning("Task fetch was interrupted. Sync state is not advanced.")
     except psycopg2.Error as e:
         logger.critical(f"Supabase connection error: {e}")
     except ValueError as e:
@@ -278,6 +317,7 @@ def main():
         if supabase_conn:
             supabase_conn.close()
             logger.info("Supabase connection closed.")
+        logger.info(f"Planfix API stats: {get_planfix_client().get_stats()}")
         logger.info("Task synchronization finished.")
 
 if __name__ == "__main__":
@@ -1,5 +1,3 @@
-import psycopg2
-import requests
 from datetime import datetime, date, timedelta
 import os
 import logging
@@ -9,6 +7,8 @@ import os
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 from core.config import MANAGERS_KPI
+from utils.db_pool import execute_query
+from utils.telegram_client import send_to_telegram
 
 # Load environment variables from .env file
 load_dotenv()
@@ -20,33 +20,11 @@ logging.basicConfig(
     handlers=[logging.StreamHandler()]
 )
 
-PG_HOST = os.environ.get('SUPABASE_HOST')
-PG_DB = os.environ.get('SUPABASE_DB')
-PG_USER = os.environ.get('SUPABASE_USER')
-PG_PASSWORD = os.environ.get('SUPABASE_PASSWORD')
-PG_PORT = os.environ.get('SUPABASE_PORT')
-TELEGRAM_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
-CHAT_ID = os.environ.get('TELEGRAM_CHAT_ID')
-
 logger = logging.getLogger(__name__)
 
 
 def _execute_query(query: str, params: tuple, description: str) -> list:
-    conn = None
-    try:
-        conn = psycopg2.connect(host=PG_HOST, dbname=PG_DB, user=PG_USER, password=PG_PASSWORD, port=PG_PORT)
-        cur = conn.cursor()
-        logger.info(f"Executing query for: {description} with params: {params}")
-        cur.execute(query, params)
-        rows = cur.fetchall()
-        logger.info(f"Query for {description} returned {len(rows)} rows.")
-        return rows
-    except psycopg2.Error as e:
-        logger.error(f"Database error during query for {description}: {e}")
-        raise
-    finally:
-        if conn:
-            conn.close()
+    return execute_query(query, params, description)
 
 def _parse_netto_pln(value):
     """Преобразует текстовое значение wartosc_netto_pln в float. Возвращает 0.0 при ошибке."""
@@ -65,73 +43,40 @@ def get_daily_activity(start_date: datetime, end_date: datetime, user_names: tup
         SELECT 
             EXTRACT(HOUR FROM t.data_zakonczenia_zadania) as hour,
             t.owner_name AS manager_name,
-            CASE 
-                WHEN TRIM(SPLIT_PART(t.title, ' /', 1)) = 'Nawiązać pierwszy kontakt' THEN 'WDM'
-                WHEN TRIM(SPLIT_PART(t.title, ' /', 1)) = 'Przeprowadzić pierwszą rozmowę telefoniczną' THEN 'PRZ'
-                WHEN TRIM(SPLIT_PART(t.title, ' /', 1)) = 'Zadzwonić do klienta' THEN 'ZKL'
-                WHEN TRIM(SPLIT_PART(t.title, ' /', 1)) = 'Przeprowadzić spotkanie' THEN 'SPT'
-                WHEN TRIM(SPLIT_PART(t.title, ' /', 1)) = 'Wysłać materiały' THEN 'MAT'
-                WHEN TRIM(SPLIT_PART(t.title, ' /', 1)) = 'Odpowiedzieć na pytanie techniczne' THEN 'TPY'
-                WHEN TRIM(SPLIT_PART(t.title, ' /', 1)) = 'Zapisać na media społecznościowe' THEN 'MSP'
-                WHEN TRIM(SPLIT_PART(t.title, ' /', 1)) = 'Opowiedzieć o nowościach' THEN 'NOW'
-                WHEN TRIM(SPLIT_PART(t.title, ' /', 1)) = 'Zebrać opinie' THEN 'OPI'
-                WHEN TRIM(SPLIT_PART(t.title, ' /', 1)) = 'Przywrócić klienta' THEN 'WRK'
-                WHEN TRIM(SPLIT_PART(t.title, ' /', 1)) = 'Tworzyć kontent' THEN 'KNT'
-                ELSE NULL
-            END AS metric,
+            t.kpi_code AS metric,
             COUNT(*) as count
         FROM planfix_tasks t
         WHERE t.data_zakonczenia_zadania >= %s AND t.data_zakonczenia_zadania < %s
         AND t.owner_name = ANY(%s)
         AND t.is_deleted = false
-        AND TRIM(SPLIT_PART(t.title, ' /', 1)) IN (
-            'Nawiązać pierwszy kontakt',
-            'Przeprowadzić pierwszą rozmowę telefoniczną',
-            'Zadzwonić do klienta',
-            'Przeprowadzić spotkanie',
-            'Wysłać materiały',
-            'Odpowiedzieć na pytanie techniczne',
-            'Zapisać na media społecznościowe',
-            'Opowiedzieć o nowościach',
-            'Zebrać opinie',
-            'Przywrócić klienta',
-            'Tworzyć kontent'
-        )
+        AND t.kpi_code IS NOT NULL
         GROUP BY hour, t.owner_name, metric
     ),
     order_metrics AS (
         SELECT 
-            EXTRACT(HOUR FROM TO_TIMESTAMP(o.data_potwierdzenia_zamowienia, 'DD-MM-YYYY HH24:MI')) as hour,
+            EXTRACT(HOUR FROM o.data_potwierdzenia_zamowienia_ts) as hour,
             o.menedzher as manager_name,
             'OFW' as metric,
             COUNT(*) as count
         FROM planfix_orders o
-        WHERE o.data_potwierdzenia_zamowienia IS NOT NULL AND o.data_potwierdzenia_zamowienia != ''
-        AND TO_TIMESTAMP(o.data_potwierdzenia_zamowienia, 'DD-MM-YYYY HH24:MI') >= %s 
-        AND TO_TIMESTAMP(o.data_potwierdzenia_zamowienia, 'DD-MM-YYYY HH24:MI') < %s
+        WHERE o.data_potwierdzenia_zamowienia_ts >= %s 
+        AND o.data_potwierdzenia_zamowienia_ts < %s
         AND o.menedzher = ANY(%s)
-        AND o.wartosc_netto_pln IS NOT NULL
-        AND TRIM(o.wartosc_netto_pln) != ''
-        AND o.wartosc_netto_pln != '0,00'
-        AND COALESCE(NULLIF(CAST(REPLACE(REPLACE(REGEXP_REPLACE(o.wartosc_netto_pln, '[^0-9,.-]', '', 'g'), ',', '.'), ' ', '') AS DECIMAL), 0), 0) != 0
+        AND o.wartosc_netto_pln_num != 0
         GROUP BY hour, o.menedzher
 
         UNION ALL
 
         SELECT 
-            EXTRACT(HOUR FROM TO_TIMESTAMP(o.data_potwierdzenia_zamowienia, 'DD-MM-YYYY HH24:MI')) as hour,
+            EXTRACT(HOUR FROM o.data_potwierdzenia_zamowienia_ts) as hour,
             o.menedzher as manager_name,
             'ZAM' as metric,
             COUNT(*) as count
         FROM planfix_orders o
-        WHERE o.data_potwierdzenia_zamowienia IS NOT NULL AND o.data_potwierdzenia_zamowienia != ''
-        AND TO_TIMESTAMP(o.data_potwierdzenia_zamowienia, 'DD-MM-YYYY HH24:MI') >= %s 
-        AND TO_TIMESTAMP(o.data_potwierdzenia_zamowienia, 'DD-MM-YYYY HH24:MI') < %s
+        WHERE o.data_potwierdzenia_zamowienia_ts >= %s 
+        AND o.data_potwierdzenia_zamowienia_ts < %s
         AND o.menedzher = ANY(%s)
-        AND o.wartosc_netto_pln IS NOT NULL
-        AND TRIM(o.wartosc_netto_pln) != ''
-        AND o.wartosc_netto_pln != '0,00'
-        AND COALESCE(NULLIF(CAST(REPLACE(REPLACE(REGEXP_REPLACE(o.wartosc_netto_pln, '[^0-9,.-]', '', 'g'), ',', '.'), ' ', '') AS DECIMAL), 0), 0) != 0
+        AND o.wartosc_netto_pln_num != 0
         GROUP BY hour, o.menedzher
     )
     SELECT 
@@ -214,28 +159,15 @@ def format_activity_report(activity: dict, current_date: date) -> str:
     message += '```'
     return message
 
-def send_to_telegram(message: str):
-    try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-        payload = {
-            'chat_id': CHAT_ID,
-            'text': message,
-            'parse_mode': 'Markdown'
-        }
-        response = requests.post(url, json=payload, timeout=10)
-        if response.status_code != 200:
-            logger.error(f"Failed to send message to Telegram: {response.text}")
-        else:
-            logger.info("Message sent successfully to Telegram")
-    except Exception as e:
-        logger.error(f"Error sending to Telegram: {str(e)}")
-        raise
+def build_activity_messages(report_day: date = None) -> list:
+    """Activity report messages for a day (without sending)."""
+    today = report_day or date.today()
+    activity = get_daily_activity(today, today + timedelta(days=1), tuple(m['planfix_user_name'] for m in MANAGERS_KPI))
+    return [format_activity_report(activity, today)]
 
 def main():
-    today = date.today()
-    activity = get_daily_activity(today, today + timedelta(days=1), tuple(m['planfix_user_name'] for m in MANAGERS_KPI))
-    message = format_activity_report(activity, today)
-    send_to_telegram(message)
+    for message in build_activity_messages():
+        send_to_telegram(message)
     logger.info("Daily activity report sent successfully")
 
 if __name__ == "__main__":
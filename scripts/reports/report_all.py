@@ -0,0 +1,79 @@
+"""
+Все ежедневные отчеты одним запуском (/report_all, send_all_reports.yml).
+
+Отчеты строятся параллельно через utils.report_runner на общем пуле соединений,
+а отправляются в чат в постоянном порядке REPORTS. Ошибка одного отчета не
+прерывает остальные: вместо него в чат уходит сообщение об ошибке, а скрипт
+завершается с кодом 1 после отправки всех отчетов.
+"""
+import os
+import sys
+import logging
+import argparse
+from dotenv import load_dotenv
+# Load environment variables from .env file
+load_dotenv()
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+from reports.report_activity import build_activity_messages
+from reports.report_kpi import build_kpi_messages
+from reports.report_bonus import build_premia_messages
+from reports.report_income import build_income_messages
+from reports.report_status import build_status_messages
+from utils.report_runner import run_reports, format_timings, REPORT_WORKERS
+from utils.telegram_client import send_to_telegram
+
+# Get a logger instance for this module
+logger = logging.getLogger(__name__)
+
+# Отчет -> функция построения сообщений, в порядке отправки
+REPORTS = {
+    'activity': build_activity_messages,
+    'kpi': build_kpi_messages,
+    'bonus': lambda: build_premia_messages(['monthly']),
+    'income': build_income_messages,
+    'status': build_status_messages,
+}
+
+FAILED_REPORT_MESSAGE = "❌ Błąd podczas generowania raportu {name}: {error}"
+
+
+def send_all_reports(names: list = None, max_workers: int = REPORT_WORKERS) -> bool:
+    """
+    Строит отчеты names (по умолчанию все) параллельно и отправляет их по порядку REPORTS.
+    Возвращает True, если все отчеты построены и отправлены.
+    """
+    names = [name for name in REPORTS if names is None or name in names]
+    results = run_reports([(name, REPORTS[name]) for name in names], max_workers)
+
+    delivered = True
+    for result in results:
+        if not result.ok:
+            # Простым текстом: имя отчета и текст ошибки (идентификаторы psycopg2) содержат '_'
+            delivered = send_to_telegram(
+                FAILED_REPORT_MESSAGE.format(name=result.name, error=result.error), parse_mode=None
+            ) and delivered
+            continue
+        for message in result.messages:
+            delivered = send_to_telegram(message) and delivered
+
+    failed = [result.name for result in results if not result.ok]
+    if failed:
+        logger.error(f"Reports failed: {', '.join(failed)} ({format_timings(results)})")
+    else:
+        logger.info(f"All reports sent ({format_timings(results)})")
+    return not failed and delivered
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        handlers=[logging.StreamHandler()]
+    )
+    parser = argparse.ArgumentParser(description='Параллельное построение и отправка всех отчетов.')
+    parser.add_argument('--only', nargs='+', choices=list(REPORTS), help='Построить только указанные отчеты')
+    parser.add_argument('--workers', type=int, default=REPORT_WORKERS, help='Сколько отчетов строится одновременно')
+    args = parser.parse_args()
+
+    sys.exit(0 if send_all_reports(args.only, args.workers) else 1)
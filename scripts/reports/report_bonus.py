@@ -4,7 +4,6 @@
 """
 import os
 import logging
-import requests
 import argparse
 from datetime import datetime
 from dotenv import load_dotenv
@@ -13,8 +12,9 @@ import sys
 # Добавляем путь к скриптам
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-from core.kpi_engine import KPIEngine
+from core.kpi_engine import KPIEngine, KPIPeriod
 from core.report_formatter import ReportFormatter
+from utils.telegram_client import send_to_telegram
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -28,59 +28,49 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-# Telegram настройки
-TELEGRAM_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
-CHAT_ID = os.environ.get('TELEGRAM_CHAT_ID')
+def generate_premia_report(period_type: str = 'monthly', start_date: str = None, end_date: str = None):
+    """Генерирует отчет по премиям для указанного периода"""
+    return generate_premia_reports([period_type], start_date, end_date)[0]
 
-def send_to_telegram(message: str):
-    """Отправляет сообщение в Telegram"""
-    if not TELEGRAM_TOKEN or not CHAT_ID:
-        logger.error("Telegram token or chat ID not configured")
-        return
-    
+def generate_premia_reports(period_types: list, start_date: str = None, end_date: str = None) -> list:
+    """
+    Генерирует отчеты по премиям для нескольких периодов.
+    Метрики и факты всех периодов собираются движком за один набор запросов.
+    Ошибка возвращается текстом отчета.
+    """
     try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-        data = {
-            "chat_id": CHAT_ID,
-            "text": message,
-            "parse_mode": "Markdown"
-        }
-        response = requests.post(url, data=data)
-        response.raise_for_status()
-        logger.info("Message sent to Telegram successfully")
+        return build_premia_messages(period_types, start_date, end_date)
     except Exception as e:
-        logger.error(f"Failed to send message to Telegram: {e}")
+        error_msg = f"Błąd podczas generowania raportu za {', '.join(period_types)}: {str(e)}"
+        logger.error(f"Error generating premia report: {e}")
+        return [error_msg] * len(period_types)
 
-def generate_premia_report(period_type: str = 'monthly', start_date: str = None, end_date: str = None):
-    """Генерирует отчет по премиям для указанного периода"""
-    try:
-        logger.info(f"Generating premia report for period: {period_type}")
-        
-        # Создаем KPI движок
-        kpi_engine = KPIEngine()
-        
-        # Генерируем KPI отчет
-        report_data = kpi_engine.generate_kpi_report(period_type, start_date, end_date)
-        
-        # Создаем форматтер
-        formatter = ReportFormatter()
-        
-        # Форматируем отчет
-        report = formatter.format_premia_report(
+def build_premia_messages(period_types: list, start_date: str = None, end_date: str = None) -> list:
+    """Отчеты по премиям для периодов движка (monthly, previous_month, ...); ошибки пробрасываются"""
+    logger.info(f"Generating premia reports for periods: {period_types}")
+    
+    # Создаем KPI движок
+    kpi_engine = KPIEngine()
+    
+    # Генерируем KPI отчеты для всех периодов сразу
+    periods = [KPIPeriod(period_type, start_date, end_date) for period_type in period_types]
+    reports_data = kpi_engine.generate_kpi_reports(periods)
+    
+    # Создаем форматтер
+    formatter = ReportFormatter()
+    
+    # Форматируем отчеты
+    reports = []
+    for period_type, report_data in zip(period_types, reports_data):
+        reports.append(formatter.format_premia_report(
             report_data['coefficients'],
             period_type,
             report_data['additional_premia'],
             report_data.get('month'),
             report_data.get('year')
-        )
-        
+        ))
         logger.info(f"Premia report generated successfully for {period_type}")
-        return report
-        
-    except Exception as e:
-        error_msg = f"Błąd podczas generowania raportu za {period_type}: {str(e)}"
-        logger.error(f"Error generating premia report: {e}")
-        return error_msg
+    return reports
 
 def main():
     """Основная функция с поддержкой аргументов командной строки"""
@@ -88,9 +78,10 @@ def main():
     parser.add_argument(
         '--period', 
         type=str, 
-        default='current',
+        nargs='+',
+        default=['current'],
         choices=['current', 'previous', 'monthly', 'previous_month'],
-        help='Период отчета: current (текущий месяц), previous (предыдущий месяц)'
+        help='Периоды отчета: current (текущий месяц), previous (предыдущий месяц); несколько периодов считаются вместе'
     )
     parser.add_argument(
         '--start-date',
@@ -108,23 +99,20 @@ def main():
     try:
         logger.info(f"Starting premia report generation for period: {args.period}")
         
-        # Определяем тип периода для KPI движка
-        if args.period == 'current':
-            period_type = 'monthly'
-        elif args.period == 'previous':
-            period_type = 'previous_month'
-        else:
-            period_type = args.period
+        # Определяем типы периодов для KPI движка
+        period_aliases = {'current': 'monthly', 'previous': 'previous_month'}
+        period_types = [period_aliases.get(period, period) for period in args.period]
         
-        # Генерируем отчет
-        report = generate_premia_report(
-            period_type=period_type,
+        # Генерируем отчеты
+        reports = generate_premia_reports(
+            period_types,
             start_date=args.start_date,
             end_date=args.end_date
         )
         
         # Отправляем в Telegram
-        send_to_telegram(report)
+        for report in reports:
+            send_to_telegram(report)
         
         logger.info("Premia report completed successfully")
         
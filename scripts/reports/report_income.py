@@ -2,9 +2,7 @@ import os
 import sys
 import logging
 from datetime import datetime, timedelta
-import psycopg2
 from decimal import Decimal
-import requests
 from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
@@ -12,17 +10,9 @@ load_dotenv()
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 from core.config import MANAGERS_KPI
 from core.kpi_utils import math_round
-
-# --- Database Settings ---
-PG_HOST = os.environ.get('SUPABASE_HOST')
-PG_DB = os.environ.get('SUPABASE_DB')
-PG_USER = os.environ.get('SUPABASE_USER')
-PG_PASSWORD = os.environ.get('SUPABASE_PASSWORD')
-PG_PORT = os.environ.get('SUPABASE_PORT')
-
-# --- Telegram Settings ---
-TELEGRAM_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
-CHAT_ID = os.environ.get('TELEGRAM_CHAT_ID')
+from core.kpi_plans import get_kpi_plan
+from utils.db_pool import get_connection
+from utils.telegram_client import send_to_telegram
 
 # Get a logger instance for this module
 logger = logging.getLogger(__name__)
@@ -49,19 +39,11 @@ def format_percent(val):
     # Округляем до целых значений и форматируем как (XX%)
     return f"({math_round(float(val), 0)}%)"
 
-def get_income_data(conn, month, year):
-    """Получает данные о доходах из Supabase."""
+def get_income_data(conn, month, year, plan):
+    """Получает данные о доходах из Supabase (plan — строка kpi_metrics за месяц или None)."""
     try:
-        # Получаем плановое значение выручки (общее для всех менеджеров)
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT revenue_plan
-                FROM kpi_metrics
-                WHERE month = %s AND year = %s
-                LIMIT 1
-            """, (f"{month:02d}", year))
-            result = cur.fetchone()
-            revenue_plan = Decimal(str(result[0])) if result and result[0] is not None else Decimal('0')
+        # Плановое значение выручки (общее для всех менеджеров)
+        revenue_plan = Decimal(str(plan['revenue_plan'])) if plan and plan.get('revenue_plan') is not None else Decimal('0')
 
         # Получаем первый и последний день месяца
         first_day = datetime(year, month, 1)
@@ -89,11 +71,11 @@ def get_income_data(conn, month, year):
             cur.execute("""
                 SELECT 
                     menedzher,
-                    SUM(CAST(REPLACE(wartosc_netto_pln, ',', '.') AS DECIMAL)) as fakt
+                    SUM(wartosc_netto_pln_num) as fakt
                 FROM planfix_orders
                 WHERE 
-                    TO_TIMESTAMP(data_realizacji, 'DD-MM-YYYY HH24:MI') >= %s::timestamp 
-                    AND TO_TIMESTAMP(data_realizacji, 'DD-MM-YYYY HH24:MI') <= %s::timestamp
+                    data_realizacji_ts >= %s::timestamp 
+                    AND data_realizacji_ts <= %s::timestamp
                     AND is_deleted = false
                 GROUP BY menedzher
             """, (first_day_str, last_day_str))
@@ -104,7 +86,7 @@ def get_income_data(conn, month, year):
             cur.execute("""
                 SELECT 
                     menedzher,
-                    SUM(CAST(REPLACE(wartosc_netto_pln, ',', '.') AS DECIMAL)) as dlug
+                    SUM(wartosc_netto_pln_num) as dlug
                 FROM planfix_orders
                 WHERE 
                     status = 140
@@ -143,15 +125,14 @@ def get_income_data(conn, month, year):
         logger.error(f"Error getting income data: {e}")
         return {}
 
-def generate_income_report(conn):
+def generate_income_report(conn, current_date, plan):
     """
     Generate income report for all managers in MANAGERS_KPI in Polish, code block, always show all managers.
     """
-    current_date = datetime.now()
     current_month = current_date.month
     current_year = current_date.year
     
-    revenue_data = get_income_data(conn, current_month, current_year)
+    revenue_data = get_income_data(conn, current_month, current_year, plan)
     
     # Сначала собираем все значения для выравнивания
     all_lines = []
@@ -275,52 +256,24 @@ def generate_income_report(conn):
     message += '```'
     return message
 
-def send_to_telegram(message):
+def build_income_messages() -> list:
     """
-    Send message to Telegram.
+    Income report messages for the current month (without sending).
     """
-    bot_token = TELEGRAM_TOKEN
-    chat_id = CHAT_ID
-    
-    if not bot_token or not chat_id:
-        logger.error("Missing Telegram configuration")
-        return False
-    
-    url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-    payload = {
-        'chat_id': chat_id,
-        'text': message,
-        'parse_mode': 'Markdown'
-    }
-    
-    try:
-        response = requests.post(url, json=payload, timeout=10)
-        if response.status_code != 200:
-            logger.error(f"Failed to send message to Telegram: {response.text}")
-            return False
-        else:
-            logger.info("Message sent successfully to Telegram")
-            return True
-    except Exception as e:
-        logger.error(f"Failed to send message to Telegram: {e}")
-        return False
+    current_date = datetime.now()
+    # The plan is read before borrowing a connection: on a cache miss the plan
+    # cache takes its own pooled connection, and nesting the two can exhaust the pool
+    plan = get_kpi_plan(current_date.month, current_date.year)
+    with get_connection() as conn:
+        return [generate_income_report(conn, current_date, plan)]
 
 def main():
     """
     Main function to generate and send income report.
     """
     try:
-        # Подключение к базе напрямую через psycopg2
-        conn = psycopg2.connect(
-            host=PG_HOST,
-            dbname=PG_DB,
-            user=PG_USER,
-            password=PG_PASSWORD,
-            port=PG_PORT
-        )
-        report = generate_income_report(conn)
-        send_to_telegram(report)
-        conn.close()
+        for report in build_income_messages():
+            send_to_telegram(report)
     except Exception as e:
         logger.critical(f"An unexpected error occurred: {e}")
 
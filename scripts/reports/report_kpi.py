@@ -1,5 +1,3 @@
-import psycopg2
-import requests
 from datetime import datetime, date, timedelta # Added timedelta
 import os
 import logging # Added logging
@@ -21,6 +19,10 @@ from utils.planfix_utils import (
     SUPABASE_PORT
 )
 from core.kpi_utils import math_round
+from core.task_types import KZI_RESULT, TASK_REPORT_ORDER
+from core.kpi_daily_facts import daily_facts_ready, get_daily_totals, period_days
+from utils.db_pool import execute_query
+from utils.telegram_client import send_to_telegram
 
 # Load environment variables from .env file
 load_dotenv()
@@ -34,13 +36,6 @@ logging.basicConfig(
     ]
 )
 
-# --- Database Settings ---
-PG_HOST = os.environ.get('SUPABASE_HOST')
-PG_DB = os.environ.get('SUPABASE_DB')
-PG_USER = os.environ.get('SUPABASE_USER')
-PG_PASSWORD = os.environ.get('SUPABASE_PASSWORD')
-PG_PORT = os.environ.get('SUPABASE_PORT')
-
 # --- Telegram Settings ---
 TELEGRAM_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 CHAT_ID = os.environ.get('TELEGRAM_CHAT_ID')
@@ -90,23 +85,8 @@ def _check_env_vars():
         raise ValueError(error_msg)
 
 def _execute_kpi_query(query: str, params: tuple, description: str) -> list:
-    """Helper function to connect, execute query, and close connection."""
-    conn = None
-    try:
-        conn = psycopg2.connect(host=PG_HOST, dbname=PG_DB, user=PG_USER, password=PG_PASSWORD, port=PG_PORT)
-        cur = conn.cursor()
-        logger.info(f"Executing KPI query for: {description} with params: {params}")
-        cur.execute(query, params)
-        rows = cur.fetchall()
-        logger.info(f"Query for {description} returned {len(rows)} rows.")
-        return rows
-    except psycopg2.Error as e:
-        logger.error(f"Database error during KPI query for {description}: {e}")
-        # Optionally re-raise or return empty list depending on desired error handling
-        raise # Re-raise to stop script if DB query fails
-    finally:
-        if conn:
-            conn.close()
+    """Helper function to execute a query on a pooled connection."""
+    return execute_query(query, params, description)
 
 def _parse_netto_pln(value):
     """Преобразует текстовое значение wartosc_netto_pln в float. Возвращает 0.0 при ошибке."""
@@ -125,53 +105,12 @@ def count_tasks_by_type(start_date_str: str, end_date_str: str) -> list:
     logger.info(f"Start date: {start_date_str}")
     logger.info(f"End date: {end_date_str}")
     
-    # Словарь соответствия полных названий и сокращений
-    task_type_mapping = {
-        'Nawiązać pierwszy kontakt': 'WDM',
-        'Przeprowadzić pierwszą rozmowę telefoniczną': 'PRZ',
-        'Zadzwonić do klienta': 'ZKL',
-        'Przeprowadzić spotkanie': 'SPT',
-        'Wysłać materiały': 'MAT',
-        'Odpowiedzieć na pytanie techniczne': 'TPY',
-        'Zapisać na media społecznościowe': 'MSP',
-        'Opowiedzieć o nowościach': 'NOW',
-        'Zebrać opinie': 'OPI',
-        'Przywrócić klienta': 'WRK',
-        'Tworzyć kontent': 'KNT'
-    }
-    
-    # Основной KPI-запрос
-    query = f"""
+    # Основной KPI-запрос: тип задачи — kpi_code, заполненный экспортером (core.task_types)
+    query = """
         WITH task_counts AS (
             SELECT
                 owner_name AS manager,
-                CASE 
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Nawiązać pierwszy kontakt' THEN 'WDM'
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Przeprowadzić pierwszą rozmowę telefoniczną' THEN 'PRZ'
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Zadzwonić do klienta' THEN 'ZKL'
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Przeprowadzić spotkanie' THEN 'SPT'
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Wysłać materiały' THEN 'MAT'
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Odpowiedzieć na pytanie techniczne' THEN 'TPY'
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Zapisać na media społecznościowe' THEN 'MSP'
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Opowiedzieć o nowościach' THEN 'NOW'
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Zebrać opinie' THEN 'OPI'
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Przywrócić klienta' THEN 'WRK'
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Tworzyć kontent' THEN 'KNT'
-                    ELSE NULL
-                END AS task_type,
-                CASE 
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Nawiązać pierwszy kontakt' THEN 1
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Przeprowadzić pierwszą rozmowę telefoniczną' THEN 2
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Zadzwonić do klienta' THEN 4
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Przeprowadzić spotkanie' THEN 5
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Wysłać materiały' THEN 6
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Odpowiedzieć na pytanie techniczne' THEN 7
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Zapisać na media społecznościowe' THEN 8
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Opowiedzieć o nowościach' THEN 9
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Zebrać opinie' THEN 10
-                    WHEN TRIM(SPLIT_PART(title, ' /', 1)) = 'Przywrócić klienta' THEN 11
-                    ELSE 12
-                END AS task_order,
+                kpi_code AS task_type,
                 COUNT(*) AS task_count
             FROM planfix_tasks
             WHERE
@@ -179,30 +118,14 @@ def count_tasks_by_type(start_date_str: str, end_date_str: str) -> list:
                 AND data_zakonczenia_zadania >= %s::timestamp
                 AND data_zakonczenia_zadania < %s::timestamp
                 AND owner_name IN %s
+                AND kpi_code IS NOT NULL
                 AND is_deleted = false
-                AND TRIM(SPLIT_PART(title, ' /', 1)) IN (
-                    'Nawiązać pierwszy kontakt',
-                    'Przeprowadzić pierwszą rozmowę telefoniczną',
-                    'Zadzwonić do klienta',
-                    'Przeprowadzić spotkanie',
-                    'Wysłać materiały',
-                    'Odpowiedzieć na pytanie techniczne',
-                    'Zapisać na media społecznościowe',
-                    'Opowiedzieć o nowościach',
-                    'Zebrać opinie',
-                    'Przywrócić klienta',
-                    'Tworzyć kontent'
-                )
-            GROUP BY
-                owner_name, 
-                task_type,
-                task_order
+            GROUP BY owner_name, kpi_code
         ),
         kzi_counts AS (
             SELECT
                 owner_name AS manager,
                 'KZI' AS task_type,
-                3 AS task_order,
                 COUNT(*) AS task_count
             FROM planfix_tasks
             WHERE
@@ -210,9 +133,9 @@ def count_tasks_by_type(start_date_str: str, end_date_str: str) -> list:
                 AND data_zakonczenia_zadania >= %s::timestamp
                 AND data_zakonczenia_zadania < %s::timestamp
                 AND owner_name IN %s
+                AND kpi_code = 'PRZ'
+                AND wynik = %s
                 AND is_deleted = false
-                AND TRIM(SPLIT_PART(title, ' /', 1)) = 'Przeprowadzić pierwszą rozmowę telefoniczną'
-                AND wynik = 'Klient jest zainteresowany'
             GROUP BY owner_name
         )
         SELECT 
@@ -224,10 +147,13 @@ def count_tasks_by_type(start_date_str: str, end_date_str: str) -> list:
             UNION ALL
             SELECT * FROM kzi_counts
         ) combined_results
-        WHERE task_type IS NOT NULL
-        ORDER BY manager, task_order;
+        ORDER BY manager, array_position(%s::text[], task_type);
     """
-    results = _execute_kpi_query(query, (start_date_str, end_date_str, PLANFIX_USER_NAMES, start_date_str, end_date_str, PLANFIX_USER_NAMES), "tasks by type")
+    results = _execute_kpi_query(query, (
+        start_date_str, end_date_str, PLANFIX_USER_NAMES,
+        start_date_str, end_date_str, PLANFIX_USER_NAMES, KZI_RESULT,
+        TASK_REPORT_ORDER
+    ), "tasks by type")
     logger.info(f"Task results: {results}")
     return results
 
@@ -258,7 +184,7 @@ def count_offers(start_date_str: str, end_date_str: str) -> list:
         SELECT 
             menedzher,
             data_wyslania_oferty,
-            TO_TIMESTAMP(data_wyslania_oferty, 'DD-MM-YYYY HH24:MI') as parsed_date
+            data_wyslania_oferty_ts as parsed_date
         FROM planfix_orders
         WHERE menedzher IN %s
         AND data_wyslania_oferty IS NOT NULL
@@ -277,10 +203,8 @@ def count_offers(start_date_str: str, end_date_str: str) -> list:
         FROM
             planfix_orders
         WHERE
-            data_wyslania_oferty IS NOT NULL
-            AND data_wyslania_oferty != ''
-            AND TO_TIMESTAMP(data_wyslania_oferty, 'DD-MM-YYYY HH24:MI') >= %s::timestamp
-            AND TO_TIMESTAMP(data_wyslania_oferty, 'DD-MM-YYYY HH24:MI') < %s::timestamp
+            data_wyslania_oferty_ts >= %s::timestamp
+            AND data_wyslania_oferty_ts < %s::timestamp
             AND menedzher IN %s
             AND is_deleted = false
             AND wartosc_netto_pln IS NOT NULL
@@ -322,8 +246,8 @@ def count_orders(start_date_str: str, end_date_str: str) -> list:
             data_potwierdzenia_zamowienia,
             data_realizacji,
             wartosc_netto_pln,
-            TO_TIMESTAMP(data_potwierdzenia_zamowienia, 'DD-MM-YYYY HH24:MI') as parsed_confirmation_date,
-            TO_TIMESTAMP(data_realizacji, 'DD-MM-YYYY HH24:MI') as parsed_realization_date
+            data_potwierdzenia_zamowienia_ts as parsed_confirmation_date,
+            data_realizacji_ts as parsed_realization_date
         FROM planfix_orders
         WHERE menedzher IN %s
         AND (data_potwierdzenia_zamowienia IS NOT NULL OR data_realizacji IS NOT NULL)
@@ -345,23 +269,19 @@ def count_orders(start_date_str: str, end_date_str: str) -> list:
             SELECT
                 menedzher AS manager_name, COUNT(*) AS order_count, 0 AS total_amount
             FROM planfix_orders
-            WHERE data_potwierdzenia_zamowienia IS NOT NULL AND data_potwierdzenia_zamowienia != ''
-                AND TO_TIMESTAMP(data_potwierdzenia_zamowienia, 'DD-MM-YYYY HH24:MI') >= %s::timestamp
-                AND TO_TIMESTAMP(data_potwierdzenia_zamowienia, 'DD-MM-YYYY HH24:MI') < %s::timestamp
+            WHERE data_potwierdzenia_zamowienia_ts >= %s::timestamp
+                AND data_potwierdzenia_zamowienia_ts < %s::timestamp
                 AND menedzher IN %s
                 AND is_deleted = false
-                AND wartosc_netto_pln IS NOT NULL
-                AND TRIM(wartosc_netto_pln) != ''
-                AND COALESCE(NULLIF(CAST(REPLACE(REPLACE(REGEXP_REPLACE(wartosc_netto_pln, '[^0-9,.-]', '', 'g'), ',', '.'), ' ', '') AS DECIMAL), 0), 0) != 0
+                AND wartosc_netto_pln_num != 0
             GROUP BY menedzher
             UNION ALL
             SELECT
                 menedzher AS manager_name, 0 AS order_count,
-                COALESCE(SUM(NULLIF(REPLACE(REPLACE(wartosc_netto_pln, ' ', ''), ',', '.'), '')::DECIMAL(10,2)), 0) AS total_amount
+                COALESCE(SUM(ROUND(wartosc_netto_pln_num, 2)), 0) AS total_amount
             FROM planfix_orders
-            WHERE data_realizacji IS NOT NULL AND data_realizacji != ''
-                AND TO_TIMESTAMP(data_realizacji, 'DD-MM-YYYY HH24:MI') >= %s::timestamp
-                AND TO_TIMESTAMP(data_realizacji, 'DD-MM-YYYY HH24:MI') < %s::timestamp
+            WHERE data_realizacji_ts >= %s::timestamp
+                AND data_realizacji_ts < %s::timestamp
                 AND menedzher IN %s
                 AND is_deleted = false
             GROUP BY menedzher
@@ -380,27 +300,24 @@ def count_client_statuses(start_date_str: str, end_date_str: str) -> list:
         WITH client_statuses AS (
             SELECT menedzer AS manager, 'NWI' as status, COUNT(*) as count
             FROM planfix_clients
-            WHERE data_dodania_do_nowi IS NOT NULL AND data_dodania_do_nowi != ''
-                AND TO_DATE(data_dodania_do_nowi, 'DD-MM-YYYY') >= %s::date
-                AND TO_DATE(data_dodania_do_nowi, 'DD-MM-YYYY') < %s::date
+            WHERE data_dodania_do_nowi_date >= %s::date
+                AND data_dodania_do_nowi_date < %s::date
                 AND menedzer IN %s
                 AND is_deleted = false
             GROUP BY menedzer
             UNION ALL
             SELECT menedzer AS manager, 'WTR' as status, COUNT(*) as count
             FROM planfix_clients
-            WHERE data_dodania_do_w_trakcie IS NOT NULL AND data_dodania_do_w_trakcie != ''
-                AND TO_DATE(data_dodania_do_w_trakcie, 'DD-MM-YYYY') >= %s::date
-                AND TO_DATE(data_dodania_do_w_trakcie, 'DD-MM-YYYY') < %s::date
+            WHERE data_dodania_do_w_trakcie_date >= %s::date
+                AND data_dodania_do_w_trakcie_date < %s::date
                 AND menedzer IN %s
                 AND is_deleted = false
             GROUP BY menedzer
             UNION ALL
             SELECT menedzer AS manager, 'PSK' as status, COUNT(*) as count
             FROM planfix_clients
-            WHERE data_dodania_do_perspektywiczni IS NOT NULL AND data_dodania_do_perspektywiczni != ''
-                AND TO_DATE(data_dodania_do_perspektywiczni, 'DD-MM-YYYY') >= %s::date
-                AND TO_DATE(data_dodania_do_perspektywiczni, 'DD-MM-YYYY') < %s::date
+            WHERE data_dodania_do_perspektywiczni_date >= %s::date
+                AND data_dodania_do_perspektywiczni_date < %s::date
                 AND menedzer IN %s
                 AND is_deleted = false
             GROUP BY menedzer
@@ -413,9 +330,43 @@ def count_client_statuses(start_date_str: str, end_date_str: str) -> list:
         start_date_str.split(' ')[0], end_date_str.split(' ')[0], PLANFIX_USER_NAMES
     ), "client statuses")
 
+def collect_report_results(start_date_str: str, end_date_str: str) -> tuple:
+    """
+    Результаты (задачи, предложения, заказы, клиенты) за период в формате count_* функций.
+    Если дневные агрегаты kpi_daily_facts готовы, они суммируются за дни периода,
+    иначе запросы идут к исходным таблицам.
+    """
+    if not daily_facts_ready():
+        logger.info("Daily KPI facts are not ready, aggregating raw tables")
+        return (
+            count_tasks_by_type(start_date_str, end_date_str),
+            count_offers(start_date_str, end_date_str),
+            count_orders(start_date_str, end_date_str),
+            count_client_statuses(start_date_str, end_date_str),
+        )
+
+    # В planfix_orders менеджер записан ID, в остальных таблицах — именем
+    order_manager_ids = tuple(str(manager_id) for manager_id in PLANFIX_USER_IDS)
+    first_day, last_day = period_days(start_date_str, end_date_str)
+    totals = get_daily_totals(first_day, last_day, PLANFIX_USER_NAMES + order_manager_ids)
 
-def send_to_telegram(task_results, offer_results, order_results, client_results, report_type):
-    """Send KPI report to Telegram."""
+    task_results, client_results, offer_results, order_results = [], [], [], []
+    for manager in sorted(PLANFIX_USER_NAMES):
+        codes = totals.get(manager, {})
+        task_results.extend((manager, code, codes[code][0]) for code in TASK_REPORT_ORDER if code in codes)
+        client_results.extend((manager, status, codes[status][0]) for status in ('NWI', 'PSK', 'WTR') if status in codes)
+    for manager_id in order_manager_ids:
+        codes = totals.get(manager_id, {})
+        if 'OFW' in codes:
+            offer_results.append((manager_id, codes['OFW'][0]))
+        if 'ZAM' in codes or 'PRC' in codes:
+            order_results.append((manager_id, codes.get('ZAM', (0, 0))[0], codes.get('PRC', (0, 0))[1]))
+    logger.info(f"Daily facts results: tasks={task_results}, offers={offer_results}, orders={order_results}, clients={client_results}")
+    return task_results, offer_results, order_results, client_results
+
+
+def format_kpi_report(task_results, offer_results, order_results, client_results, report_type) -> str:
+    """Format KPI report message (Markdown code block) from count_* results."""
     try:
         logger.info(f"=== Processing results for {report_type} report ===")
         logger.info(f"Task results: {task_results}")
@@ -519,7 +470,7 @@ def send_to_telegram(task_results, offer_results, order_results, client_results,
                     message += f'{status:<3} |{kozik_count:7d} |{stukalo_count:7d}\n'
             message += f'{mid_line}\n'
             message += 'zadania\n'
-            task_order = ['WDM', 'PRZ', 'KZI', 'ZKL', 'SPT', 'MAT', 'TPY', 'MSP', 'NOW', 'OPI', 'WRK', 'KNT']
+            task_order = TASK_REPORT_ORDER
             for task_type in task_order:
                 kozik_count = data['Kozik Andrzej'][task_type]
                 stukalo_count = data['Stukalo Nazarii'][task_type]
@@ -555,7 +506,7 @@ def send_to_telegram(task_results, offer_results, order_results, client_results,
                     message += f'{status:<3} |{kozik_count:7d} |{stukalo_count:7d}\n'
             message += f'{mid_line}\n'
             message += 'zadania\n'
-            task_order = ['WDM', 'PRZ', 'KZI', 'ZKL', 'SPT', 'MAT', 'TPY', 'MSP', 'NOW', 'OPI', 'WRK', 'KNT']
+            task_order = TASK_REPORT_ORDER
             for task_type in task_order:
                 kozik_count = data['Kozik Andrzej'][task_type]
                 stukalo_count = data['Stukalo Nazarii'][task_type]
@@ -575,33 +526,24 @@ def send_to_telegram(task_results, offer_results, order_results, client_results,
                 if kozik_count > 0 or stukalo_count > 0:
                     message += f'{order_type:<3} |{kozik_count:7d} |{stukalo_count:7d}\n'
             message += f'{top_line}\n```'
-        
-        # Send to Telegram
-        bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
-        chat_id = os.environ.get('TELEGRAM_CHAT_ID')
-        
-        if not bot_token or not chat_id:
-            logger.error("Missing Telegram configuration")
-            return
-            
-        url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-        payload = {
-            'chat_id': chat_id,
-            'text': message,
-            'parse_mode': 'Markdown'
-        }
-        
-        response = requests.post(url, json=payload, timeout=10)
-        if response.status_code != 200:
-            logger.error(f"Failed to send message to Telegram: {response.text}")
-        else:
-            logger.info("Message sent successfully to Telegram")
-            
+        return message
+
     except Exception as e:
-        logger.error(f"Error sending to Telegram: {str(e)}")
+        logger.error(f"Error formatting KPI report: {str(e)}")
         raise
 
 
+def build_kpi_messages() -> list:
+    """Daily and monthly KPI report messages (without sending)."""
+    messages = []
+    for report_type in ('daily', 'monthly'):
+        logger.info(f"Generating {report_type} KPI report.")
+        start_date_str, end_date_str = get_date_range(report_type)
+        tasks, offers, orders, clients = collect_report_results(start_date_str, end_date_str)
+        messages.append(format_kpi_report(tasks, offers, orders, clients, report_type))
+    return messages
+
+
 def get_date_range(report_type: str) -> tuple[str, str]:
     today = date.today()
     if report_type == 'daily':
@@ -624,12 +566,12 @@ def get_date_range(report_type: str) -> tuple[str, str]:
 
 def check_kpi_coverage():
     """Проверяет, что все KPI из ALL_KPI есть в структуре отчёта и в базе."""
-    conn = None
     try:
-        conn = psycopg2.connect(host=PG_HOST, dbname=PG_DB, user=PG_USER, password=PG_PASSWORD, port=PG_PORT)
-        cur = conn.cursor()
-        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'kpi_metrics';")
-        columns = [row[0].lower() for row in cur.fetchall()]
+        rows = execute_query(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = 'kpi_metrics';",
+            (), "kpi_metrics columns"
+        )
+        columns = [row[0].lower() for row in rows]
         missing_in_db = [kpi.lower() for kpi in ALL_KPI if kpi.lower() not in columns]
         if missing_in_db:
             logger.warning(f"KPI отсутствуют в таблице kpi_metrics: {missing_in_db}")
@@ -637,9 +579,6 @@ def check_kpi_coverage():
             logger.info("Все KPI присутствуют в таблице kpi_metrics.")
     except Exception as e:
         logger.error(f"Ошибка при проверке структуры kpi_metrics: {e}")
-    finally:
-        if conn:
-            conn.close()
     # Проверка структуры отчёта (data, task_order, client_order, order_order)
     # Проверяем, что все KPI есть в форматировании отчёта
     report_kpi = set(['NWI', 'WTR', 'PSK', 'WDM', 'PRZ', 'KZI', 'ZKL', 'SPT', 'MAT', 'TPY', 'MSP', 'NOW', 'OPI', 'WRK', 'KNT', 'TTL', 'OFW', 'ZAM', 'PRC'])
@@ -661,23 +600,9 @@ if __name__ == "__main__":
         _check_env_vars() # Check environment variables and manager config
         check_kpi_coverage() # Проверка покрытия KPI
 
-        # Send daily report
-        logger.info("Generating daily KPI report.")
-        start_daily, end_daily = get_date_range('daily')
-        tasks_daily = count_tasks_by_type(start_daily, end_daily)
-        offers_daily = count_offers(start_daily, end_daily)
-        orders_daily = count_orders(start_daily, end_daily)
-        clients_daily = count_client_statuses(start_daily, end_daily)
-        send_to_telegram(tasks_daily, offers_daily, orders_daily, clients_daily, 'daily')
-        
-        # Send monthly report
-        logger.info("Generating monthly KPI report.")
-        start_monthly, end_monthly = get_date_range('monthly')
-        tasks_monthly = count_tasks_by_type(start_monthly, end_monthly)
-        offers_monthly = count_offers(start_monthly, end_monthly)
-        orders_monthly = count_orders(start_monthly, end_monthly)
-        clients_monthly = count_client_statuses(start_monthly, end_monthly)
-        send_to_telegram(tasks_monthly, offers_monthly, orders_monthly, clients_monthly, 'monthly')
+        # Daily and monthly reports
+        for message in build_kpi_messages():
+            send_to_telegram(message)
             
         logger.info("KPI Telegram report script finished successfully.")
 
@@ -1,6 +1,6 @@
+import argparse
 import psycopg2
 import psycopg2.extras
-import requests
 from datetime import datetime, date, timedelta
 import os
 import logging
@@ -11,35 +11,13 @@ import hashlib
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 from core.config import MANAGERS_KPI
 from core.kpi_utils import math_round
+from core.client_funnel import ClientFunnel, CLIENT_STATUSES
+from utils.db_pool import get_connection
+from utils.telegram_client import send_to_telegram
 
 # Load environment variables from .env file
 load_dotenv()
 
-def count_workdays(start_date, end_date):
-    """
-    Подсчитывает количество рабочих дней между двумя датами (исключая выходные).
-    
-    Args:
-        start_date: дата начала (date)
-        end_date: дата окончания (date)
-    
-    Returns:
-        int: количество рабочих дней
-    """
-    if start_date > end_date:
-        return 0
-    
-    workdays = 0
-    current_date = start_date
-    
-    while current_date <= end_date:
-        # Понедельник = 0, Воскресенье = 6
-        if current_date.weekday() < 5:  # 0-4 = понедельник-пятница
-            workdays += 1
-        current_date += timedelta(days=1)
-    
-    return workdays
-
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -47,43 +25,10 @@ logging.basicConfig(
     handlers=[logging.StreamHandler()]
 )
 
-PG_HOST = os.environ.get('SUPABASE_HOST')
-PG_DB = os.environ.get('SUPABASE_DB')
-PG_USER = os.environ.get('SUPABASE_USER')
-PG_PASSWORD = os.environ.get('SUPABASE_PASSWORD')
-PG_PORT = os.environ.get('SUPABASE_PORT')
-TELEGRAM_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
-CHAT_ID = os.environ.get('TELEGRAM_CHAT_ID')
-
 HISTORY_TABLE_NAME = "report_clients_status_history"
+SNAPSHOT_TABLE_NAME = "report_clients_funnel_snapshots"
 logger = logging.getLogger(__name__)
 
-# Статусы клиентов и их порядок в отчёте
-CLIENT_STATUSES = ['NWI', 'WTR', 'PSK', 'PIZ', 'STL', 'NAK', 'REZ', 'BRK', 'ARC']
-
-# Сопоставление для статусов, чья логика НЕ зависит от дат (кроме STL)
-STATUS_MAPPING = {
-    'Nowi': 'NWI',
-    'W trakcie': 'WTR',
-    'Perspektywiczni': 'PSK',
-    'Pierwsze zamówienie': 'PIZ',
-    'Stali klienci': 'STL',
-    'Rezygnacja': 'REZ',
-    'Brak kontaktu': 'BRK',
-    'Archiwum': 'ARC'
-}
-
-# Сопоставление статусов с их полем даты для расчета ПРИТОКА
-STATUS_INFLOW_DATE_COLS = {
-    'NWI': 'data_dodania_do_nowi',
-    'WTR': 'data_dodania_do_w_trakcie',
-    'PSK': 'data_dodania_do_perspektywiczni',
-    'PIZ': 'data_pierwszego_zamowienia',
-    'REZ': 'data_dodania_do_rezygnacja',
-    'BRK': 'data_dodania_do_brak_kontaktu',
-    'ARC': 'data_dodania_do_archiwum',
-}
-
 def _execute_query(conn, query: str, params: tuple = (), description: str = "") -> list:
     """Выполняет запрос с использованием существующего соединения."""
     try:
@@ -149,6 +94,131 @@ def get_statuses_from_history(conn, report_date: date, manager: str) -> dict:
             statuses[status] = count
     return statuses
 
+def create_snapshot_table_if_not_exists(conn):
+    """Создает таблицу дневных снимков воронки: остаток, приток и отток по каждому статусу."""
+    query = f"""
+    CREATE TABLE IF NOT EXISTS {SNAPSHOT_TABLE_NAME} (
+        snapshot_date DATE NOT NULL,
+        manager TEXT NOT NULL,
+        status TEXT NOT NULL,
+        current_count INTEGER NOT NULL,
+        inflow INTEGER NOT NULL,
+        outflow INTEGER NOT NULL,
+        updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY (snapshot_date, manager, status)
+    );
+    """
+    try:
+        with conn.cursor() as cur:
+            logger.info(f"Checking/Creating funnel snapshot table: {SNAPSHOT_TABLE_NAME}...")
+            cur.execute(query)
+            conn.commit()
+            logger.info(f"Table {SNAPSHOT_TABLE_NAME} is ready.")
+    except psycopg2.Error as e:
+        logger.error(f"Error creating snapshot table: {e}")
+        conn.rollback()
+        raise
+
+def snapshot_records(snapshot_date: date, manager: str, totals: dict, inflow: dict, outflow: dict) -> list:
+    """Строки снимка воронки менеджера за день — по одной на каждый статус из CLIENT_STATUSES."""
+    return [
+        (snapshot_date, manager, status, totals.get(status, 0), inflow.get(status, 0), outflow.get(status, 0))
+        for status in CLIENT_STATUSES
+    ]
+
+def save_funnel_snapshots(conn, records: list):
+    """Сохраняет строки снимков воронки одним пакетным INSERT ... ON CONFLICT."""
+    if not records:
+        return
+    query = f"""
+    INSERT INTO {SNAPSHOT_TABLE_NAME} (snapshot_date, manager, status, current_count, inflow, outflow)
+    VALUES %s
+    ON CONFLICT (snapshot_date, manager, status) DO UPDATE SET
+        current_count = EXCLUDED.current_count,
+        inflow = EXCLUDED.inflow,
+        outflow = EXCLUDED.outflow,
+        updated_at = NOW();
+    """
+    try:
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(cur, query, records, page_size=1000)
+            conn.commit()
+            logger.info(f"Saved {len(records)} funnel snapshot records.")
+    except psycopg2.Error as e:
+        logger.error(f"Error saving funnel snapshots: {e}")
+        conn.rollback()
+        raise
+
+def get_funnel_snapshot(conn, snapshot_date: date, manager: str, taken_after: datetime = None):
+    """
+    Возвращает сохраненный снимок воронки (totals, inflow, outflow) за день
+    или None, если снимка нет (или он записан раньше taken_after).
+    """
+    query = f"SELECT status, current_count, inflow, outflow, updated_at FROM {SNAPSHOT_TABLE_NAME} WHERE snapshot_date = %s AND manager = %s;"
+    results = _execute_query(conn, query, (snapshot_date, manager), f"funnel snapshot for {manager} on {snapshot_date}")
+    if not results:
+        return None
+    if taken_after and any(updated_at < taken_after for *_, updated_at in results):
+        logger.info(f"Funnel snapshot for {manager} on {snapshot_date} was taken before {taken_after}, ignoring it")
+        return None
+    totals = {status: 0 for status in CLIENT_STATUSES}
+    inflow = {status: 0 for status in CLIENT_STATUSES}
+    outflow = {status: 0 for status in CLIENT_STATUSES}
+    for status, current_count, status_inflow, status_outflow, _ in results:
+        if status in totals:
+            totals[status] = current_count
+            inflow[status] = status_inflow
+            outflow[status] = status_outflow
+    return totals, inflow, outflow
+
+def reconstruct_funnel_snapshot(funnel: ClientFunnel, snapshot_date: date) -> (dict, dict, dict):
+    """
+    Восстанавливает снимок воронки за прошедший день: остатки — по датам статусов
+    на snapshot_date, приток и отток — относительно предыдущего рабочего дня.
+    """
+    report_date, last_workday = get_comparison_dates(snapshot_date)
+    totals = funnel.totals_on(report_date)
+    inflow, outflow = funnel.flows(last_workday, report_date)
+    return totals, inflow, outflow
+
+def backfill_funnel_snapshots(conn, start_date: date, end_date: date):
+    """Заполняет снимки воронки за рабочие дни диапазона (включительно) для всех менеджеров."""
+    create_snapshot_table_if_not_exists(conn)
+    workdays = [
+        start_date + timedelta(days=offset)
+        for offset in range((end_date - start_date).days + 1)
+        if (start_date + timedelta(days=offset)).weekday() < 5
+    ]
+    if not workdays:
+        logger.info(f"No workdays between {start_date} and {end_date}, nothing to backfill.")
+        return
+    for manager in (m['planfix_user_name'] for m in MANAGERS_KPI if m['planfix_user_name']):
+        funnel = ClientFunnel.load(conn, manager)
+        # Остатки за весь диапазон — одним векторным проходом
+        daily_totals = funnel.daily_totals(workdays[0], workdays[-1])
+        records = []
+        for day in workdays:
+            _, last_workday = get_comparison_dates(day)
+            inflow, outflow = funnel.flows(last_workday, day)
+            records.extend(snapshot_records(day, manager, daily_totals[day], inflow, outflow))
+        save_funnel_snapshots(conn, records)
+        logger.info(f"Backfilled {len(workdays)} funnel snapshots for {manager} ({workdays[0]} - {workdays[-1]}).")
+
+def get_comparison_dates(today: date) -> (date, date):
+    """
+    Возвращает (report_date, last_workday): день, за который считается движение,
+    и последний рабочий день для сравнения.
+    Понедельник (0) → сравниваем с пятницей (-3 дня)
+    Вторник-пятница (1-4) → сравниваем со вчера (-1 день)
+    Суббота/воскресенье (5-6) → показываем данные за пятницу (сравниваем с четвергом)
+    """
+    if today.weekday() == 0:  # Понедельник
+        return today, today - timedelta(days=3)  # Пятница
+    if today.weekday() >= 5:  # Суббота или воскресенье
+        days_since_friday = today.weekday() - 4
+        report_date = today - timedelta(days=days_since_friday)  # Пятница
+        return report_date, report_date - timedelta(days=1)  # Четверг
+    return today, today - timedelta(days=1)  # Вторник-пятница
 
 def get_current_statuses_and_inflow(conn, manager: str, today: date) -> (dict, dict, dict):
     """
@@ -157,370 +227,28 @@ def get_current_statuses_and_inflow(conn, manager: str, today: date) -> (dict, d
     2. Дневной приток клиентов (для статусов с датой входа).
     3. Дневной отток клиентов (для статусов с датой выхода).
     """
+    # Все клиенты менеджера загружаются одним запросом, дальше расчет идет в памяти
+    funnel = ClientFunnel.load(conn, manager)
+
     # 1. Рассчитываем АБСОЛЮТНЫЕ значения на сегодня
-    query = "SELECT status_wspolpracy, data_ostatniego_zamowienia FROM planfix_clients WHERE menedzer = %s AND is_deleted = false AND status_wspolpracy IS NOT NULL AND status_wspolpracy != ''"
-    params = (manager,)
-    results = _execute_query(conn, query, params, f"current statuses for {manager}")
+    current_totals = funnel.current_totals(today)
 
-    current_totals = {status: 0 for status in CLIENT_STATUSES}
-    
-    for full_status, last_order_date in results:
-        status_clean = full_status.strip()
-        
-        # ПРИОРИТЕТ 1: STL/NAK (если status_wspolpracy = 'Stali klienci')
-        if status_clean == 'Stali klienci':
-            workdays_diff = float('inf')
-            if last_order_date and last_order_date.strip():
-                try:
-                    order_date = datetime.strptime(last_order_date.strip()[:10], '%d-%m-%Y').date()
-                    workdays_diff = count_workdays(order_date, today)
-                except (ValueError, TypeError):
-                    workdays_diff = float('inf')
-            short_status = 'STL' if workdays_diff <= 30 else 'NAK'
-        # ПРИОРИТЕТ 2: PIZ (если status_wspolpracy = 'Pierwsze zamówienie')
-        elif status_clean == 'Pierwsze zamówienie':
-            short_status = 'PIZ'
-        # ПРИОРИТЕТ 3: Остальные статусы по STATUS_MAPPING
-        else:
-            short_status = STATUS_MAPPING.get(status_clean)
-
-        if short_status and short_status in current_totals:
-            current_totals[short_status] += 1
-            
     # 2. Рассчитываем ДНЕВНОЙ ПРИТОК и ОТТОК 
     # Комбинированная логика:
     # - Для клиентов с переходами СЕГОДНЯ: считаем все переходы
     # - Для остальных клиентов: сравниваем с последним рабочим днем
-    daily_inflow = {status: 0 for status in CLIENT_STATUSES}
-    daily_outflow = {status: 0 for status in CLIENT_STATUSES}
-    
-    # Определяем последний рабочий день для сравнения
-    # Понедельник (0) → сравниваем с пятницей (-3 дня)
-    # Вторник-пятница (1-4) → сравниваем со вчера (-1 день)
-    # Суббота/воскресенье (5-6) → показываем данные за пятницу
-    is_weekend_report = False
-    report_date = today
-    
-    if today.weekday() == 0:  # Понедельник
-        last_workday = today - timedelta(days=3)  # Пятница
-    elif today.weekday() >= 5:  # Суббота или воскресенье
-        # В выходные показываем отчет за пятницу
-        is_weekend_report = True
-        days_since_friday = today.weekday() - 4
-        report_date = today - timedelta(days=days_since_friday)  # Пятница
-        last_workday = report_date - timedelta(days=1)  # Четверг
+
+    report_date, last_workday = get_comparison_dates(today)
+    if report_date != today:
         logger.info(f"⚠️ Weekend report: showing data for Friday {report_date} (comparing with Thursday {last_workday})")
-    else:  # Вторник-пятница
-        last_workday = today - timedelta(days=1)
-    
-    if not is_weekend_report:
+    else:
         logger.info(f"Comparing {today} (weekday={today.weekday()}) with last workday: {last_workday}")
     
-    # Получаем списки клиентов по статусам на последний рабочий день и report_date
     # В выходные report_date = пятница, в остальные дни = today
-    yesterday_clients = get_clients_by_status_for_date(conn, manager, last_workday)
-    today_clients = get_clients_by_status_for_date(conn, manager, report_date)
-    
-    # Находим всех активных клиентов (вчера или сегодня)
-    all_active_clients = set()
-    for status_set in today_clients.values():
-        all_active_clients.update(status_set)
-    for status_set in yesterday_clients.values():
-        all_active_clients.update(status_set)
-    
-    # Для каждого активного клиента проверяем его переходы
-    for client_id in all_active_clients:
-        # Получаем все переходы клиента за report_date (сегодня или пятница в выходные)
-        transitions = get_daily_transitions_for_client(conn, manager, client_id, report_date)
-        
-        # Находим где клиент был вчера и где сегодня
-        yesterday_status = None
-        today_status = None
-        
-        for status in CLIENT_STATUSES:
-            if client_id in yesterday_clients.get(status, set()):
-                yesterday_status = status
-            if client_id in today_clients.get(status, set()):
-                today_status = status
-        
-        # Проверяем, новый ли это клиент в системе
-        was_in_system_yesterday = yesterday_status is not None
-        is_new_client = not was_in_system_yesterday and today_status is not None
-        
-        # Если это новый клиент, ВСЕГДА добавляем его в первый статус
-        if is_new_client:
-            # Получаем данные клиента из базы для поиска первого статуса
-            query_first_status = """
-            SELECT data_dodania_do_nowi, data_dodania_do_w_trakcie,
-                   data_dodania_do_perspektywiczni, data_pierwszego_zamowienia
-            FROM planfix_clients WHERE id = %s
-            """
-            result = _execute_query(conn, query_first_status, (client_id,), "first status")
-            
-            if result:
-                dates = result[0]
-                status_dates = {
-                    'NWI': dates[0],
-                    'WTR': dates[1],
-                    'PSK': dates[2],
-                    'PIZ': dates[3]
-                }
-                
-                # Ищем самую раннюю дату (первый статус)
-                earliest_status = None
-                earliest_date = None
-                
-                for status, date_str in status_dates.items():
-                    if date_str and date_str.strip():
-                        try:
-                            date_obj = datetime.strptime(date_str.strip()[:10], '%d-%m-%Y').date()
-                            if earliest_date is None or date_obj < earliest_date:
-                                earliest_date = date_obj
-                                earliest_status = status
-                        except:
-                            continue
-                
-                # Добавляем inflow в первый статус, если он не в transitions
-                if earliest_status and earliest_status not in transitions:
-                    daily_inflow[earliest_status] += 1
-                    # Outflow только если первый статус != текущий статус
-                    if earliest_status != today_status:
-                        daily_outflow[earliest_status] += 1
-        
-        if transitions:
-            # Если есть переходы сегодня, считаем inflow по всей цепочке
-            for i, status in enumerate(transitions):
-                daily_inflow[status] += 1
-                # Outflow для всех кроме последнего в цепочке
-                if i < len(transitions) - 1:
-                    daily_outflow[status] += 1
-        else:
-            # Если нет переходов сегодня и не новый клиент
-            if not is_new_client:
-                # Если статус изменился - считаем inflow
-                if yesterday_status != today_status and today_status:
-                    daily_inflow[today_status] += 1
-                    
-        # OUTFLOW считаем ВСЕГДА по сравнению вчера/сегодня
-        if yesterday_status and yesterday_status != today_status:
-            # Только если клиент НЕ в цепочке переходов (чтобы не дублировать)
-            if not transitions or yesterday_status not in transitions:
-                daily_outflow[yesterday_status] += 1
-                
+    daily_inflow, daily_outflow = funnel.flows(last_workday, report_date)
 
     return current_totals, daily_inflow, daily_outflow
 
-def get_client_status_on_date(client_data, target_date):
-    """Определяет, в каком статусе был клиент на определенную дату"""
-    
-    # ПРИОРИТЕТ 1: STL/NAK (если status_wspolpracy = 'Stali klienci')
-    # НО ТОЛЬКО если второй заказ был ДО target_date!
-    if client_data.get('status_wspolpracy') == 'Stali klienci':
-        last_order_date = client_data.get('data_ostatniego_zamowienia')
-        if last_order_date and last_order_date.strip():
-            try:
-                order_date = datetime.strptime(last_order_date.strip()[:10], '%d-%m-%Y').date()
-                # Если последний заказ ПОСЛЕ target_date → клиент ЕЩЕ НЕ БЫЛ в STL/NAK
-                if order_date > target_date:
-                    # Используем обычную логику по датам (PIZ и т.д.)
-                    pass
-                else:
-                    # Последний заказ БЫЛ до target_date → клиент УЖЕ в STL/NAK
-                    workdays_diff = count_workdays(order_date, target_date)
-                    return 'STL' if workdays_diff <= 30 else 'NAK'
-            except:
-                return 'NAK'
-        else:
-            return 'NAK'
-    
-    # ПРИОРИТЕТ 2: Остальные статусы по датам
-    # Порядок статусов в воронке (важно для случаев с одинаковыми датами)
-    status_order = ['NWI', 'WTR', 'PSK', 'PIZ', 'REZ', 'BRK', 'ARC']
-    
-    # Собираем все даты статусов (кроме STL/NAK)
-    status_dates = {
-        'NWI': client_data.get('data_dodania_do_nowi'),
-        'WTR': client_data.get('data_dodania_do_w_trakcie'),
-        'PSK': client_data.get('data_dodania_do_perspektywiczni'),
-        'PIZ': client_data.get('data_pierwszego_zamowienia'),
-        'REZ': client_data.get('data_dodania_do_rezygnacja'),
-        'BRK': client_data.get('data_dodania_do_brak_kontaktu'),
-        'ARC': client_data.get('data_dodania_do_archiwum')
-    }
-    
-    # Находим самую последнюю дату, которая <= target_date
-    # Если даты одинаковые, выбираем статус, который идет ПОЗЖЕ в воронке
-    latest_date = None
-    status_on_date = None
-    
-    for status, date_str in status_dates.items():
-        if date_str and date_str.strip():
-            try:
-                date_obj = datetime.strptime(date_str.strip()[:10], '%d-%m-%Y').date()
-                
-                # Берем только даты <= целевой даты
-                if date_obj <= target_date:
-                    # Если дата новее, или дата та же, но статус позже в воронке
-                    if latest_date is None or date_obj > latest_date:
-                        latest_date = date_obj
-                        status_on_date = status
-                    elif date_obj == latest_date and status_on_date:
-                        # Если даты одинаковые, выбираем статус, который позже в воронке
-                        if status in status_order and status_on_date in status_order:
-                            if status_order.index(status) > status_order.index(status_on_date):
-                                status_on_date = status
-            except:
-                continue
-    
-    return status_on_date
-
-def get_current_statuses_for_date(conn, manager: str, target_date: date) -> dict:
-    """Получает статусы клиентов на определенную дату"""
-    
-    query = """
-    SELECT id, status_wspolpracy, data_ostatniego_zamowienia,
-           data_dodania_do_nowi, data_dodania_do_w_trakcie,
-           data_dodania_do_perspektywiczni, data_pierwszego_zamowienia,
-           data_dodania_do_rezygnacja, data_dodania_do_brak_kontaktu,
-           data_dodania_do_archiwum
-    FROM planfix_clients 
-    WHERE menedzer = %s AND is_deleted = false
-    """
-    params = (manager,)
-    results = _execute_query(conn, query, params, f"statuses for {manager} on {target_date}")
-
-    current_totals = {status: 0 for status in CLIENT_STATUSES}
-    
-    for row in results:
-        client_data = {
-            'id': row[0],
-            'status_wspolpracy': row[1],
-            'data_ostatniego_zamowienia': row[2],
-            'data_dodania_do_nowi': row[3],
-            'data_dodania_do_w_trakcie': row[4],
-            'data_dodania_do_perspektywiczni': row[5],
-            'data_pierwszego_zamowienia': row[6],
-            'data_dodania_do_rezygnacja': row[7],
-            'data_dodania_do_brak_kontaktu': row[8],
-            'data_dodania_do_archiwum': row[9]
-        }
-        
-        # Определяем статус на целевую дату (по самой последней дате ≤ target_date)
-        status_on_date = get_client_status_on_date(client_data, target_date)
-        
-        if status_on_date and status_on_date in current_totals:
-            current_totals[status_on_date] += 1
-    
-    return current_totals
-
-def get_clients_by_status_for_date(conn, manager: str, target_date: date) -> dict:
-    """Получает списки клиентов по статусам на определенную дату"""
-    
-    query = """
-    SELECT id, status_wspolpracy, data_ostatniego_zamowienia,
-           data_dodania_do_nowi, data_dodania_do_w_trakcie,
-           data_dodania_do_perspektywiczni, data_pierwszego_zamowienia,
-           data_dodania_do_rezygnacja, data_dodania_do_brak_kontaktu,
-           data_dodania_do_archiwum
-    FROM planfix_clients 
-    WHERE menedzer = %s AND is_deleted = false
-    """
-    params = (manager,)
-    results = _execute_query(conn, query, params, f"clients by status for {manager} on {target_date}")
-
-    clients_by_status = {status: set() for status in CLIENT_STATUSES}
-    
-    for row in results:
-        client_data = {
-            'id': row[0],
-            'status_wspolpracy': row[1],
-            'data_ostatniego_zamowienia': row[2],
-            'data_dodania_do_nowi': row[3],
-            'data_dodania_do_w_trakcie': row[4],
-            'data_dodania_do_perspektywiczni': row[5],
-            'data_pierwszego_zamowienia': row[6],
-            'data_dodania_do_rezygnacja': row[7],
-            'data_dodania_do_brak_kontaktu': row[8],
-            'data_dodania_do_archiwum': row[9]
-        }
-        
-        # Определяем статус на целевую дату
-        status_on_date = get_client_status_on_date(client_data, target_date)
-        
-        if status_on_date and status_on_date in clients_by_status:
-            clients_by_status[status_on_date].add(row[0])  # Добавляем ID клиента
-    
-    return clients_by_status
-
-def get_daily_transitions_for_client(conn, manager: str, client_id: int, target_date: date) -> list:
-    """Получает все переходы клиента за день"""
-    
-    query = """
-    SELECT id, status_wspolpracy, data_ostatniego_zamowienia,
-           data_dodania_do_nowi, data_dodania_do_w_trakcie,
-           data_dodania_do_perspektywiczni, data_pierwszego_zamowienia,
-           data_dodania_do_rezygnacja, data_dodania_do_brak_kontaktu,
-           data_dodania_do_archiwum
-    FROM planfix_clients 
-    WHERE menedzer = %s AND id = %s AND is_deleted = false
-    """
-    params = (manager, client_id)
-    results = _execute_query(conn, query, params, f"client {client_id} transitions for {manager} on {target_date}")
-    
-    if not results:
-        return []
-    
-    row = results[0]
-    client_data = {
-        'id': row[0],
-        'status_wspolpracy': row[1],
-        'data_ostatniego_zamowienia': row[2],
-        'data_dodania_do_nowi': row[3],
-        'data_dodania_do_w_trakcie': row[4],
-        'data_dodania_do_perspektywiczni': row[5],
-        'data_pierwszego_zamowienia': row[6],
-        'data_dodania_do_rezygnacja': row[7],
-        'data_dodania_do_brak_kontaktu': row[8],
-        'data_dodania_do_archiwum': row[9]
-    }
-    
-    # Собираем все даты статусов за день
-    status_dates = {}
-    for status, col_name in STATUS_INFLOW_DATE_COLS.items():
-        date_str = client_data.get(col_name)
-        if date_str and date_str.strip():
-            try:
-                date_obj = datetime.strptime(date_str.strip()[:10], '%d-%m-%Y').date()
-                if date_obj == target_date:
-                    status_dates[status] = date_obj
-            except (ValueError, TypeError):
-                pass
-    
-    # Добавляем STL/NAK если клиент был в статусе "Stali klienci"
-    if client_data.get('status_wspolpracy') == 'Stali klienci':
-        last_order_date = client_data.get('data_ostatniego_zamowienia')
-        if last_order_date and last_order_date.strip():
-            try:
-                order_date = datetime.strptime(last_order_date.strip()[:10], '%d-%m-%Y').date()
-                if order_date == target_date:
-                    workdays_diff = count_workdays(order_date, target_date)
-                    if workdays_diff <= 30:
-                        status_dates['STL'] = order_date
-                    else:
-                        status_dates['NAK'] = order_date
-            except (ValueError, TypeError):
-                pass
-    
-    # Сортируем по времени (если есть время) или по порядку статусов
-    status_order = ['NWI', 'WTR', 'PSK', 'PIZ', 'STL', 'NAK', 'REZ', 'BRK', 'ARC']
-    transitions = []
-    for status in status_order:
-        if status in status_dates:
-            transitions.append(status)
-    
-    return transitions
-
-
 def get_global_max_count(all_managers_data: dict) -> int:
     """Получить глобальный максимум из словаря {manager: {status: count}}."""
     global_max = 0
@@ -549,7 +277,7 @@ def validate_data_on_the_fly(conn, manager, today):
     issues = []
     
     try:
-        # 1. Проверка некорректных дат
+        # 1. Проверка некорректных дат: текст есть, а типизированная колонка *_date не заполнилась
         invalid_dates_check = """
         SELECT id, status_wspolpracy,
                data_dodania_do_nowi, data_dodania_do_w_trakcie,
@@ -559,29 +287,29 @@ def validate_data_on_the_fly(conn, manager, today):
         FROM planfix_clients 
         WHERE menedzer = %s AND is_deleted = false
           AND (
-            (data_dodania_do_nowi IS NOT NULL AND data_dodania_do_nowi != '' 
-             AND TO_DATE(data_dodania_do_nowi, 'DD-MM-YYYY') IS NULL)
+            (data_dodania_do_nowi IS NOT NULL AND TRIM(data_dodania_do_nowi) != '' 
+             AND data_dodania_do_nowi_date IS NULL)
             OR
-            (data_dodania_do_w_trakcie IS NOT NULL AND data_dodania_do_w_trakcie != '' 
-             AND TO_DATE(data_dodania_do_w_trakcie, 'DD-MM-YYYY') IS NULL)
+            (data_dodania_do_w_trakcie IS NOT NULL AND TRIM(data_dodania_do_w_trakcie) != '' 
+             AND data_dodania_do_w_trakcie_date IS NULL)
             OR
-            (data_dodania_do_perspektywiczni IS NOT NULL AND data_dodania_do_perspektywiczni != '' 
-             AND TO_DATE(data_dodania_do_perspektywiczni, 'DD-MM-YYYY') IS NULL)
+            (data_dodania_do_perspektywiczni IS NOT NULL AND TRIM(data_dodania_do_perspektywiczni) != '' 
+             AND data_dodania_do_perspektywiczni_date IS NULL)
             OR
-            (data_dodania_do_rezygnacja IS NOT NULL AND data_dodania_do_rezygnacja != '' 
-             AND TO_DATE(data_dodania_do_rezygnacja, 'DD-MM-YYYY') IS NULL)
+            (data_dodania_do_rezygnacja IS NOT NULL AND TRIM(data_dodania_do_rezygnacja) != '' 
+             AND data_dodania_do_rezygnacja_date IS NULL)
             OR
-            (data_dodania_do_brak_kontaktu IS NOT NULL AND data_dodania_do_brak_kontaktu != '' 
-             AND TO_DATE(data_dodania_do_brak_kontaktu, 'DD-MM-YYYY') IS NULL)
+            (data_dodania_do_brak_kontaktu IS NOT NULL AND TRIM(data_dodania_do_brak_kontaktu) != '' 
+             AND data_dodania_do_brak_kontaktu_date IS NULL)
             OR
-            (data_dodania_do_archiwum IS NOT NULL AND data_dodania_do_archiwum != '' 
-             AND TO_DATE(data_dodania_do_archiwum, 'DD-MM-YYYY') IS NULL)
+            (data_dodania_do_archiwum IS NOT NULL AND TRIM(data_dodania_do_archiwum) != '' 
+             AND data_dodania_do_archiwum_date IS NULL)
             OR
-            (data_pierwszego_zamowienia IS NOT NULL AND data_pierwszego_zamowienia != '' 
-             AND TO_DATE(data_pierwszego_zamowienia, 'DD-MM-YYYY') IS NULL)
+            (data_pierwszego_zamowienia IS NOT NULL AND TRIM(data_pierwszego_zamowienia) != '' 
+             AND data_pierwszego_zamowienia_date IS NULL)
             OR
-            (data_ostatniego_zamowienia IS NOT NULL AND data_ostatniego_zamowienia != '' 
-             AND TO_DATE(data_ostatniego_zamowienia, 'DD-MM-YYYY') IS NULL)
+            (data_ostatniego_zamowienia IS NOT NULL AND TRIM(data_ostatniego_zamowienia) != '' 
+             AND data_ostatniego_zamowienia_date IS NULL)
           )
         """
         
@@ -678,45 +406,59 @@ def format_client_status_report(changes: dict, global_max: int) -> str:
 
     return "\n".join(lines)
 
-def send_to_telegram(message: str):
-    """Отправить сообщение в Telegram."""
-    try:
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-        payload = {'chat_id': CHAT_ID, 'text': message, 'parse_mode': 'Markdown'}
-        response = requests.post(url, json=payload, timeout=10)
-        if response.status_code == 200:
-            logger.info("Message sent successfully to Telegram")
-        else:
-            logger.error(f"Failed to send message to Telegram: {response.text}")
-    except Exception as e:
-        logger.error(f"Error sending to Telegram: {str(e)}")
-
-def main():
-    """Основная функция для генерации и отправки отчёта."""
-    today = date.today()
+def get_manager_funnel_data(conn, manager: str, today: date, is_live: bool) -> (dict, dict, dict):
+    """
+    Остатки, приток и отток менеджера для отчета за today.
+    Живой отчет за будний день считается заново и сохраняется снимком. Прошедшая дата
+    берется из сохраненного снимка, а без него восстанавливается по датам статусов.
+    Живой отчет за выходные (данные за пятницу) берет снимок пятницы, только если он записан
+    после окончания пятницы (утренний снимок не содержит изменений за остаток дня);
+    иначе отчет считается как раньше, и результат не сохраняется снимком пятницы.
+    """
+    report_date, _ = get_comparison_dates(today)
+    if not is_live or report_date != today:
+        taken_after = datetime.combine(report_date + timedelta(days=1), datetime.min.time()) if is_live else None
+        snapshot = get_funnel_snapshot(conn, report_date, manager, taken_after)
+        if snapshot:
+            logger.info(f"Using stored funnel snapshot for {manager} on {report_date}")
+            return snapshot
+
+    if is_live:
+        totals, inflow, outflow = get_current_statuses_and_inflow(conn, manager, today)
+        if report_date != today:
+            return totals, inflow, outflow
+    else:
+        totals, inflow, outflow = reconstruct_funnel_snapshot(ClientFunnel.load(conn, manager), today)
+    save_funnel_snapshots(conn, snapshot_records(report_date, manager, totals, inflow, outflow))
+    return totals, inflow, outflow
+
+def build_status_messages(report_day: date = None) -> list:
+    """Сообщения отчёта по статусам без отправки (report_day — отчет за прошедшую дату)."""
+    today = report_day or date.today()
+    is_live = today >= date.today()
     logger.info(f"Starting client status report generation for date: {today}")
 
-    conn = None
-    try:
-        conn = psycopg2.connect(host=PG_HOST, dbname=PG_DB, user=PG_USER, password=PG_PASSWORD, port=PG_PORT)
+    with get_connection() as conn:
         create_history_table_if_not_exists(conn)
+        create_snapshot_table_if_not_exists(conn)
 
         all_managers_totals = {}
         all_managers_inflow = {}
         all_managers_outflow = {}
         all_validation_issues = {}
-        
+    
         for manager in (m['planfix_user_name'] for m in MANAGERS_KPI if m['planfix_user_name']):
             # 1. Валидация данных
             validation_issues = validate_data_on_the_fly(conn, manager, today)
             all_validation_issues[manager] = validation_issues
-            
-            # 2. Получаем статусы и потоки
-            totals, inflow, outflow = get_current_statuses_and_inflow(conn, manager, today)
+        
+            # 2. Получаем статусы и потоки (из снимка или расчетом)
+            totals, inflow, outflow = get_manager_funnel_data(conn, manager, today, is_live)
             all_managers_totals[manager] = totals
             all_managers_inflow[manager] = inflow
             all_managers_outflow[manager] = outflow
-            save_statuses_to_history(conn, today, manager, totals)
+            if is_live:
+                save_statuses_to_history(conn, today, manager, totals)
 
         global_max = get_global_max_count(all_managers_totals)
         logger.info(f"Global max count for today is: {global_max}")
@@ -729,27 +471,27 @@ def main():
             last_workday = today - timedelta(days=days_since_friday + 1)  # Четверг
         else:  # Вторник-пятница
             last_workday = today - timedelta(days=1)
-        
+    
         # Используем фиксированные ширины для всех менеджеров
         global_max_current_len = 6   # Фиксированная ширина для текущего количества
         global_max_change_len = 4    # Фиксированная ширина для изменений
-        
+    
         all_reports = []
         for manager, current_totals in all_managers_totals.items():
             report_body = ""
             try:
                 logger.info(f"Processing report for manager: {manager}")
-                
+            
                 # Получаем STL/NAK с последнего рабочего дня из истории
                 previous_stl_nak = get_statuses_from_history(conn, last_workday, manager)
-                
+            
                 status_changes = {}
-                
+            
                 for status in CLIENT_STATUSES:
                     curr_count = current_totals.get(status, 0)
                     inflow = all_managers_inflow[manager].get(status, 0)
                     outflow = all_managers_outflow[manager].get(status, 0)
-                    
+                
                     # Правильная логика Вариант 3:
                     # Net = inflow - outflow (результат движения)
                     # [Inflow/-Outflow] = движение через статус
@@ -763,20 +505,20 @@ def main():
                         'inflow': inflow,
                         'outflow': outflow
                     }
-                
+            
                 logger.info(f"Got status changes for {manager}: {status_changes}")
-                
+            
                 # Формируем тело отчета (строки с KPI)
                 report_kpi_lines = format_client_status_report(status_changes, global_max)
-                
+            
                 # Формируем полный текст сообщения для одного менеджера
                 # Заголовок теперь будет общий, а здесь только имя менеджера
                 manager_header = f"👤 {manager}:"
                 separator = "─────────────────────────────────"
-                
+            
                 # RZM = сумма всех текущих клиентов
                 total_current = sum(data['current'] for data in status_changes.values())
-                
+            
                 # RZM изменение = только реальные изменения в системе:
                 # +1 если добавился новый клиент (NWI inflow)
                 # -1 если клиент удален из системы (например, в архив)
@@ -784,15 +526,15 @@ def main():
                 nwi_inflow = status_changes.get('NWI', {}).get('inflow', 0)
                 # Пока считаем только NWI inflow как реальное добавление в систему
                 total_net = nwi_inflow
-                
+            
                 # Формируем итоговую строку с правильным выравниванием
                 total_current_str = str(total_current)
                 total_change_str = f"+{total_net}" if total_net > 0 else (str(total_net) if total_net < 0 else "")
-                
+            
                 # Используем те же максимальные длины что и в основном отчете
                 max_current_len = max(3, len(total_current_str))
                 max_change_len = max(3, len(total_change_str))
-                
+            
                 # Формат итоговой строки: "RZM BAR CURRENT CHANGE IND"
                 # Используем тот же формат что и в основных строках, но без INOUT и PERCENT
                 # RZM (3) + " " (1) + BAR (5) + " " (1) + CURRENT + " " (1) + CHANGE + " " (1) + IND (1)
@@ -812,19 +554,19 @@ def main():
 
                 full_report_for_manager = f"{manager_header}\n{separator}\n{report_kpi_lines}\n{separator}\n{footer}{validation_info}"
                 all_reports.append(full_report_for_manager)
-                
+            
                 logger.info(f"Generated report for {manager}:\n{full_report_for_manager}")
 
             except Exception as e:
                 logger.error(f"Failed to generate report for {manager}: {e}", exc_info=True)
                 error_message = f"Error generating report for {manager}: {e}"
                 all_reports.append(error_message)
-        
-        # Отправляем один общий отчет
+    
+        # Один общий отчет
         if all_reports:
             # Проверяем, выходной ли день
             is_weekend = today.weekday() >= 5
-            
+        
             if is_weekend:
                 # В выходные показываем данные за пятницу
                 days_since_friday = today.weekday() - 4
@@ -835,8 +577,15 @@ def main():
             else:
                 final_report_header = f"WORONKA_{today.strftime('%d.%m.%Y')}"
                 final_report = f"```{final_report_header}\n\n" + "\n\n".join(all_reports) + "\n```"
-            
-            send_to_telegram(final_report)
+        
+            return [final_report]
+        return []
+
+def main(report_day: date = None):
+    """Основная функция для генерации и отправки отчёта (report_day — отчет за прошедшую дату)."""
+    try:
+        for message in build_status_messages(report_day):
+            send_to_telegram(message)
 
     except psycopg2.Error as e:
         logger.error(f"Database connection error: {e}", exc_info=True)
@@ -844,9 +593,16 @@ def main():
     except Exception as e:
         logger.error(f"An unexpected error occurred: {e}", exc_info=True)
         send_to_telegram(f"An unexpected error occurred: {e}")
-    finally:
-        if conn:
-            conn.close()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Отчет по статусам клиентов (WORONKA).')
+    parser.add_argument('--date', type=date.fromisoformat, help='Отчет за прошедшую дату (YYYY-MM-DD) из снимка воронки')
+    parser.add_argument('--backfill-from', type=date.fromisoformat, help='Заполнить снимки воронки с даты (YYYY-MM-DD) и выйти')
+    parser.add_argument('--backfill-to', type=date.fromisoformat, help='Последняя дата заполнения снимков (по умолчанию вчера)')
+    args = parser.parse_args()
+
+    if args.backfill_from:
+        with get_connection() as conn:
+            backfill_funnel_snapshots(conn, args.backfill_from, args.backfill_to or date.today() - timedelta(days=1))
+    else:
+        main(args.date)
\ No newline at end of file
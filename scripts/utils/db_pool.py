@@ -0,0 +1,153 @@
+"""
+Process-wide PostgreSQL connection pool for reports and KPI code.
+
+Reports and KPIEngine borrow connections from one lazily created
+ThreadedConnectionPool instead of connecting for every query:
+
+    with get_connection() as conn:
+        ...
+
+    rows = execute_query(query, params, "description")
+
+Connections are health-checked when they have been idle for a while and
+replaced if the server has dropped them.
+"""
+import os
+import time
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.pool
+from dotenv import load_dotenv
+
+# Get a logger instance for this module
+logger = logging.getLogger(__name__)
+
+# Load environment variables from .env file
+load_dotenv()
+
+DB_POOL_MIN_CONN = int(os.environ.get('DB_POOL_MIN_CONN', '0'))
+DB_POOL_MAX_CONN = int(os.environ.get('DB_POOL_MAX_CONN', '4'))
+# Connections idle longer than this are pinged before use
+DB_POOL_HEALTHCHECK_SECONDS = float(os.environ.get('DB_POOL_HEALTHCHECK_SECONDS', '30'))
+
+_pool = None
+_pool_lock = threading.Lock()
+# getconn() raises PoolError when the pool is exhausted; the semaphore makes callers wait instead
+_slots = threading.BoundedSemaphore(DB_POOL_MAX_CONN)
+_last_used = {}
+
+
+def _connection_kwargs() -> dict:
+    """Connection parameters: connection string if set, otherwise individual SUPABASE_* variables."""
+    connection_string = os.environ.get('SUPABASE_CONNECTION_STRING')
+    if connection_string:
+        return {'dsn': connection_string}
+    return {
+        'host': os.environ.get('SUPABASE_HOST'),
+        'dbname': os.environ.get('SUPABASE_DB'),
+        'user': os.environ.get('SUPABASE_USER'),
+        'password': os.environ.get('SUPABASE_PASSWORD'),
+        'port': os.environ.get('SUPABASE_PORT')
+    }
+
+
+def _get_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    """Returns the process-wide pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = psycopg2.pool.ThreadedConnectionPool(
+                    DB_POOL_MIN_CONN, DB_POOL_MAX_CONN, **_connection_kwargs()
+                )
+                logger.info(f"Created database connection pool (max {DB_POOL_MAX_CONN} connections).")
+    return _pool
+
+
+def _is_healthy(conn) -> bool:
+    """Checks a pooled connection; long-idle connections are pinged with SELECT 1."""
+    if conn.closed:
+        return False
+    last_used = _last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < DB_POOL_HEALTHCHECK_SECONDS:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error as e:
+        logger.warning(f"Discarding broken pooled connection: {e}")
+        return False
+
+
+def _acquire():
+    pool = _get_pool()
+    conn = pool.getconn()
+    if not _is_healthy(conn):
+        _last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    return conn
+
+
+@contextmanager
+def get_connection():
+    """
+    Borrows a connection from the pool.
+    The transaction is committed on success and rolled back on error,
+    then the connection is returned to the pool.
+    """
+    _slots.acquire()
+    conn = None
+    try:
+        conn = _acquire()
+        yield conn
+        if not conn.closed:
+            conn.commit()
+    except Exception:
+        if conn is not None and not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        raise
+    finally:
+        if conn is not None:
+            if conn.closed:
+                _last_used.pop(id(conn), None)
+            else:
+                _last_used[id(conn)] = time.monotonic()
+            _get_pool().putconn(conn, close=bool(conn.closed))
+        _slots.release()
+
+
+def execute_query(query: str, params: tuple, description: str) -> list:
+    """Executes a read query on a pooled connection and returns all rows."""
+    with get_connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                logger.info(f"Executing query for: {description} with params: {params}")
+                cur.execute(query, params)
+                rows = cur.fetchall()
+                logger.info(f"Query for {description} returned {len(rows)} rows.")
+                return rows
+        except psycopg2.Error as e:
+            logger.error(f"Database error during query for {description}: {e}")
+            raise
+
+
+def close_pool() -> None:
+    """Closes all pooled connections."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _last_used.clear()
+
+
+atexit.register(close_pool)
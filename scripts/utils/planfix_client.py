@@ -0,0 +1,212 @@
+"""
+Shared HTTP client for the Planfix XML API.
+
+All exporters and make_planfix_request() go through one PlanfixClient so that
+TCP/TLS connections are pooled and kept alive between pages, and timeouts,
+retries and request metrics are configured in a single place.
+"""
+import io
+import os
+import time
+import logging
+import threading
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv
+
+# Get a logger instance for this module
+logger = logging.getLogger(__name__)
+
+# Load environment variables from .env file
+load_dotenv()
+
+PLANFIX_API_URL = os.environ.get('PLANFIX_API_URL') or "https://api.planfix.com/xml/"
+
+# Connection pool and timeout settings (can be overridden via environment)
+PLANFIX_POOL_SIZE = int(os.environ.get('PLANFIX_POOL_SIZE', '8'))
+PLANFIX_CONNECT_TIMEOUT = float(os.environ.get('PLANFIX_CONNECT_TIMEOUT', '10'))
+PLANFIX_READ_TIMEOUT = float(os.environ.get('PLANFIX_READ_TIMEOUT', '60'))
+PLANFIX_MAX_RETRIES = int(os.environ.get('PLANFIX_MAX_RETRIES', '3'))
+
+# Pagination settings: page size of list methods and number of pages in flight
+PLANFIX_PAGE_SIZE = 100
+PLANFIX_FETCH_WORKERS = int(os.environ.get('PLANFIX_FETCH_WORKERS', '4'))
+
+
+class PlanfixAPIError(Exception):
+    """Planfix returned <response status="error">."""
+
+
+class PlanfixClient:
+    """Keep-alive session for Planfix XML API requests."""
+
+    def __init__(self, api_key: str = None, token: str = None, account: str = None,
+                 api_url: str = PLANFIX_API_URL, pool_size: int = PLANFIX_POOL_SIZE,
+                 connect_timeout: float = PLANFIX_CONNECT_TIMEOUT,
+                 read_timeout: float = PLANFIX_READ_TIMEOUT,
+                 max_retries: int = PLANFIX_MAX_RETRIES):
+        self.api_key = api_key if api_key is not None else os.environ.get('PLANFIX_API_KEY')
+        self.token = token if token is not None else os.environ.get('PLANFIX_TOKEN')
+        self.account = account if account is not None else os.environ.get('PLANFIX_ACCOUNT')
+        self.api_url = api_url
+        self.timeout = (connect_timeout, read_timeout)
+
+        # Planfix list methods are read-only, so POST retries on connection
+        # errors, 429 and 5xx are safe.
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['POST']),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Content-Type': 'application/xml',
+            'Accept': 'application/xml',
+            'Accept-Encoding': 'gzip, deflate'
+        })
+
+        # Simple request metrics
+        self._lock = threading.Lock()
+        self.request_count = 0
+        self.bytes_received = 0
+        self.total_seconds = 0.0
+
+    def post(self, body: str, use_basic_auth: bool = True) -> str:
+        """
+        Sends an XML request body to Planfix and returns the response text.
+        use_basic_auth: send API key/token as HTTP basic auth (exporters) or
+        rely on the <auth> block inside the body (make_planfix_request).
+        """
+        auth = (self.api_key, self.token) if use_basic_auth else None
+        started = time.monotonic()
+        response = self.session.post(
+            self.api_url,
+            data=body.encode('utf-8'),
+            auth=auth,
+            timeout=self.timeout
+        )
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self.request_count += 1
+            self.bytes_received += len(response.content)
+            self.total_seconds += elapsed
+        response.raise_for_status()
+        return response.text
+
+    def get_stats(self) -> dict:
+        """Returns request metrics collected by this client."""
+        with self._lock:
+            return {
+                'requests': self.request_count,
+                'bytes_received': self.bytes_received,
+                'total_seconds': round(self.total_seconds, 3)
+            }
+
+    def close(self) -> None:
+        """Closes pooled connections."""
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_planfix_client() -> PlanfixClient:
+    """Returns the process-wide PlanfixClient, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = PlanfixClient()
+                logger.info(f"Created Planfix client (pool size {PLANFIX_POOL_SIZE}, timeouts {_client.timeout}).")
+    return _client
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_page_counts(xml_text: str, list_tag: str) -> tuple[int, int | None]:
+    """
+    Reads the count/totalCount attributes of a list response
+    (e.g. <tasks count="100" totalCount="1234">) without building the whole tree.
+    Returns (rows on this page, total rows or None if unknown).
+    Raises PlanfixAPIError if the response is an error.
+    """
+    for _, elem in ET.iterparse(io.BytesIO(xml_text.encode('utf-8')), events=('start',)):
+        if elem.tag == 'response' and elem.get('status') == 'error':
+            root = ET.fromstring(xml_text)
+            raise PlanfixAPIError(f"code={root.findtext('code')}, message={root.findtext('message')}")
+        if elem.tag == list_tag:
+            count = _to_int(elem.get('count'))
+            total = _to_int(elem.get('totalCount'))
+            if count is None:
+                # No count attribute - fall back to counting the rows
+                list_elem = ET.fromstring(xml_text).find(f'.//{list_tag}')
+                count = len(list_elem) if list_elem is not None else 0
+            return count, total
+    return 0, None
+
+
+def iter_pages(fetch_page, list_tag: str, page_size: int = PLANFIX_PAGE_SIZE,
+               workers: int = PLANFIX_FETCH_WORKERS):
+    """
+    Fetches all pages of a Planfix list method and yields (page, xml_text) in page order.
+
+    fetch_page: function page -> xml_text (e.g. get_planfix_orders).
+    list_tag: list element of the response ('tasks', 'contacts').
+    workers: number of pages fetched concurrently; 1 means strictly sequential.
+
+    Page 1 is used as a probe: its totalCount tells how many pages to fetch.
+    If Planfix does not report totalCount, pages are fetched in windows of
+    `workers` until the first short page.
+    """
+    first_xml = fetch_page(1)
+    count, total = get_page_counts(first_xml, list_tag)
+    logger.info(f"Page 1 of {list_tag}: {count} rows, totalCount={total}")
+    yield 1, first_xml
+    if count < page_size:
+        return
+
+    last_page = -(-total // page_size) if total is not None else None
+    if last_page is not None and last_page <= 1:
+        return
+
+    workers = max(1, workers)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"planfix-{list_tag}") as pool:
+        pending = deque()
+        next_page = 2
+        try:
+            while True:
+                while len(pending) < workers and (last_page is None or next_page <= last_page):
+                    pending.append((next_page, pool.submit(fetch_page, next_page)))
+                    next_page += 1
+                if not pending:
+                    break
+                page, future = pending.popleft()
+                xml_text = future.result()
+                count, _ = get_page_counts(xml_text, list_tag)
+                if count == 0:
+                    break
+                yield page, xml_text
+                if count < page_size:
+                    break
+        finally:
+            # Also on a failed fetch or when the consumer stops early (GeneratorExit):
+            # queued pages are not fetched, so leaving the pool waits only for running requests
+            for _, future in pending:
+                future.cancel()
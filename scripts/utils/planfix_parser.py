@@ -0,0 +1,134 @@
+"""
+Streaming parser for Planfix XML list responses.
+
+iter_records() walks a task.getList / contact.getList response with iterparse
+and yields one flat PlanfixRecord per <task>/<contact> element. Each element
+is cleared as soon as it has been handled, so peak memory does not grow with
+the page size, and every field is read once instead of via repeated find().
+"""
+import io
+import logging
+import xml.etree.ElementTree as ET
+
+# Get a logger instance for this module
+logger = logging.getLogger(__name__)
+
+CUSTOM_DATA_TAG = 'customData'
+CUSTOM_VALUE_TAG = 'customValue'
+
+
+class PlanfixRecord:
+    """
+    One <task>/<contact> element flattened into lookups:
+    fields - leaf path relative to the record ('id', 'owner/name') -> text,
+             the first occurrence of a path wins (same as Element.find);
+    custom - customData field name -> {'value': ..., 'text': ...}, only tags
+             present in the response are set; the last customValue wins;
+    groups - repeated group tag ('phones') -> list of {leaf tag: text}.
+    """
+    __slots__ = ('fields', 'custom', 'groups')
+
+    def __init__(self):
+        self.fields = {}
+        self.custom = {}
+        self.groups = {}
+
+    def get(self, path: str, default=None):
+        """Returns the text of a leaf by its path, like Element.findtext()."""
+        return self.fields.get(path, default)
+
+    def get_int(self, path: str) -> int | None:
+        """Returns the leaf as int, or None if it is missing or empty."""
+        value = self.fields.get(path)
+        return int(value) if value else None
+
+    def find_first(self, prefix: str, leaf: str) -> str | None:
+        """
+        Returns the first leaf named `leaf` anywhere under `prefix`,
+        like Element.find(f'{prefix}//{leaf}') (e.g. responsible//user/id).
+        """
+        start = prefix + '/'
+        end = '/' + leaf
+        for path, value in self.fields.items():
+            if path.startswith(start) and path.endswith(end):
+                return value
+        return None
+
+
+def _check_response_status(root_elem, xml_text: str) -> bool:
+    """Logs a Planfix error response. Returns False if the response is an error."""
+    if root_elem.get('status') != 'error':
+        return True
+    root = ET.fromstring(xml_text)
+    code = root.findtext('code')
+    message = root.findtext('message')
+    logger.error(f"Ошибка Planfix API: code={code}, message={message}")
+    return False
+
+
+def iter_records(xml_text: str, list_tag: str, record_tag: str, group_tags: tuple = ()):
+    """
+    Yields a PlanfixRecord for every <record_tag> directly inside <list_tag>.
+
+    xml_text: response of a Planfix list method.
+    list_tag / record_tag: 'tasks'/'task' or 'contacts'/'contact'.
+    group_tags: record children holding repeated items (e.g. ('phones',)),
+        collected into record.groups instead of record.fields.
+    """
+    stack = []
+    list_elem = None
+    record = None
+    record_depth = None
+    custom_value = None
+    group_item = None
+
+    for event, elem in ET.iterparse(io.BytesIO(xml_text.encode('utf-8')), events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem.tag)
+            depth = len(stack)
+            if depth == 1:
+                if not _check_response_status(elem, xml_text):
+                    return
+            elif record is None:
+                if elem.tag == list_tag and list_elem is None:
+                    list_elem = elem
+                elif elem.tag == record_tag and list_elem is not None and stack[-2] == list_tag:
+                    record = PlanfixRecord()
+                    record_depth = depth
+            else:
+                rel_depth = depth - record_depth
+                if elem.tag == CUSTOM_VALUE_TAG and rel_depth == 2 and stack[-2] == CUSTOM_DATA_TAG:
+                    custom_value = {}
+                elif rel_depth == 2 and stack[-2] in group_tags:
+                    group_item = {}
+            continue
+
+        # 'end' event
+        depth = len(stack)
+        if record is not None and depth > record_depth:
+            rel_path = stack[record_depth:]
+            top = rel_path[0]
+            if top == CUSTOM_DATA_TAG:
+                if custom_value is not None:
+                    if len(rel_path) == 2:
+                        name = custom_value.pop('field/name', None)
+                        if name is not None:
+                            record.custom[name] = custom_value
+                        custom_value = None
+                    elif len(elem) == 0:
+                        custom_value.setdefault('/'.join(rel_path[2:]), elem.text)
+            elif top in group_tags:
+                if group_item is not None:
+                    if len(rel_path) == 2:
+                        record.groups.setdefault(top, []).append(group_item)
+                        group_item = None
+                    elif len(elem) == 0:
+                        group_item.setdefault(rel_path[-1], elem.text)
+            elif len(elem) == 0:
+                record.fields.setdefault('/'.join(rel_path), elem.text)
+        elif record is not None and depth == record_depth:
+            yield record
+            record = None
+            elem.clear()
+            list_elem.remove(elem)
+        stack.pop()
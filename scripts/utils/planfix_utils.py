@@ -1,11 +1,15 @@
+import io
 import os
+import json
+import hashlib
 import psycopg2
 import requests
 import xml.etree.ElementTree as ET
-from datetime import datetime
+from datetime import datetime, date
 import logging
 from dotenv import load_dotenv
-import psycopg2.extras
+from .planfix_client import get_planfix_client
+from .sync_state import bump_data_version
 
 # Get a logger instance for this module
 logger = logging.getLogger(__name__)
@@ -26,6 +30,10 @@ SUPABASE_PORT = os.environ.get('SUPABASE_PORT')
 
 PLANFIX_API_URL = "https://api.planfix.com/xml/"
 
+# Content hash used to skip upserts of unchanged rows
+ROW_HASH_COLUMN = "row_hash"
+ROW_HASH_EXCLUDED_COLUMNS = {"updated_at", "is_deleted", ROW_HASH_COLUMN}
+
 def check_required_env_vars(env_vars_dict: dict) -> None:
     """
     Checks if all required environment variables are set.
@@ -78,10 +86,6 @@ def make_planfix_request(method_name: str, params: dict) -> str:
     method_name: имя метода API (например, 'task.getList').
     params: словарь с параметрами запроса.
     """
-    headers = {
-        'Content-Type': 'application/xml',
-        'Accept': 'application/xml'
-    }
     auth_xml = f"""
     <auth>
         <key>{PLANFIX_API_KEY}</key>
@@ -108,11 +112,10 @@ def make_planfix_request(method_name: str, params: dict) -> str:
         """
         logger.info(f"Making Planfix API request to method: {method_name}")
         
-        response = requests.post(PLANFIX_API_URL, data=final_xml_payload.encode('utf-8'), headers=headers)
-        response.raise_for_status()
+        response_text = get_planfix_client().post(final_xml_payload, use_basic_auth=False)
         
         # Check for Planfix API errors in response
-        root = ET.fromstring(response.text)
+        root = ET.fromstring(response_text)
         error = root.find('.//error')
         if error is not None:
             error_code = error.find('code').text if error.find('code') is not None else 'Unknown'
@@ -121,7 +124,7 @@ def make_planfix_request(method_name: str, params: dict) -> str:
             raise ValueError(f"Planfix API error: {error_message}")
             
         logger.info(f"Planfix API request to {method_name} successful.")
-        return response.text
+        return response_text
         
     except ET.ParseError as e:
         logger.error(f"XML ParseError for request_body_xml: {e}. Request body: {request_body_xml[:200]}...")
@@ -213,10 +216,68 @@ def create_table_if_not_exists(conn, create_sql):
         conn.rollback()
         raise
 
+def _to_copy_value(value) -> str:
+    """Formats a Python value for COPY ... FROM STDIN in PostgreSQL text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime, date)):
+        text = value.isoformat()
+    elif isinstance(value, (dict, list)):
+        text = json.dumps(value, ensure_ascii=False)
+    else:
+        text = str(value)
+    return (text.replace('\\', '\\\\')
+                .replace('\t', '\\t')
+                .replace('\n', '\\n')
+                .replace('\r', '\\r'))
+
+def compute_row_hash(record: dict, column_names: list[str]) -> str:
+    """
+    Returns a stable MD5 hash of the record content.
+    Service columns (updated_at, is_deleted, row_hash) are not part of the hash.
+    """
+    hashed_columns = sorted(col for col in column_names if col not in ROW_HASH_EXCLUDED_COLUMNS)
+    payload = "\x1f".join(f"{col}={_to_copy_value(record.get(col))}" for col in hashed_columns)
+    return hashlib.md5(payload.encode('utf-8')).hexdigest()
+
+def filter_changed_records(conn: psycopg2.extensions.connection, table_name: str, primary_key_column: str, column_names: list[str], data_list: list[dict]) -> list[dict]:
+    """
+    Sets row_hash on every record and returns only records that are new,
+    differ from the stored hash or are currently marked as deleted.
+    Stored hashes are fetched with one query for the whole batch.
+    """
+    for record_dict in data_list:
+        record_dict[ROW_HASH_COLUMN] = compute_row_hash(record_dict, column_names)
+
+    ids = [r.get(primary_key_column) for r in data_list if r.get(primary_key_column) is not None]
+    if not ids:
+        return data_list
+
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT "{primary_key_column}", "{ROW_HASH_COLUMN}", is_deleted
+            FROM "{table_name}"
+            WHERE "{primary_key_column}" = ANY(%s)
+        """, (ids,))
+        stored = {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+
+    changed = []
+    for record_dict in data_list:
+        stored_hash, stored_is_deleted = stored.get(record_dict.get(primary_key_column), (None, None))
+        if stored_hash != record_dict[ROW_HASH_COLUMN] or stored_is_deleted:
+            changed.append(record_dict)
+    return changed
+
 def upsert_data_to_supabase(conn: psycopg2.extensions.connection, table_name: str, primary_key_column: str, column_names: list[str], data_list: list[dict]) -> None:
     """
     Upserts data into a Supabase table.
     data_list items already include 'updated_at' and 'is_deleted'.
+    Rows are streamed with COPY into a temporary staging table and merged into
+    the target table with a single INSERT ... SELECT ... ON CONFLICT.
+    If column_names contains row_hash, rows whose content hash matches the
+    stored one are skipped.
     Logs information about the upsert process and errors.
     """
     if not data_list:
@@ -224,33 +285,50 @@ def upsert_data_to_supabase(conn: psycopg2.extensions.connection, table_name: st
         return
 
     logger.info(f"Starting upsert process for {len(data_list)} records into table '{table_name}'.")
-    
+
     cursor = None # Initialize cursor to None for finally block
     try:
+        if ROW_HASH_COLUMN in column_names:
+            total_records = len(data_list)
+            data_list = filter_changed_records(conn, table_name, primary_key_column, column_names, data_list)
+            logger.info(f"Table '{table_name}': {len(data_list)} of {total_records} records changed since last sync.")
+            if not data_list:
+                conn.commit()
+                return
+
         cursor = conn.cursor()
         
+        staging_table = f"{table_name}_staging"
         cols_sql = ", ".join([f'"{col}"' for col in column_names])
-        placeholders_sql = ", ".join(["%s"] * len(column_names))
         update_cols = [col for col in column_names if col != primary_key_column]
         update_set_sql = ", ".join([f'"{col}" = EXCLUDED."{col}"' for col in update_cols])
 
-        upsert_query = f"""
+        # ON CONFLICT cannot update the same row twice in one statement,
+        # so duplicates are collapsed here (the last record wins, as before).
+        records_by_pk = {}
+        for record_dict in data_list:
+            records_by_pk[record_dict.get(primary_key_column)] = record_dict
+
+        buffer = io.StringIO()
+        for record_dict in records_by_pk.values():
+            buffer.write("\t".join(_to_copy_value(record_dict.get(col)) for col in column_names))
+            buffer.write("\n")
+        buffer.seek(0)
+
+        cursor.execute(f"""
+        CREATE TEMP TABLE "{staging_table}" (LIKE "{table_name}" INCLUDING DEFAULTS) ON COMMIT DROP;
+        """)
+        cursor.copy_expert(f'COPY "{staging_table}" ({cols_sql}) FROM STDIN', buffer)
+
+        merge_query = f"""
         INSERT INTO "{table_name}" ({cols_sql})
-        VALUES ({placeholders_sql})
+        SELECT {cols_sql} FROM "{staging_table}"
         ON CONFLICT ("{primary_key_column}") DO UPDATE SET
         {update_set_sql};
         """
-        
-        records_to_insert = []
-        for record_dict in data_list:
-            record_values = [record_dict.get(col) for col in column_names]
-            records_to_insert.append(tuple(record_values))
-
-        if records_to_insert:
-            # logger.debug(f"Upsert query: {upsert_query}")
-            # logger.debug(f"First record to upsert (sample): {records_to_insert[0]}")
-            psycopg2.extras.execute_batch(cursor, upsert_query, records_to_insert)
-            logger.info(f"Successfully upserted {len(records_to_insert)} records to table '{table_name}'.")
+        cursor.execute(merge_query)
+        bump_data_version(cursor, table_name)
+        logger.info(f"Successfully upserted {len(records_by_pk)} records to table '{table_name}'.")
 
         conn.commit()
     except psycopg2.Error as e:
@@ -308,44 +386,57 @@ def add_missing_columns(conn, table_name, expected_columns_map):
         conn.rollback()
         raise
 
-def mark_items_as_deleted_in_supabase(conn: psycopg2.extensions.connection, table_name: str, id_column_name: str, actual_ids: list[int | str]) -> None:
+def mark_items_as_deleted_in_supabase(conn: psycopg2.extensions.connection, table_name: str, id_column_name: str, actual_ids: list[int | str]) -> dict:
     """
-    Marks items as deleted in Supabase table if their IDs are not in actual_ids list.
+    Marks items as deleted in Supabase table if their IDs are not in actual_ids list
+    and revives deleted items that are present in it.
+    The IDs are loaded into a temporary table with COPY and both updates are
+    anti-/semi-joins against it. Returns {'deleted': n, 'revived': m}.
     Logs the process and any errors.
     """
     logger.info(f"Starting process to mark items as deleted in table '{table_name}'.")
     logger.info(f"Number of actual (active) IDs received: {len(actual_ids)} for table '{table_name}'.")
 
+    seen_table = f"{table_name}_seen_ids"
     cursor = None
     try:
         cursor = conn.cursor()
-        if not actual_ids: 
-            update_query = f"""
-            UPDATE "{table_name}"
-            SET is_deleted = TRUE, updated_at = NOW()
-            WHERE is_deleted = FALSE; 
-            """
-            logger.info(f"actual_ids list is empty. Marking all non-deleted items in '{table_name}' as deleted.")
-            cursor.execute(update_query)
+        # Same column type as the target table's ID column
+        cursor.execute(f"""
+        CREATE TEMP TABLE "{seen_table}" ON COMMIT DROP AS
+        SELECT "{id_column_name}" FROM "{table_name}" WITH NO DATA;
+        """)
+        if actual_ids:
+            buffer = io.StringIO("".join(f"{_to_copy_value(item_id)}\n" for item_id in set(actual_ids)))
+            cursor.copy_expert(f'COPY "{seen_table}" ("{id_column_name}") FROM STDIN', buffer)
+            cursor.execute(f'CREATE INDEX ON "{seen_table}" ("{id_column_name}");')
+            cursor.execute(f'ANALYZE "{seen_table}";')
         else:
-            ids_tuple = tuple(actual_ids)
-            if not ids_tuple: # Should be caught by 'if not actual_ids' but as a safeguard
-                logger.warning(f"actual_ids list resulted in an empty tuple for table {table_name}. No items will be marked as deleted based on 'NOT IN ()' clause, which could be problematic.")
-                # This path should ideally not be hit if `actual_ids` is truly empty due to the above `if not actual_ids`.
-                # If `actual_ids` contains items that result in an empty tuple (e.g. list of Nones, though type hints suggest int/str),
-                # then this warning is relevant.
-            
-            update_query = f"""
-            UPDATE "{table_name}"
-            SET is_deleted = TRUE, updated_at = NOW()
-            WHERE "{id_column_name}" NOT IN %s AND is_deleted = FALSE;
-            """
-            # logger.debug(f"Marking items as deleted query: {update_query} with {len(ids_tuple)} IDs.")
-            cursor.execute(update_query, (ids_tuple,))
+            logger.info(f"actual_ids list is empty. Marking all non-deleted items in '{table_name}' as deleted.")
 
+        cursor.execute(f"""
+        UPDATE "{table_name}" t
+        SET is_deleted = TRUE, updated_at = NOW()
+        WHERE t.is_deleted = FALSE
+          AND NOT EXISTS (
+              SELECT 1 FROM "{seen_table}" s WHERE s."{id_column_name}" = t."{id_column_name}"
+          );
+        """)
         deleted_count = cursor.rowcount
+
+        cursor.execute(f"""
+        UPDATE "{table_name}" t
+        SET is_deleted = FALSE, updated_at = NOW()
+        FROM "{seen_table}" s
+        WHERE s."{id_column_name}" = t."{id_column_name}" AND t.is_deleted = TRUE;
+        """)
+        revived_count = cursor.rowcount
+        if deleted_count or revived_count:
+            bump_data_version(cursor, table_name)
+
         conn.commit()
-        logger.info(f"Successfully marked {deleted_count} items as deleted in '{table_name}'.")
+        logger.info(f"Successfully marked {deleted_count} items as deleted and revived {revived_count} items in '{table_name}'.")
+        return {'deleted': deleted_count, 'revived': revived_count}
 
     except Exception as e:
         if conn:
@@ -0,0 +1,72 @@
+"""
+Concurrent report generation with ordered delivery.
+
+Report builders are independent read-mostly queries, so they run in a thread
+pool over the shared utils.db_pool connections and the total time is that of
+the slowest report rather than the sum of all of them. Results come back in
+the order the builders were given, each with its timing and error, and one
+failing report does not stop the others.
+
+REPORT_WORKERS limits how many reports are built at the same time. Keep it
+at or below DB_POOL_MAX_CONN: builders that hold a connection for the whole
+report (status, income) leave fewer slots for the short queries of the rest.
+"""
+import os
+import time
+import logging
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+
+# Get a logger instance for this module
+logger = logging.getLogger(__name__)
+
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', '4'))
+
+
+@dataclass
+class ReportResult:
+    name: str
+    messages: list = field(default_factory=list)
+    seconds: float = 0.0
+    error: Exception = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def _build(name: str, build) -> ReportResult:
+    started = time.monotonic()
+    try:
+        messages = build()
+    except Exception as e:
+        seconds = time.monotonic() - started
+        logger.error(f"Report {name} failed after {seconds:.1f}s: {e}", exc_info=True)
+        return ReportResult(name, seconds=seconds, error=e)
+    seconds = time.monotonic() - started
+    logger.info(f"Report {name} built in {seconds:.1f}s")
+    return ReportResult(name, list(messages or []), seconds)
+
+
+def run_reports(builders: list, max_workers: int = REPORT_WORKERS) -> list[ReportResult]:
+    """
+    Builds reports concurrently. builders is a list of (name, callable returning a list of messages);
+    results are returned in the same order.
+    """
+    if not builders:
+        return []
+    started = time.monotonic()
+    workers = max(1, min(max_workers, len(builders)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='report') as executor:
+        futures = [executor.submit(_build, name, build) for name, build in builders]
+        results = [future.result() for future in futures]
+    logger.info(f"Built {len(results)} reports in {time.monotonic() - started:.1f}s ({workers} workers): {format_timings(results)}")
+    return results
+
+
+def format_timings(results: list[ReportResult]) -> str:
+    """One-line summary like 'activity 1.2s, kpi 3.4s, status FAILED 0.5s'."""
+    return ', '.join(
+        f"{result.name} {result.seconds:.1f}s" if result.ok else f"{result.name} FAILED {result.seconds:.1f}s"
+        for result in results
+    )
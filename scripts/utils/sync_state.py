@@ -0,0 +1,172 @@
+"""
+Incremental sync state for the Planfix exporters.
+
+Each exporter keeps a high-watermark (the latest lastUpdateDate it has seen)
+in the sync_state table and asks Planfix only for records changed since then.
+A full reconciliation pass runs when the last one is older than
+SYNC_FULL_INTERVAL_HOURS, or when --full is passed to the exporter.
+"""
+import os
+import logging
+from datetime import datetime, timedelta
+import psycopg2
+from dotenv import load_dotenv
+
+# Get a logger instance for this module
+logger = logging.getLogger(__name__)
+
+# Load environment variables from .env file
+load_dotenv()
+
+SYNC_STATE_TABLE_NAME = "sync_state"
+SYNC_FULL_INTERVAL_HOURS = float(os.environ.get('SYNC_FULL_INTERVAL_HOURS', '24'))
+
+# Planfix filter type codes for "last update date" in task.getList / contact.getList.
+# Filter codes depend on the Planfix account configuration, so they are set via
+# environment; without them the exporters always run a full sync.
+PLANFIX_TASK_UPDATED_FILTER_TYPE = os.environ.get('PLANFIX_TASK_UPDATED_FILTER_TYPE')
+PLANFIX_CONTACT_UPDATED_FILTER_TYPE = os.environ.get('PLANFIX_CONTACT_UPDATED_FILTER_TYPE')
+
+SYNC_MODE_FULL = 'full'
+SYNC_MODE_INCREMENTAL = 'incremental'
+
+
+def create_sync_state_table(conn) -> None:
+    """Creates the sync_state table if it does not exist."""
+    query = f"""
+    CREATE TABLE IF NOT EXISTS "{SYNC_STATE_TABLE_NAME}" (
+        entity TEXT PRIMARY KEY,
+        watermark TIMESTAMP,
+        last_sync_at TIMESTAMP,
+        last_sync_mode TEXT,
+        last_full_sync_at TIMESTAMP
+    );
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query)
+        conn.commit()
+    except psycopg2.Error as e:
+        logger.error(f"Error creating table '{SYNC_STATE_TABLE_NAME}': {e}")
+        conn.rollback()
+        raise
+
+
+def get_sync_state(conn, entity: str) -> dict | None:
+    """Returns the stored sync state of an entity or None if it was never synced."""
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT watermark, last_sync_at, last_sync_mode, last_full_sync_at
+            FROM "{SYNC_STATE_TABLE_NAME}"
+            WHERE entity = %s
+        """, (entity,))
+        row = cur.fetchone()
+    if not row:
+        return None
+    return {
+        'watermark': row[0],
+        'last_sync_at': row[1],
+        'last_sync_mode': row[2],
+        'last_full_sync_at': row[3]
+    }
+
+
+def choose_sync_mode(conn, entity: str, filter_type: str | None, force_full: bool = False) -> tuple[str, datetime | None]:
+    """
+    Decides whether the next run of an exporter is full or incremental.
+    Returns (mode, updated_since); updated_since is None for a full sync.
+    """
+    if force_full:
+        logger.info(f"[{entity}] Full sync requested explicitly.")
+        return SYNC_MODE_FULL, None
+    if not filter_type:
+        logger.warning(f"[{entity}] Planfix 'last update date' filter type is not configured. Running full sync.")
+        return SYNC_MODE_FULL, None
+
+    state = get_sync_state(conn, entity)
+    if not state or not state['watermark'] or not state['last_full_sync_at']:
+        logger.info(f"[{entity}] No previous sync state. Running full sync.")
+        return SYNC_MODE_FULL, None
+    if datetime.now() - state['last_full_sync_at'] >= timedelta(hours=SYNC_FULL_INTERVAL_HOURS):
+        logger.info(f"[{entity}] Last full sync at {state['last_full_sync_at']}. Running full reconciliation.")
+        return SYNC_MODE_FULL, None
+
+    logger.info(f"[{entity}] Incremental sync of records changed since {state['watermark']}.")
+    return SYNC_MODE_INCREMENTAL, state['watermark']
+
+
+def build_updated_since_filter(filter_type: str | None, updated_since: datetime | None) -> str:
+    """Returns the <filter> XML fragment selecting records changed since updated_since."""
+    if not filter_type or not updated_since:
+        return ''
+    # Planfix date filters have day granularity, so the whole watermark day is re-read
+    date_from = updated_since.strftime('%d-%m-%Y')
+    date_to = (datetime.now() + timedelta(days=1)).strftime('%d-%m-%Y')
+    return (
+        '  <filter>'
+        f'    <type>{filter_type}</type>'
+        '    <operator>equal</operator>'
+        '    <value>'
+        '      <datetype>otherrange</datetype>'
+        f'      <datefrom>{date_from}</datefrom>'
+        f'      <dateto>{date_to}</dateto>'
+        '    </value>'
+        '  </filter>'
+    )
+
+
+def max_watermark(current: datetime | None, records: list[dict], column: str = 'last_update_date') -> datetime | None:
+    """Returns the latest of the current watermark and the records' last update dates."""
+    result = current
+    for record in records:
+        value = record.get(column)
+        if isinstance(value, str):
+            try:
+                value = datetime.fromisoformat(value)
+            except ValueError:
+                continue
+        if isinstance(value, datetime) and (result is None or value > result):
+            result = value
+    return result
+
+
+def data_version_entity(table_name: str) -> str:
+    """sync_state entity whose last_sync_at records the last write to table_name."""
+    return f"{table_name}_data"
+
+
+def bump_data_version(cur, table_name: str) -> None:
+    """
+    Records that rows of table_name changed. Runs on the caller's cursor, so the
+    mark is committed (or rolled back) together with the write itself. The report
+    cache (bot/report_cache.py) reads sync_state as its data version, so reports
+    are rebuilt after every write, not only after a successful sync run.
+    """
+    cur.execute(f"""
+    INSERT INTO "{SYNC_STATE_TABLE_NAME}" (entity, last_sync_at)
+    VALUES (%s, clock_timestamp())
+    ON CONFLICT (entity) DO UPDATE SET last_sync_at = EXCLUDED.last_sync_at;
+    """, (data_version_entity(table_name),))
+
+
+def save_sync_state(conn, entity: str, watermark: datetime | None, mode: str) -> None:
+    """Stores the watermark and the mode of a finished sync run."""
+    now = datetime.now()
+    query = f"""
+    INSERT INTO "{SYNC_STATE_TABLE_NAME}" (entity, watermark, last_sync_at, last_sync_mode, last_full_sync_at)
+    VALUES (%s, %s, %s, %s, %s)
+    ON CONFLICT (entity) DO UPDATE SET
+        watermark = COALESCE(EXCLUDED.watermark, "{SYNC_STATE_TABLE_NAME}".watermark),
+        last_sync_at = EXCLUDED.last_sync_at,
+        last_sync_mode = EXCLUDED.last_sync_mode,
+        last_full_sync_at = COALESCE(EXCLUDED.last_full_sync_at, "{SYNC_STATE_TABLE_NAME}".last_full_sync_at);
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query, (entity, watermark, now, mode, now if mode == SYNC_MODE_FULL else None))
+        conn.commit()
+        logger.info(f"[{entity}] Sync state saved: mode={mode}, watermark={watermark}.")
+    except psycopg2.Error as e:
+        logger.error(f"Error saving sync state for '{entity}': {e}")
+        conn.rollback()
+        raise
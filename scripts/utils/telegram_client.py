@@ -0,0 +1,221 @@
+"""
+Shared Telegram Bot API client for report delivery.
+
+All reports and the bot send messages through one TelegramClient so that
+connections are pooled and kept alive, every request has a timeout, and
+bursts (e.g. /report_all) respect Telegram's flood limits:
+
+- a token bucket per chat (TELEGRAM_CHAT_RATE messages per second, bursts of
+  TELEGRAM_CHAT_BURST) and a global bucket (TELEGRAM_GLOBAL_RATE per second);
+- on 429 the chat is paused for the retry_after Telegram returns and the
+  message is re-sent (up to TELEGRAM_MAX_RETRIES times);
+- messages longer than 4096 characters are split on line boundaries, and a
+  ``` code block cut by the split is closed and reopened in the next part.
+"""
+import os
+import time
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv
+
+# Get a logger instance for this module
+logger = logging.getLogger(__name__)
+
+# Load environment variables from .env file
+load_dotenv()
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+TELEGRAM_MESSAGE_LIMIT = 4096
+CODE_FENCE = '```'
+
+TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', '4'))
+TELEGRAM_CONNECT_TIMEOUT = float(os.environ.get('TELEGRAM_CONNECT_TIMEOUT', '5'))
+TELEGRAM_READ_TIMEOUT = float(os.environ.get('TELEGRAM_READ_TIMEOUT', '15'))
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', '3'))
+# Telegram allows about one message per second per chat (short bursts are tolerated) and 30 per second overall
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = float(os.environ.get('TELEGRAM_CHAT_BURST', '3'))
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', '30'))
+
+
+class TokenBucket:
+    """Thread-safe token bucket: acquire() blocks until a token is available."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _wait_time(self, now: float) -> float:
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                wait = self._wait_time(time.monotonic())
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Blocks all acquires for `seconds` (Telegram retry_after) and empties the bucket."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+            self._updated = self._paused_until
+
+
+def _split_long_line(line: str, limit: int) -> list[str]:
+    return [line[i:i + limit] for i in range(0, len(line), limit)]
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list[str]:
+    """
+    Splits text into parts of at most `limit` characters on line boundaries.
+    If a part ends inside a ``` block, the block is closed there and reopened
+    on its own line at the start of the next part, so every part is valid Markdown
+    (text right after an opening fence would be taken as the block's language).
+    """
+    if len(text) <= limit:
+        return [text]
+
+    reopen = CODE_FENCE + '\n'
+    # Room for the closing fence (on its own line) at the end of a part
+    body_limit = limit - len('\n' + CODE_FENCE)
+    # A single line longer than this is cut, so that it fits after a reopening fence
+    line_limit = body_limit - len(reopen)
+    parts = []
+    current = ''
+    in_code = False
+    for line in text.splitlines(keepends=True):
+        for piece in (_split_long_line(line, line_limit) if len(line) > line_limit else [line]):
+            if current not in ('', reopen) and len(current) + len(piece) > body_limit:
+                if in_code:
+                    current += ('' if current.endswith('\n') else '\n') + CODE_FENCE
+                parts.append(current)
+                current = reopen if in_code else ''
+            current += piece
+            if piece.count(CODE_FENCE) % 2:
+                in_code = not in_code
+    if current:
+        parts.append(current)
+    return parts
+
+
+class TelegramClient:
+    """Keep-alive session for Bot API sendMessage with per-chat rate limiting."""
+
+    def __init__(self, token: str = None, pool_size: int = TELEGRAM_POOL_SIZE,
+                 connect_timeout: float = TELEGRAM_CONNECT_TIMEOUT,
+                 read_timeout: float = TELEGRAM_READ_TIMEOUT,
+                 max_retries: int = TELEGRAM_MAX_RETRIES,
+                 chat_rate: float = TELEGRAM_CHAT_RATE, chat_burst: float = TELEGRAM_CHAT_BURST,
+                 global_rate: float = TELEGRAM_GLOBAL_RATE):
+        self.token = token if token is not None else os.environ.get('TELEGRAM_BOT_TOKEN')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+
+        # sendMessage is not idempotent: only connection errors (request not sent) are retried here,
+        # 429 is handled in send_message with Telegram's retry_after
+        retry = Retry(total=max_retries, connect=max_retries, read=0, status=0, backoff_factor=0.5)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._lock = threading.Lock()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        with self._lock:
+            bucket = self._chat_buckets.get(str(chat_id))
+            if bucket is None:
+                bucket = self._chat_buckets[str(chat_id)] = TokenBucket(self.chat_rate, self.chat_burst)
+            return bucket
+
+    def _send_part(self, chat_id, text: str, parse_mode: str | None) -> bool:
+        url = f"{TELEGRAM_API_URL}/bot{self.token}/sendMessage"
+        payload = {'chat_id': chat_id, 'text': text}
+        if parse_mode:
+            payload['parse_mode'] = parse_mode
+        bucket = self._chat_bucket(chat_id)
+
+        for attempt in range(self.max_retries + 1):
+            bucket.acquire()
+            self._global_bucket.acquire()
+            try:
+                response = self.session.post(url, json=payload, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Failed to send message to Telegram chat {chat_id}: {e}")
+                return False
+
+            if response.status_code == 200:
+                return True
+            if response.status_code == 429 and attempt < self.max_retries:
+                try:
+                    retry_after = float(response.json().get('parameters', {}).get('retry_after', 1))
+                except ValueError:
+                    retry_after = 1.0
+                logger.warning(f"Telegram rate limit for chat {chat_id}, retrying after {retry_after}s")
+                bucket.pause(retry_after)
+                continue
+            logger.error(f"Failed to send message to Telegram: {response.status_code} - {response.text}")
+            return False
+        return False
+
+    def send_message(self, chat_id, text: str, parse_mode: str | None = 'Markdown') -> bool:
+        """
+        Sends text to a chat, split into several messages if it is too long.
+        Returns True if every part was delivered.
+        """
+        if not self.token or not chat_id:
+            logger.error("Telegram token or chat ID not configured")
+            return False
+        parts = split_message(text)
+        for number, part in enumerate(parts, 1):
+            if not self._send_part(chat_id, part, parse_mode):
+                logger.error(f"Message to Telegram chat {chat_id} stopped at part {number} of {len(parts)}")
+                return False
+        logger.info(f"Message sent to Telegram chat {chat_id}" + (f" in {len(parts)} parts" if len(parts) > 1 else ""))
+        return True
+
+    def close(self) -> None:
+        """Closes pooled connections."""
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_telegram_client() -> TelegramClient:
+    """Returns the process-wide TelegramClient, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = TelegramClient()
+    return _client
+
+
+def send_to_telegram(message: str, chat_id=None, parse_mode: str | None = 'Markdown') -> bool:
+    """
+    Sends a report message to chat_id (by default TELEGRAM_CHAT_ID).
+    Pass parse_mode=None for text that is not Markdown (error notices with raw exception text).
+    """
+    return get_telegram_client().send_message(chat_id or os.environ.get('TELEGRAM_CHAT_ID'), message, parse_mode)
@@ -0,0 +1,53 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+from utils.telegram_client import CODE_FENCE, split_message
+
+
+def _code_report(lines: int) -> str:
+    rows = '\n'.join(f"Manager {number:04d} | {number * 7:>6} | {number * 13:>6}" for number in range(lines))
+    return f"*KPI*\n{CODE_FENCE}\n{rows}\n{CODE_FENCE}\nKoniec"
+
+
+class SplitMessageTest(unittest.TestCase):
+
+    def test_short_message_is_not_split(self):
+        self.assertEqual(split_message("short", limit=200), ["short"])
+
+    def test_reopened_code_block_starts_on_its_own_line(self):
+        text = _code_report(30)
+        parts = split_message(text, limit=200)
+
+        self.assertGreater(len(parts), 2)
+        for part in parts:
+            self.assertLessEqual(len(part), 200)
+            self.assertEqual(part.count(CODE_FENCE) % 2, 0, part)
+        for part in parts[1:-1]:
+            self.assertTrue(part.startswith(CODE_FENCE + '\n'), part)
+            self.assertTrue(part.rstrip('\n').endswith('\n' + CODE_FENCE), part)
+        # Removing the added fences gives back the original rows in order
+        rows = [line for part in parts for line in part.splitlines() if line.startswith('Manager')]
+        self.assertEqual(rows, [line for line in text.splitlines() if line.startswith('Manager')])
+
+    def test_line_longer_than_limit_is_cut(self):
+        long_line = 'x' * 450
+        text = f"{CODE_FENCE}\n{long_line}\n{CODE_FENCE}"
+        parts = split_message(text, limit=100)
+
+        for part in parts:
+            self.assertLessEqual(len(part), 100)
+            self.assertEqual(part.count(CODE_FENCE) % 2, 0, part)
+        self.assertEqual(''.join(line for part in parts for line in part.splitlines() if line != CODE_FENCE), long_line)
+
+    def test_plain_text_parts_have_no_fences(self):
+        text = '\n'.join(f"line {number}" for number in range(100))
+        parts = split_message(text, limit=120)
+
+        self.assertEqual(''.join(parts), text)
+        self.assertTrue(all(CODE_FENCE not in part for part in parts))
+
+
+if __name__ == '__main__':
+    unittest.main()